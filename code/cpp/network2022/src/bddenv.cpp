@@ -494,6 +494,89 @@ vector<int> dynamicBitsetToVector(const boost::dynamic_bitset<> &bitset)
     return result;
 }
 
+int BDDEnv::prune_dd(vector<vector<int>> pareto_states)
+{
+    // Keep only the nodes whose state is one of the predicted Pareto states of
+    // their layer, so that the frontier is computed on the DD compiled by this
+    // env instead of compiling it again. Layer l of pareto_states is layer l + 1
+    // of the DD, same as in get_dd_arrays.
+    if (problem_type != 1 || bdd == NULL)
+    {
+        cout << "BDD not constructed! Cannot prune BDD. " << endl;
+        return 1;
+    }
+
+    timers.start_timer(approx_time);
+    for (int l = 1; l < bdd->num_layers - 1 && l - 1 < (int)pareto_states.size(); ++l)
+    {
+        unordered_set<int> states(pareto_states[l - 1].begin(), pareto_states[l - 1].end());
+        vector<Node *> pruned_layer;
+        pruned_layer.reserve(states.size());
+        for (vector<Node *>::iterator it = bdd->layers[l].begin(); it != bdd->layers[l].end(); ++it)
+        {
+            if (states.count((*it)->weight[0]))
+            {
+                pruned_layer.push_back(*it);
+            }
+            else
+            {
+                bdd->remove_node(*it);
+            }
+        }
+        bdd->layers[l] = pruned_layer;
+    }
+    bdd->fix_indices();
+    timers.end_timer(approx_time);
+
+    return 0;
+}
+
+int BDDEnv::prune_dd_mask(const uint8_t *keep, size_t n_keep)
+{
+    // Same as prune_dd, but keep[i] tells whether to keep the i-th node in the
+    // order of get_dd_arrays, so that membership is a single lookup
+    if (bdd == NULL)
+    {
+        cout << "BDD not constructed! Cannot prune BDD. " << endl;
+        return 1;
+    }
+
+    size_t n_nodes = 0;
+    for (int l = 1; l < bdd->num_layers - 1; ++l)
+    {
+        n_nodes += bdd->layers[l].size();
+    }
+    if (n_nodes != n_keep)
+    {
+        cout << "Pruning mask does not match the BDD! Expected " << n_nodes << " nodes, got " << n_keep << endl;
+        return 1;
+    }
+
+    timers.start_timer(approx_time);
+    size_t i = 0;
+    for (int l = 1; l < bdd->num_layers - 1; ++l)
+    {
+        vector<Node *> pruned_layer;
+        pruned_layer.reserve(bdd->layers[l].size());
+        for (vector<Node *>::iterator it = bdd->layers[l].begin(); it != bdd->layers[l].end(); ++it, ++i)
+        {
+            if (keep[i])
+            {
+                pruned_layer.push_back(*it);
+            }
+            else
+            {
+                bdd->remove_node(*it);
+            }
+        }
+        bdd->layers[l] = pruned_layer;
+    }
+    bdd->fix_indices();
+    timers.end_timer(approx_time);
+
+    return 0;
+}
+
 vector<map<string, vector<int>>> BDDEnv::get_layer(int l)
 {
     vector<map<string, vector<int>>> layer;
@@ -570,6 +653,65 @@ vector<vector<map<string, vector<int>>>> BDDEnv::get_dd()
     return dd;
 }
 
+DDArrays BDDEnv::get_dd_arrays()
+{
+    DDArrays dd;
+    dd.layer_ptr.push_back(0);
+    dd.state_ptr.push_back(0);
+    dd.op_ptr.push_back(0);
+    dd.zp_ptr.push_back(0);
+
+    size_t n_nodes = 0;
+    for (int l = 1; l < bdd->num_layers - 1; ++l)
+    {
+        n_nodes += bdd->layers[l].size();
+    }
+    dd.layer_ptr.reserve(bdd->num_layers - 1);
+    dd.state_ptr.reserve(n_nodes + 1);
+    dd.op_ptr.reserve(n_nodes + 1);
+    dd.zp_ptr.reserve(n_nodes + 1);
+
+    for (int l = 1; l < bdd->num_layers - 1; ++l)
+    {
+        for (vector<Node *>::iterator it = bdd->layers[l].begin();
+             it != bdd->layers[l].end(); ++it)
+        {
+            // Node state
+            if (problem_type == 1)
+            {
+                dd.state.insert(dd.state.end(), (*it)->weight.begin(), (*it)->weight.end());
+            }
+            else if (problem_type == 2)
+            {
+                const boost::dynamic_bitset<> &state = (*it)->setpack_state;
+                for (boost::dynamic_bitset<>::size_type i = state.find_first();
+                     i != boost::dynamic_bitset<>::npos; i = state.find_next(i))
+                {
+                    dd.state.push_back(i);
+                }
+            }
+            dd.state_ptr.push_back(dd.state.size());
+
+            // Indices of one prev
+            for (vector<Node *>::iterator it1 = (*it)->prev[1].begin(); it1 != (*it)->prev[1].end(); ++it1)
+            {
+                dd.op_idx.push_back((*it1)->index);
+            }
+            dd.op_ptr.push_back(dd.op_idx.size());
+
+            // Indices of zero prev
+            for (vector<Node *>::iterator it1 = (*it)->prev[0].begin(); it1 != (*it)->prev[0].end(); ++it1)
+            {
+                dd.zp_idx.push_back((*it1)->index);
+            }
+            dd.zp_ptr.push_back(dd.zp_idx.size());
+        }
+        dd.layer_ptr.push_back(dd.state_ptr.size() - 1);
+    }
+
+    return dd;
+}
+
 vector<int> BDDEnv::get_var_layer()
 {
     if (problem_type == 2)
@@ -597,6 +739,10 @@ double BDDEnv::get_time(int time_type)
     {
         return timers.get_time(pareto_time);
     }
+    else if (time_type == 3)
+    {
+        return timers.get_time(approx_time);
+    }
     else
     {
         return -1;
@@ -5,6 +5,8 @@
 // General includes
 #include <iostream>
 #include <cstdlib>
+#include <cstdint>
+#include <unordered_set>
 
 #include "bdd/bdd.hpp"
 #include "bdd/bdd_alg.hpp"
@@ -34,6 +36,20 @@
 // #include "instances/tsp_instance.hpp"
 // #include "mdd/tsp_mdd.hpp"
 
+// Flat view of a DD: layer offsets into the node arrays, node states and
+// one-arc/zero-arc parents in CSR form. Parent indices are local to the
+// previous layer, same as the "op"/"zp" entries returned by get_dd.
+struct DDArrays
+{
+    vector<int64_t> layer_ptr;
+    vector<int64_t> state_ptr;
+    vector<int> state;
+    vector<int64_t> op_ptr;
+    vector<int> op_idx;
+    vector<int64_t> zp_ptr;
+    vector<int> zp_idx;
+};
+
 class BDDEnv
 {
 public:
@@ -133,12 +149,18 @@ public:
 
     int reduce_dd();
 
+    int prune_dd(vector<vector<int>> pareto_states);
+
+    int prune_dd_mask(const uint8_t *keep, size_t n_keep);
+
     int compute_pareto_frontier();
 
     vector<map<string, vector<int>>> get_layer(int);
 
     vector<vector<map<string, vector<int>>>> get_dd();
 
+    DDArrays get_dd_arrays();
+
     vector<int> get_var_layer();
 
     vector<int> get_frontier();
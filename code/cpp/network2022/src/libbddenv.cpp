@@ -1,9 +1,80 @@
 #include "bddenv.hpp"
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
+#include <pybind11/numpy.h>
 
 namespace py = pybind11;
 
+// Hand the buffer of a vector over to NumPy without copying it. The vector is
+// moved to the heap and freed when the array is garbage collected.
+template <typename T>
+py::array_t<T> to_numpy(vector<T> &&vec)
+{
+    vector<T> *data = new vector<T>(std::move(vec));
+    py::capsule owner(data, [](void *p)
+                      { delete reinterpret_cast<vector<T> *>(p); });
+
+    return py::array_t<T>(data->size(), data->data(), owner);
+}
+
+// Same columns as morbdd.utils.ColumnarBDD
+py::dict get_dd_arrays(BDDEnv &env)
+{
+    DDArrays dd;
+    {
+        py::gil_scoped_release release;
+        dd = env.get_dd_arrays();
+    }
+
+    py::dict arrays;
+    arrays["layer_ptr"] = to_numpy(std::move(dd.layer_ptr));
+    arrays["state_ptr"] = to_numpy(std::move(dd.state_ptr));
+    arrays["state"] = to_numpy(std::move(dd.state));
+    arrays["op_ptr"] = to_numpy(std::move(dd.op_ptr));
+    arrays["op_idx"] = to_numpy(std::move(dd.op_idx));
+    arrays["zp_ptr"] = to_numpy(std::move(dd.zp_ptr));
+    arrays["zp_idx"] = to_numpy(std::move(dd.zp_idx));
+
+    return arrays;
+}
+
+// Prune the DD with a mask over its nodes, in the order of get_dd_arrays. The
+// mask is read in place.
+int prune_dd_mask(BDDEnv &env, py::array_t<uint8_t, py::array::c_style | py::array::forcecast> keep)
+{
+    py::buffer_info info = keep.request();
+    const uint8_t *data = static_cast<const uint8_t *>(info.ptr);
+
+    py::gil_scoped_release release;
+    return env.prune_dd_mask(data, info.size);
+}
+
+// Same as prune_dd_mask, with the indices of the nodes to keep, e.g.
+// np.flatnonzero(mask)
+int prune_dd_nodes(BDDEnv &env, py::array_t<int64_t, py::array::c_style | py::array::forcecast> nodes, size_t n_nodes)
+{
+    py::buffer_info info = nodes.request();
+    const int64_t *data = static_cast<const int64_t *>(info.ptr);
+
+    py::gil_scoped_release release;
+    vector<uint8_t> keep(n_nodes, 0);
+    for (py::ssize_t i = 0; i < info.size; ++i)
+    {
+        if (data[i] < 0 || (size_t)data[i] >= n_nodes)
+        {
+            return 1;
+        }
+        keep[data[i]] = 1;
+    }
+
+    return env.prune_dd_mask(keep.data(), keep.size());
+}
+
+// Long running calls release the GIL so that several BDDEnv objects can be
+// used concurrently from Python threads. They only touch the C++ state of
+// their own env.
+using release_gil = py::call_guard<py::gil_scoped_release>;
+
 PYBIND11_MODULE(libbddenv, m)
 {
     py::class_<BDDEnv>(m, "BDDEnv")
@@ -12,13 +83,17 @@ PYBIND11_MODULE(libbddenv, m)
         .def("set_inst", &BDDEnv::set_inst)
         .def("preprocess_inst", &BDDEnv::preprocess_inst)
         .def("initialize_dd_constructor", &BDDEnv::initialize_dd_constructor)
-        .def("generate_dd", &BDDEnv::generate_dd)
-        .def("generate_next_layer", &BDDEnv::generate_next_layer)
+        .def("generate_dd", &BDDEnv::generate_dd, release_gil())
+        .def("generate_next_layer", &BDDEnv::generate_next_layer, release_gil())
         .def("approximate_layer", &BDDEnv::approximate_layer)
         .def("get_dd", &BDDEnv::get_dd)
         .def("get_layer", &BDDEnv::get_layer)
-        .def("reduce_dd", &BDDEnv::reduce_dd)
-        .def("compute_pareto_frontier", &BDDEnv::compute_pareto_frontier)
+        .def("get_dd_arrays", &get_dd_arrays)
+        .def("reduce_dd", &BDDEnv::reduce_dd, release_gil())
+        .def("prune_dd", &BDDEnv::prune_dd, release_gil())
+        .def("prune_dd_mask", &prune_dd_mask)
+        .def("prune_dd_nodes", &prune_dd_nodes)
+        .def("compute_pareto_frontier", &BDDEnv::compute_pareto_frontier, release_gil())
         .def("get_var_layer", &BDDEnv::get_var_layer)
         .def("get_frontier", &BDDEnv::get_frontier)
         .def("get_time", &BDDEnv::get_time)
@@ -35,5 +110,5 @@ PYBIND11_MODULE(libbddenv, m)
         .def_readwrite("num_comparisons_per_layer", &BDDEnv::num_comparisons_per_layer)
         .def_readwrite("in_degree", &BDDEnv::in_degree)
         .def_readwrite("nnds", &BDDEnv::nnds)
-        .def_readwrite("z_sol", &BDDEnv::z_sol)
+        .def_readwrite("z_sol", &BDDEnv::z_sol);
 }
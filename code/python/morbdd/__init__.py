@@ -22,3 +22,4 @@ class ResourcePaths:
 class Const:
     TIME_COMPILE = 1
     TIME_PARETO = 2
+    TIME_PRUNE = 3
@@ -0,0 +1,37 @@
+import hydra
+import numpy as np
+
+from morbdd.utils import ShardWriter
+from morbdd.utils import get_shard_store_path
+from morbdd.utils import get_weights_type
+from morbdd.utils import get_xgb_data_loader
+
+
+@hydra.main(version_base="1.2", config_path="./configs", config_name="build_xgb_store.yaml")
+def main(cfg):
+    sampling_type = f"npr{cfg.neg_pos_ratio}ms{cfg.min_samples}"
+    weights_type = get_weights_type(cfg.flag_layer_penalty,
+                                    cfg.layer_penalty,
+                                    cfg.flag_imbalance_penalty,
+                                    cfg.flag_importance_penalty,
+                                    cfg.penalty_aggregation)
+    load = get_xgb_data_loader(cfg.prob.name, cfg.prob.size, cfg.split, sampling_type, weights_type, cfg.label,
+                               data_format=cfg.source)
+
+    path = get_shard_store_path(cfg.prob.name, cfg.prob.size, cfg.split, sampling_type, weights_type, cfg.label)
+    writer = ShardWriter(path, shard_rows=cfg.shard_rows)
+    for pid in range(cfg.from_pid, cfg.to_pid):
+        data = load(pid)
+        if data is None:
+            continue
+        x, y, wt = data
+        # The last feature is (layer + 1) / layer_norm_const
+        layer = np.rint(x[:, -1] * cfg.prob.layer_norm_const) - 1
+        writer.add(pid, x, y, wt, layer)
+    writer.close()
+    print(f"Stored {sum(shard['n_rows'] for shard in writer.shards)} rows of {len(writer.pids)} instances "
+          f"in {len(writer.shards)} shards at {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import json
+import zipfile
+
+import hydra
+
+from morbdd import resource_path
+from morbdd.utils import get_columnar_bdd_path
+from morbdd.utils import get_results
+from morbdd.utils import run_pids
+from morbdd.utils import save_columnar_bdd
+
+
+def get_archive_path(cfg):
+    return resource_path / f"bdds/{cfg.prob}/{cfg.size}.zip"
+
+
+def init_worker(cfg):
+    with zipfile.ZipFile(get_archive_path(cfg)) as zf:
+        members = set(zf.namelist())
+
+    return {"members": members}
+
+
+def worker(pid, cfg, members):
+    file = f"{cfg.size}/{cfg.split}/{pid}.json"
+    if file not in members:
+        return False
+
+    file_path = get_columnar_bdd_path(cfg.prob, cfg.size, cfg.split, pid)
+    if file_path.exists() and not cfg.overwrite:
+        return False
+
+    with zipfile.ZipFile(get_archive_path(cfg)) as zf:
+        with zf.open(file, "r") as fp:
+            bdd = json.load(fp)
+    save_columnar_bdd(file_path, bdd)
+
+    return True
+
+
+@hydra.main(version_base="1.2", config_path="./configs", config_name="convert_bdd.yaml")
+def main(cfg):
+    results = run_pids(worker,
+                       range(cfg.from_pid, cfg.to_pid),
+                       args=(cfg,),
+                       num_processes=cfg.num_processes,
+                       init_fn=init_worker)
+
+    converted = sum(get_results(results))
+    print(f"Converted {converted} BDDs to the columnar format")
+
+
+if __name__ == '__main__':
+    main()
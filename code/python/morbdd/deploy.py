@@ -1,6 +1,5 @@
 import hashlib
 import json
-import multiprocessing as mp
 import time
 
 import hydra
@@ -8,17 +7,30 @@ import libbddenvv1
 # import networkx as nx
 import numpy as np
 import pandas as pd
+import xgboost as xgb
 # import torch
 # from torchmetrics.classification import BinaryStatScores
 
+from morbdd import Const as CONST
 from morbdd import resource_path
+from morbdd.utils import ColumnarBDD
 from morbdd.utils import get_instance_data
+from morbdd.utils import get_results
 from morbdd.utils import get_static_order
 from morbdd.utils import get_xgb_model_name
 from morbdd.utils import label_bdd
+from morbdd.utils import load_columnar_bdd
+from morbdd.utils import run_pids
 from morbdd.utils import statscore
 import gurobipy as gp
-from morbdd.heuristics import stitch
+from morbdd.generate_raw_data import get_lib
+from morbdd.heuristics import stitch_disconnected_layers
+from morbdd.predict_xgb import convert_bdd_to_xgb_data_deploy
+from morbdd.predict_xgb import load_bdd
+from morbdd.predict_xgb import load_model
+from morbdd.predict_xgb import save_bdd
+from morbdd.predict_xgb import set_prediction_score_on_node
+from morbdd.utils.connectivity import read_pred
 
 
 def call_get_model_name(cfg):
@@ -63,51 +75,19 @@ def call_get_model_name(cfg):
                                   device=cfg.device)
 
 
-def check_connectedness(prev_layer, layer, threshold=0.5, round_upto=1):
-    is_connected = False
-    if prev_layer is None:
-        # On the first layer, we only check if there exists at least one node with a score higher than threshold
-        # to check for connectedness as the root node is always selected.
-        for node in layer:
-            if np.round(node["pred"], round_upto) >= threshold:
-                is_connected = True
-                node["conn"] = True
-            else:
-                node["conn"] = False
-    else:
-        # Check if we have a high scoring node. If yes, then check if at least one of the parents is also high scoring.
-        for node in layer:
-            is_node_connected = False
-            node["conn"] = False
-            if np.round(node["pred"], round_upto) >= threshold:
-                for op in node["op"]:
-                    if prev_layer[op]["conn"]:
-                        is_connected = True
-                        is_node_connected = True
-                        node["conn"] = True
-                        break
-
-                if not is_node_connected:
-                    for zp in node["zp"]:
-                        if prev_layer[zp]["conn"]:
-                            is_connected = True
-                            node["conn"] = True
-                            break
-
-    return is_connected
+def get_pareto_mask(bdd, threshold=0.5, round_upto=1):
+    # Nodes predicted to be Pareto, in the order of get_dd_arrays
+    return np.round(read_pred(bdd), round_upto) >= threshold
 
 
 def get_pareto_states_per_layer(bdd, threshold=0.5, round_upto=1):
-    pareto_states_per_layer = []
-    for layer in bdd:
-        _pareto_states = []
-        for node in layer:
-            if np.round(node["pred"], round_upto) >= threshold:
-                _pareto_states.append(node["s"][0])
-
-        pareto_states_per_layer.append(_pareto_states)
+    mask = get_pareto_mask(bdd, threshold=threshold, round_upto=round_upto)
+    states = np.fromiter((node["s"][0] for layer in bdd for node in layer), dtype=np.int64, count=len(mask))
+    layer_ptr = np.cumsum([0] + [len(layer) for layer in bdd])
 
-    return pareto_states_per_layer
+    # Sorted, unique states of the predicted Pareto nodes of every layer
+    return [np.unique(states[start:end][mask[start:end]]).tolist()
+            for start, end in zip(layer_ptr[:-1], layer_ptr[1:])]
 
 
 def get_run_data_from_env(env, order_type, was_disconnected):
@@ -273,70 +253,212 @@ def compute_pareto_frontier_on_pareto_bdd(cfg, env, pareto_states, inst_data, or
     return env
 
 
-def worker(rank, cfg, mdl_hex):
-    env = libbddenvv1.BDDEnv()
+def compile_dd(cfg, env, inst_data, order):
+    # Compile the DD in a network env, where it stays for pruning once it is scored
+    if cfg.prob.name == "knapsack":
+        env.reset(cfg.bin.problem_type,
+                  cfg.bin.preprocess,
+                  cfg.bin.pf_enum_method,
+                  cfg.bin.maximization,
+                  cfg.bin.dominance,
+                  cfg.bin.bdd_type,
+                  cfg.bin.maxwidth,
+                  order)
+        env.set_inst(cfg.prob.num_vars,
+                     1,
+                     cfg.prob.num_objs,
+                     inst_data['value'],
+                     [inst_data['weight']],
+                     [inst_data['capacity']])
+    else:
+        raise ValueError("Invalid problem name!")
+
+    if cfg.bin.preprocess:
+        env.preprocess_inst()
+    env.initialize_dd_constructor()
+    env.generate_dd()
+    if cfg.deploy.reduce_dd:
+        env.reduce_dd()
+
+    return ColumnarBDD(env.get_dd_arrays())
+
+
+def compute_pareto_frontier_on_cached_dd(cfg, env, pareto_mask):
+    # Prune the DD kept in the env by compile_dd instead of compiling it again
+    if env.prune_dd_mask(pareto_mask) != 0:
+        raise ValueError("Invalid pruning mask!")
+    env.compute_pareto_frontier()
+
+    return env
+
+
+def get_run_data_from_cached_env(env, order_type, was_disconnected):
+    frontier = env.get_frontier()
+    sol = {"x": frontier["x"],
+           "z": frontier["z"],
+           "ot": order_type}
+    # Reduction time is included in the compilation time
+    time_result = {"compilation": env.get_time(CONST.TIME_COMPILE),
+                   "reduction": 0,
+                   "pareto": env.get_time(CONST.TIME_PARETO),
+                   "pruning": env.get_time(CONST.TIME_PRUNE)}
 
+    data = [was_disconnected,
+            env.initial_node_count,
+            env.reduced_node_count,
+            env.initial_arcs_count,
+            env.reduced_arcs_count,
+            env.num_comparisons,
+            sol,
+            time_result]
+
+    return data
+
+
+def save_time_result(cfg, time_results, mdl_hex):
+    out_path = resource_path / f"predictions/{cfg.deploy.mdl}/{cfg.prob.name}/{cfg.prob.size}/{cfg.deploy.split}/{mdl_hex}"
+    out_path.mkdir(exist_ok=True, parents=True)
+    df = pd.DataFrame(time_results)
+    df.to_csv(out_path / f"time_deploy_result_{cfg.deploy.pipeline}_{df['pid'].iloc[0]}.csv", index=False)
+
+
+def load_pred_bdd(cfg, mdl_hex, pid):
+    # Scored BDD written by predict_xgb.py
+    bdd_path = resource_path / (f"predictions/{cfg.deploy.mdl}/{cfg.prob.name}/{cfg.prob.size}/{cfg.deploy.split}/"
+                                f"{mdl_hex}/pred_bdd/{pid}.json")
+    print(bdd_path)
+    if bdd_path.with_suffix(".cbdd").exists():
+        return load_columnar_bdd(bdd_path.with_suffix(".cbdd")).to_list()
+    elif bdd_path.exists():
+        return json.load(open(bdd_path, "r"))
+
+    return None
+
+
+def predict_bdd(cfg, model, mdl_hex, pid, inst_data, order, timings, bdd=None):
+    # Score the BDD in memory, same as predict_xgb.worker
+    if bdd is None:
+        bdd = load_bdd(cfg.prob.name, cfg.prob.size, cfg.deploy.split, pid, bdd_format=cfg.deploy.bdd_format)
+    if bdd is None:
+        return None
+
+    start = time.time()
+    features = convert_bdd_to_xgb_data_deploy(cfg.prob.name,
+                                              bdd=bdd,
+                                              inst_data=inst_data,
+                                              order=order,
+                                              state_norm_const=cfg.prob.state_norm_const,
+                                              layer_norm_const=cfg.prob.layer_norm_const)
+    dfeatures = xgb.DMatrix(features)
+    timings["time_featurize"] = time.time() - start
+
+    start = time.time()
+    preds = model.predict(dfeatures, iteration_range=(0, model.best_iteration + 1))
+    timings["time_predict"] = time.time() - start
+
+    start = time.time()
+    bdd = set_prediction_score_on_node(bdd, preds)
+    if cfg.deploy.save_pred_bdd:
+        save_bdd(cfg.prob.name, cfg.prob.size, cfg.deploy.split, pid, bdd, mdl_hex)
+    if isinstance(bdd, ColumnarBDD):
+        bdd = bdd.to_list()
+    timings["time_set_score"] = time.time() - start
+
+    return bdd
+
+
+def init_worker(cfg, mdl_hex):
+    if cfg.deploy.dd_source == "cached":
+        assert cfg.deploy.pipeline == "fused", "The cached DD is only scored by the fused pipeline!"
+        env = get_lib("network", n_objs=cfg.prob.num_objs).BDDEnv()
+    elif cfg.deploy.dd_source == "compile":
+        env = libbddenvv1.BDDEnv()
+    else:
+        raise ValueError("Invalid DD source!")
+
+    worker_state = {"env": env, "model": None}
+    if cfg.deploy.pipeline == "fused":
+        worker_state["model"] = load_model(cfg, mdl_hex)
+        assert worker_state["model"] is not None
+    elif cfg.deploy.pipeline != "staged":
+        raise ValueError("Invalid deploy pipeline!")
+
+    return worker_state
+
+
+def worker(pid, cfg, mdl_hex, env, model=None):
     pred_stats_per_layer = np.zeros((cfg.prob.num_vars, 5))
     pred_stats_per_layer[:, 0] = np.arange(pred_stats_per_layer.shape[0])
-    pids, bdd_data = [], []
-    for pid in range(cfg.deploy.from_pid + rank, cfg.deploy.to_pid, cfg.deploy.num_processes):
-        print(pid)
-        # Read instance
-        inst_data = get_instance_data(cfg.prob.name, cfg.prob.size, cfg.deploy.split, pid)
-        order = get_static_order(cfg.prob.name, cfg.deploy.order_type, inst_data)
-
-        # Load BDD
-        bdd_path = resource_path / (f"predictions/{cfg.deploy.mdl}/{cfg.prob.name}/{cfg.prob.size}/{cfg.deploy.split}/"
-                                    f"{mdl_hex}/pred_bdd/{pid}.json")
-        print(bdd_path)
-        if not bdd_path.exists():
-            continue
-        bdd = json.load(open(bdd_path, "r"))
+    timings = {"pid": pid}
+
+    print(pid)
+    # Read instance
+    start = time.time()
+    inst_data = get_instance_data(cfg.prob.name, cfg.prob.size, cfg.deploy.split, pid)
+    order = get_static_order(cfg.prob.name, cfg.deploy.order_type, inst_data)
+    timings["time_read"] = time.time() - start
+
+    # Load BDD, either scored by predict_xgb.py or scored here
+    if model is None:
+        start = time.time()
+        bdd = load_pred_bdd(cfg, mdl_hex, pid)
+        timings["time_load_pred_bdd"] = time.time() - start
+    else:
+        dd = None
+        if cfg.deploy.dd_source == "cached":
+            start = time.time()
+            dd = compile_dd(cfg, env, inst_data, order)
+            timings["time_compile"] = time.time() - start
+        bdd = predict_bdd(cfg, model, mdl_hex, pid, inst_data, order, timings, bdd=dd)
+    if bdd is None:
+        return None
+    # A DD compiled here has no Pareto labels
+    if len(bdd) and len(bdd[0]) and "pareto" in bdd[0][0]:
         bdd = label_bdd(bdd, cfg.deploy.label)
         pred_stats_per_layer = get_prediction_stats(bdd,
                                                     pred_stats_per_layer,
                                                     threshold=cfg.deploy.threshold,
                                                     round_upto=cfg.deploy.round_upto)
 
-        # Check connectedness of predicted Pareto BDD and perform stitching if necessary
-        was_disconnected, total_time_stitching, time_mip, count_stitching = False, 0, 0, 0
-        for lidx, layer in enumerate(bdd):
-            prev_layer = bdd[lidx - 1] if lidx > 0 else None
-            is_connected = check_connectedness(prev_layer,
-                                               layer,
-                                               threshold=cfg.deploy.threshold,
-                                               round_upto=cfg.deploy.round_upto)
-            if not is_connected:
-                print(f"Disconnected {pid}, layer: ", lidx)
-                was_disconnected = True
-                count_stitching += 1
-                bdd, total_time_stitching, time_mip = stitch("knapsack",
-                                                             cfg,
-                                                             bdd,
-                                                             lidx,
-                                                             total_time_stitching)
-
-        # cfg.deploy.stitching_heuristic = "mip"
-        # bdd, total_time_stitching, time_mip = stitch("knapsack", cfg, bdd, lidx, total_time_stitching)
-
-        if ((was_disconnected is False and cfg.deploy.process_connected) or
-                (was_disconnected is True and cfg.deploy.process_disconnected)):
-            # Compute Pareto frontier on predicted Pareto BDD
+    # Check connectedness of predicted Pareto BDD and perform stitching if necessary
+    start = time.time()
+    bdd, was_disconnected, total_time_stitching, time_mip, count_stitching = stitch_disconnected_layers("knapsack",
+                                                                                                      cfg,
+                                                                                                      bdd,
+                                                                                                      pid)
+    timings["time_connect"] = time.time() - start
+
+    # cfg.deploy.stitching_heuristic = "mip"
+    # bdd, total_time_stitching, time_mip = stitch("knapsack", cfg, bdd, lidx, total_time_stitching)
+
+    bdd_data = None
+    if ((was_disconnected is False and cfg.deploy.process_connected) or
+            (was_disconnected is True and cfg.deploy.process_disconnected)):
+        # Compute Pareto frontier on predicted Pareto BDD
+        start = time.time()
+        if cfg.deploy.dd_source == "cached":
+            # The nodes of the cached DD are in the same order as the scored BDD
+            pareto_mask = get_pareto_mask(bdd,
+                                          threshold=cfg.deploy.threshold,
+                                          round_upto=cfg.deploy.round_upto)
+            env = compute_pareto_frontier_on_cached_dd(cfg, env, pareto_mask)
+            timings["time_pareto"] = time.time() - start
+            _data = get_run_data_from_cached_env(env, cfg.deploy.order_type, was_disconnected)
+        else:
             pareto_states = get_pareto_states_per_layer(bdd,
                                                         threshold=cfg.deploy.threshold,
                                                         round_upto=cfg.deploy.round_upto)
             env = compute_pareto_frontier_on_pareto_bdd(cfg, env, pareto_states, inst_data, order)
-
+            timings["time_pareto"] = time.time() - start
             # Extract run info
             _data = get_run_data_from_env(env, cfg.deploy.order_type, was_disconnected)
-            _data1 = [total_time_stitching, time_mip, count_stitching]
-            _data1.extend(_data)
+        _data1 = [total_time_stitching, time_mip, count_stitching]
+        _data1.extend(_data)
 
-            pids.append(pid)
-            bdd_data.append(_data1)
-            print(f'Processed: {pid}, was_disconnected: {_data[0]}, n_sols: {len(_data[-2]["x"])}')
+        bdd_data = _data1
+        print(f'Processed: {pid}, was_disconnected: {_data[0]}, n_sols: {len(_data[-2]["x"])}')
 
-    return pids, bdd_data, pred_stats_per_layer
+    return pid, bdd_data, pred_stats_per_layer, timings
 
 
 @hydra.main(version_base="1.2", config_path="./configs", config_name="deploy.yaml")
@@ -348,23 +470,26 @@ def main(cfg):
     mdl_hex = h.hexdigest()
     print(f"Using model: ", mdl_hex)
     # Deploy model
-    # pool = mp.Pool(processes=cfg.deploy.num_processes)
-    # results = []
-    # for rank in range(cfg.deploy.num_processes):
-    #     results.append(pool.apply_async(worker, args=(rank, cfg, mdl_hex)))
-
-    results = [worker(0, cfg, mdl_hex)]
+    results = run_pids(worker,
+                       range(cfg.deploy.from_pid, cfg.deploy.to_pid),
+                       args=(cfg, mdl_hex),
+                       num_processes=cfg.deploy.num_processes,
+                       init_fn=init_worker,
+                       backend=cfg.deploy.backend)
 
     # Fetch results
-    results = [r.get() for r in results]
-
-    pids, bdd_data = [], []
+    pids, bdd_data, time_results = [], [], []
     pred_stats_per_layer = np.zeros((cfg.prob.num_vars, 5))
     pred_stats_per_layer[:, 0] = np.arange(pred_stats_per_layer.shape[0])
-    for r in results:
-        pids.extend(r[0])
-        bdd_data.extend(r[1])
-        pred_stats_per_layer[:, 1:] += r[2][:, 1:]
+    for pid, _bdd_data, _pred_stats_per_layer, timings in get_results(results):
+        pred_stats_per_layer[:, 1:] += _pred_stats_per_layer[:, 1:]
+        time_results.append(timings)
+        if _bdd_data is not None:
+            pids.append(pid)
+            bdd_data.append(_bdd_data)
+
+    if len(time_results):
+        save_time_result(cfg, time_results, mdl_hex)
 
     if len(pids):
         # Save results
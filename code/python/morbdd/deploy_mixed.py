@@ -18,7 +18,7 @@ from morbdd.utils import get_static_order
 from morbdd.utils import label_bdd
 from morbdd.utils import statscore
 # import gurobipy as gp
-from morbdd.heuristics import stitch
+from morbdd.heuristics import stitch_disconnected_layers
 
 
 def get_xgb_model_name(max_depth=None,
@@ -177,40 +177,6 @@ def call_get_model_name(cfg):
                                   device=cfg.device)
 
 
-def check_connectedness(prev_layer, layer, threshold=0.5, round_upto=1):
-    is_connected = False
-    if prev_layer is None:
-        # On the first layer, we only check if there exists at least one node with a score higher than threshold
-        # to check for connectedness as the root node is always selected.
-        for node in layer:
-            if np.round(node["pred"], round_upto) >= threshold:
-                is_connected = True
-                node["conn"] = True
-            else:
-                node["conn"] = False
-    else:
-        # Check if we have a high scoring node. If yes, then check if at least one of the parents is also high scoring.
-        for node in layer:
-            is_node_connected = False
-            node["conn"] = False
-            if np.round(node["pred"], round_upto) >= threshold:
-                for op in node["op"]:
-                    if prev_layer[op]["conn"]:
-                        is_connected = True
-                        is_node_connected = True
-                        node["conn"] = True
-                        break
-
-                if not is_node_connected:
-                    for zp in node["zp"]:
-                        if prev_layer[zp]["conn"]:
-                            is_connected = True
-                            node["conn"] = True
-                            break
-
-    return is_connected
-
-
 def get_pareto_states_per_layer(bdd, threshold=0.5, round_upto=1):
     pareto_states_per_layer = []
     for layer in bdd:
@@ -414,22 +380,10 @@ def worker(rank, cfg, mdl_hex):
                                                     round_upto=cfg.deploy.round_upto)
 
         # Check connectedness of predicted Pareto BDD and perform stitching if necessary
-        was_disconnected, total_time_stitching, time_mip, count_stitching = False, 0, 0, 0
-        for lidx, layer in enumerate(bdd):
-            prev_layer = bdd[lidx - 1] if lidx > 0 else None
-            is_connected = check_connectedness(prev_layer,
-                                               layer,
-                                               threshold=cfg.deploy.threshold,
-                                               round_upto=cfg.deploy.round_upto)
-            if not is_connected:
-                print(f"Disconnected {pid}, layer: ", lidx)
-                was_disconnected = True
-                count_stitching += 1
-                bdd, total_time_stitching, time_mip = stitch("knapsack",
-                                                             cfg,
-                                                             bdd,
-                                                             lidx,
-                                                             total_time_stitching)
+        bdd, was_disconnected, total_time_stitching, time_mip, count_stitching = stitch_disconnected_layers("knapsack",
+                                                                                                          cfg,
+                                                                                                          bdd,
+                                                                                                          pid)
 
         # cfg.deploy.stitching_heuristic = "mip"
         # bdd, total_time_stitching, time_mip = stitch("knapsack", cfg, bdd, lidx, total_time_stitching)
@@ -1,5 +1,4 @@
 import json
-import multiprocessing as mp
 
 import hydra
 import libbddenvv1
@@ -9,6 +8,8 @@ from morbdd import resource_path
 from morbdd.utils import get_instance_data
 from morbdd.utils import get_static_order
 from morbdd.utils import read_from_zip
+from morbdd.utils import run_pids
+from morbdd.utils import save_columnar_bdd
 
 
 def get_pareto_states_per_layer(weight, x):
@@ -28,14 +29,19 @@ def tag_bdd_states(bdd, pareto_state_scores):
     assert len(pareto_state_scores) == len(bdd)
 
     for l in range(len(bdd)):
+        # Pareto states are sorted by np.unique, so nodes can be matched with a binary search
         pareto_states, pareto_scores = pareto_state_scores[l]
-
-        for n in bdd[l]:
-            node_state = n["s"][0]
-            index = np.where(pareto_states == node_state)[0]
-            if len(index):
+        node_states = np.array([n["s"][0] for n in bdd[l]])
+        index = np.zeros(len(node_states), dtype=int)
+        is_pareto = np.zeros(len(node_states), dtype=bool)
+        if len(pareto_states):
+            index = np.minimum(np.searchsorted(pareto_states, node_states), len(pareto_states) - 1)
+            is_pareto = pareto_states[index] == node_states
+
+        for n, i, flag in zip(bdd[l], index, is_pareto):
+            if flag:
                 n["pareto"] = 1
-                n["score"] = pareto_scores[index[0]]
+                n["score"] = pareto_scores[i]
             else:
                 n["pareto"] = 0
                 n["score"] = 0
@@ -43,57 +49,57 @@ def tag_bdd_states(bdd, pareto_state_scores):
     return bdd
 
 
-def worker(rank, cfg):
-    env = libbddenvv1.BDDEnv()
-
-    for pid in range(cfg.from_pid + rank, cfg.to_pid, cfg.num_processes):
-        # print(f"Processing pid {pid}...")
-        # Read instance
-        data = get_instance_data(cfg.prob, cfg.size, cfg.split, pid)
-        order = get_static_order(cfg.prob, cfg.order_type, data)
-
-        # print("\tReading sol...")
-        archive = resource_path / f"sols/{cfg.prob}/{cfg.size}.zip"
-        file = f"{cfg.size}/{cfg.split}/{pid}.json"
-        sol = read_from_zip(archive, file, format="json")
-        # Ignore instances not solved within time limit
-        if sol is None:
-            continue
-
-        # Extract BDD before reduction
-        # print("\tExtracting non-reduced BDD...")
-        env.set_knapsack_inst(cfg.num_vars,
-                              cfg.num_objs,
-                              data['value'],
-                              data['weight'],
-                              data['capacity'])
-        bdd = env.get_bdd(cfg.problem_type, order)
-
-        # Label BDD
-        # print("\tLabelling BDD...")
-        weight = np.array(data['weight'])[order]
-        pareto_state_scores = get_pareto_states_per_layer(weight, np.array(sol["x"]))
-        bdd = tag_bdd_states(bdd, pareto_state_scores)
-
-        # Save
-        print(f"Saving BDD {pid}...")
-        file_path = resource_path / f"bdds/{cfg.prob}/{cfg.size}/{cfg.split}"
-        file_path.mkdir(parents=True, exist_ok=True)
-        file_path /= f"{pid}.json"
-        with open(file_path, "w") as fp:
+def init_worker(cfg):
+    return {"env": libbddenvv1.BDDEnv()}
+
+
+def worker(pid, cfg, env):
+    # print(f"Processing pid {pid}...")
+    # Read instance
+    data = get_instance_data(cfg.prob, cfg.size, cfg.split, pid)
+    order = get_static_order(cfg.prob, cfg.order_type, data)
+
+    # print("\tReading sol...")
+    archive = resource_path / f"sols/{cfg.prob}/{cfg.size}.zip"
+    file = f"{cfg.size}/{cfg.split}/{pid}.json"
+    sol = read_from_zip(archive, file, format="json")
+    # Ignore instances not solved within time limit
+    if sol is None:
+        return
+
+    # Extract BDD before reduction
+    # print("\tExtracting non-reduced BDD...")
+    env.set_knapsack_inst(cfg.num_vars,
+                          cfg.num_objs,
+                          data['value'],
+                          data['weight'],
+                          data['capacity'])
+    bdd = env.get_bdd(cfg.problem_type, order)
+
+    # Label BDD
+    # print("\tLabelling BDD...")
+    weight = np.array(data['weight'])[order]
+    pareto_state_scores = get_pareto_states_per_layer(weight, np.array(sol["x"]))
+    bdd = tag_bdd_states(bdd, pareto_state_scores)
+
+    # Save
+    print(f"Saving BDD {pid}...")
+    file_path = resource_path / f"bdds/{cfg.prob}/{cfg.size}/{cfg.split}"
+    file_path.mkdir(parents=True, exist_ok=True)
+    if cfg.bdd_format == "columnar":
+        save_columnar_bdd(file_path / f"{pid}.cbdd", bdd)
+    else:
+        with open(file_path / f"{pid}.json", "w") as fp:
             json.dump(bdd, fp)
 
 
 @hydra.main(version_base="1.2", config_path="./configs", config_name="bdd_dataset.yaml")
 def main(cfg):
-    pool = mp.Pool(processes=cfg.num_processes)
-    results = []
-
-    for rank in range(cfg.num_processes):
-        results.append(pool.apply_async(worker, args=(rank, cfg)))
-
-    for r in results:
-        r.get()
+    run_pids(worker,
+             range(cfg.from_pid, cfg.to_pid),
+             args=(cfg,),
+             num_processes=cfg.num_processes,
+             init_fn=init_worker)
 
 
 if __name__ == '__main__':
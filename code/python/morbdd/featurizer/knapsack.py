@@ -1,8 +1,6 @@
 from enum import Enum
 import numpy as np
 
-from operator import itemgetter
-
 
 class KnapsackStaticOrderings(Enum):
     max_weight = 0
@@ -90,70 +88,42 @@ class KnapsackFeaturizer:
 
     def _get_heuristic_variable_rank_features(self):
         self.n_vars = len(self.data['weight'])
+        weight = np.asarray(self.data['weight'])
+        value = np.asarray(self.data['value'])
 
         ranks = []
         for o in KnapsackStaticOrderings:
             if o.name == 'max_weight':
-                idx_weight = [(i, w) for i, w in enumerate(self.data['weight'])]
-                idx_weight.sort(key=itemgetter(1), reverse=True)
-                idx_rank = self._get_rank(idx_weight)
+                idx_rank = self._get_rank(weight, reverse=True)
 
             elif o.name == 'min_weight':
-                idx_weight = [(i, w) for i, w in enumerate(self.data['weight'])]
-                idx_weight.sort(key=itemgetter(1))
-                idx_rank = self._get_rank(idx_weight)
+                idx_rank = self._get_rank(weight)
 
             elif o.name == 'max_avg_value':
-                mean_profit = np.mean(self.data['value'], 0)
-                idx_profit = [(i, mp) for i, mp in enumerate(mean_profit)]
-                idx_profit.sort(key=itemgetter(1), reverse=True)
-                idx_rank = self._get_rank(idx_profit)
+                idx_rank = self._get_rank(np.mean(value, 0), reverse=True)
 
             elif o.name == 'min_avg_value':
-                mean_profit = np.mean(self.data['value'], 0)
-                idx_profit = [(i, mp) for i, mp in enumerate(mean_profit)]
-                idx_profit.sort(key=itemgetter(1))
-                idx_rank = self._get_rank(idx_profit)
+                idx_rank = self._get_rank(np.mean(value, 0))
 
             elif o.name == 'max_max_value':
-                max_profit = np.max(self.data['value'], 0)
-                idx_profit = [(i, mp) for i, mp in enumerate(max_profit)]
-                idx_profit.sort(key=itemgetter(1), reverse=True)
-                idx_rank = self._get_rank(idx_profit)
+                idx_rank = self._get_rank(np.max(value, 0), reverse=True)
 
             elif o.name == 'min_max_value':
-                max_profit = np.max(self.data['value'], 0)
-                idx_profit = [(i, mp) for i, mp in enumerate(max_profit)]
-                idx_profit.sort(key=itemgetter(1))
-                idx_rank = self._get_rank(idx_profit)
+                idx_rank = self._get_rank(np.max(value, 0))
 
             elif o.name == 'max_min_value':
-                min_profit = np.min(self.data['value'], 0)
-                idx_profit = [(i, mp) for i, mp in enumerate(min_profit)]
-                idx_profit.sort(key=itemgetter(1), reverse=True)
-                idx_rank = self._get_rank(idx_profit)
+                idx_rank = self._get_rank(np.min(value, 0), reverse=True)
 
             elif o.name == 'min_min_value':
-                min_profit = np.min(self.data['value'], 0)
-                idx_profit = [(i, mp) for i, mp in enumerate(min_profit)]
-                idx_profit.sort(key=itemgetter(1))
-                idx_rank = self._get_rank(idx_profit)
+                idx_rank = self._get_rank(np.min(value, 0))
 
             elif o.name == 'max_avg_value_by_weight':
-                mean_profit = np.mean(self.data['value'], 0)
-                profit_by_weight = [v / w for v, w in zip(mean_profit, self.data['weight'])]
-                idx_profit_by_weight = [(i, f) for i, f in enumerate(profit_by_weight)]
-                idx_profit_by_weight.sort(key=itemgetter(1), reverse=True)
-                idx_rank = self._get_rank(idx_profit_by_weight)
+                idx_rank = self._get_rank(np.mean(value, 0) / weight, reverse=True)
 
             elif o.name == 'max_max_value_by_weight':
-                max_profit = np.max(self.data['value'], 0)
-                profit_by_weight = [v / w for v, w in zip(max_profit, self.data['weight'])]
-                idx_profit_by_weight = [(i, f) for i, f in enumerate(profit_by_weight)]
-                idx_profit_by_weight.sort(key=itemgetter(1), reverse=True)
-                idx_rank = self._get_rank(idx_profit_by_weight)
+                idx_rank = self._get_rank(np.max(value, 0) / weight, reverse=True)
 
-            ranks.append([idx_rank[i] for i in range(self.n_vars)])
+            ranks.append(idx_rank)
 
         ranks = (1 / self.n_vars) * np.asarray(ranks)
         return ranks
@@ -173,10 +143,13 @@ class KnapsackFeaturizer:
         #                                idx_rank_array])
 
     @staticmethod
-    def _get_rank(sorted_data):
-        idx_rank = {}
-        for rank, item in enumerate(sorted_data):
-            idx_rank[item[0]] = rank
+    def _get_rank(key, reverse=False):
+        # Position of every variable when sorted by key. The sort is stable, so ties keep the variable
+        # order, same as list.sort(reverse=True).
+        key = np.asarray(key)
+        order = np.argsort(-key if reverse else key, kind="stable")
+        idx_rank = np.empty(len(key), dtype=np.int64)
+        idx_rank[order] = np.arange(len(key))
 
         return idx_rank
 
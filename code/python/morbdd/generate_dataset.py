@@ -1,78 +1,98 @@
-import multiprocessing as mp
-
 import hydra
 
 from morbdd import resource_path
 from morbdd.utils import convert_bdd_to_tensor_data
 from morbdd.utils import convert_bdd_to_xgb_data
+from morbdd.utils import convert_bdd_to_xgb_indexed_data
 from morbdd.utils import convert_bdd_to_xgb_mixed_data
 from morbdd.utils import label_bdd
 from morbdd.utils import read_from_zip
-
-
-def worker_nn(rank, cfg):
-    for pid in range(cfg.from_pid + rank, cfg.to_pid, cfg.num_processes):
-        # print(f"Processing pid {pid}...")
-        archive = resource_path / f"bdds/{cfg.prob}/{cfg.size}.zip"
-        file = f"{cfg.size}/{cfg.split}/{pid}.json"
-        bdd = read_from_zip(archive, file, format="json")
-        if bdd is None:
-            continue
-        bdd = label_bdd(bdd, cfg.label)
-
-        print(f"\tRank {rank}: Converting BDD:{pid} to tensor dataset...")
-        convert_bdd_to_tensor_data(cfg.prob,
-                                   bdd=bdd,
-                                   num_objs=cfg.num_objs,
-                                   num_vars=cfg.num_vars,
-                                   split=cfg.split,
-                                   pid=pid,
-                                   order_type=cfg.order_type,
-                                   state_norm_const=cfg.state_norm_const,
-                                   layer_norm_const=cfg.layer_norm_const,
-                                   task=cfg.task,
-                                   label_type=cfg.label,
-                                   neg_pos_ratio=cfg.neg_pos_ratio,
-                                   min_samples=cfg.min_samples,
-                                   flag_layer_penalty=cfg.flag_layer_penalty,
-                                   layer_penalty=cfg.layer_penalty,
-                                   flag_imbalance_penalty=cfg.flag_imbalance_penalty,
-                                   flag_importance_penalty=cfg.flag_importance_penalty,
-                                   penalty_aggregation=cfg.penalty_aggregation,
-                                   random_seed=cfg.seed)
-
-
-def worker_xgb(rank, cfg):
-    for pid in range(cfg.from_pid + rank, cfg.to_pid, cfg.num_processes):
-        archive = resource_path / f"bdds/{cfg.prob}/{cfg.size}.zip"
-        file = f"{cfg.size}/{cfg.split}/{pid}.json"
-        bdd = read_from_zip(archive, file, format="json")
-        if bdd is None:
-            continue
-        bdd = label_bdd(bdd, cfg.label)
-
-        convert_bdd_to_xgb_data(cfg.prob,
-                                bdd=bdd,
-                                num_objs=cfg.num_objs,
-                                num_vars=cfg.num_vars,
-                                split=cfg.split,
-                                pid=pid,
-                                order_type=cfg.order_type,
-                                state_norm_const=cfg.state_norm_const,
-                                layer_norm_const=cfg.layer_norm_const,
-                                task=cfg.task,
-                                label_type=cfg.label,
-                                neg_pos_ratio=cfg.neg_pos_ratio,
-                                min_samples=cfg.min_samples,
-                                flag_layer_penalty=cfg.flag_layer_penalty,
-                                layer_penalty=cfg.layer_penalty,
-                                flag_imbalance_penalty=cfg.flag_imbalance_penalty,
-                                flag_importance_penalty=cfg.flag_importance_penalty,
-                                penalty_aggregation=cfg.penalty_aggregation,
-                                random_seed=cfg.seed)
-
-
-def worker_xgb_mixed(rank, cfg):
+from morbdd.utils import run_pids
+
+
+def worker_nn(pid, cfg):
+    # print(f"Processing pid {pid}...")
+    archive = resource_path / f"bdds/{cfg.prob}/{cfg.size}.zip"
+    file = f"{cfg.size}/{cfg.split}/{pid}.json"
+    bdd = read_from_zip(archive, file, format="json")
+    if bdd is None:
+        return
+    bdd = label_bdd(bdd, cfg.label)
+
+    print(f"\tConverting BDD:{pid} to tensor dataset...")
+    convert_bdd_to_tensor_data(cfg.prob,
+                               bdd=bdd,
+                               num_objs=cfg.num_objs,
+                               num_vars=cfg.num_vars,
+                               split=cfg.split,
+                               pid=pid,
+                               order_type=cfg.order_type,
+                               state_norm_const=cfg.state_norm_const,
+                               layer_norm_const=cfg.layer_norm_const,
+                               task=cfg.task,
+                               label_type=cfg.label,
+                               neg_pos_ratio=cfg.neg_pos_ratio,
+                               min_samples=cfg.min_samples,
+                               flag_layer_penalty=cfg.flag_layer_penalty,
+                               layer_penalty=cfg.layer_penalty,
+                               flag_imbalance_penalty=cfg.flag_imbalance_penalty,
+                               flag_importance_penalty=cfg.flag_importance_penalty,
+                               penalty_aggregation=cfg.penalty_aggregation,
+                               random_seed=cfg.seed)
+
+
+def worker_xgb(pid, cfg):
+    archive = resource_path / f"bdds/{cfg.prob}/{cfg.size}.zip"
+    file = f"{cfg.size}/{cfg.split}/{pid}.json"
+    bdd = read_from_zip(archive, file, format="json")
+    if bdd is None:
+        return
+
+    # Labels are computed from the Pareto flags and scores by convert_bdd_to_xgb_data
+    convert_bdd_to_xgb_data(cfg.prob,
+                            bdd=bdd,
+                            num_objs=cfg.num_objs,
+                            num_vars=cfg.num_vars,
+                            split=cfg.split,
+                            pid=pid,
+                            order_type=cfg.order_type,
+                            state_norm_const=cfg.state_norm_const,
+                            layer_norm_const=cfg.layer_norm_const,
+                            task=cfg.task,
+                            label_type=cfg.label,
+                            neg_pos_ratio=cfg.neg_pos_ratio,
+                            min_samples=cfg.min_samples,
+                            flag_layer_penalty=cfg.flag_layer_penalty,
+                            layer_penalty=cfg.layer_penalty,
+                            flag_imbalance_penalty=cfg.flag_imbalance_penalty,
+                            flag_importance_penalty=cfg.flag_importance_penalty,
+                            penalty_aggregation=cfg.penalty_aggregation,
+                            random_seed=cfg.seed)
+
+
+def worker_xgb_indexed(pid, cfg):
+    archive = resource_path / f"bdds/{cfg.prob}/{cfg.size}.zip"
+    file = f"{cfg.size}/{cfg.split}/{pid}.json"
+    bdd = read_from_zip(archive, file, format="json")
+    if bdd is None:
+        return
+
+    convert_bdd_to_xgb_indexed_data(cfg.prob,
+                                    bdd=bdd,
+                                    num_objs=cfg.num_objs,
+                                    num_vars=cfg.num_vars,
+                                    split=cfg.split,
+                                    pid=pid,
+                                    order_type=cfg.order_type,
+                                    state_norm_const=cfg.state_norm_const,
+                                    layer_norm_const=cfg.layer_norm_const,
+                                    label_types=list(cfg.indexed.labels),
+                                    samplings=list(cfg.indexed.samplings),
+                                    weightings=list(cfg.indexed.weightings),
+                                    random_seed=cfg.seed)
+
+
+def worker_xgb_mixed(cfg):
     sizes = str(cfg.mixed.sizes)
     sizes = sizes.strip().split(",")
     counter = int(cfg.from_pid)
@@ -86,7 +106,6 @@ def worker_xgb_mixed(rank, cfg):
             print(archive, pid)
             if bdd is None:
                 continue
-            bdd = label_bdd(bdd, cfg.label)
 
             convert_bdd_to_xgb_mixed_data(cfg.prob,
                                           counter=counter,
@@ -118,20 +137,19 @@ def main(cfg):
         worker_fn = worker_nn
     elif cfg.dtype == "DMatrix":
         worker_fn = worker_xgb
+    elif cfg.dtype == "DMatrix-indexed":
+        worker_fn = worker_xgb_indexed
     elif cfg.dtype == "DMatrix-mixed":
-        worker_fn = worker_xgb_mixed
+        # The sample counter runs across sizes and pids, so the mixed dataset is built sequentially
+        worker_xgb_mixed(cfg)
+        return
     else:
         raise ValueError("Invalid dataset type!")
 
-    # pool = mp.Pool(processes=cfg.num_processes)
-    # results = []
-    # for rank in range(cfg.num_processes):
-    #     results.append(pool.apply_async(worker_fn, args=(rank, cfg)))
-    #
-    # for r in results:
-    #     r.get()
-    # Debug
-    worker_fn(0, cfg)
+    run_pids(worker_fn,
+             range(cfg.from_pid, cfg.to_pid),
+             args=(cfg,),
+             num_processes=cfg.num_processes)
 
 
 if __name__ == '__main__':
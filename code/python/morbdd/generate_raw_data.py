@@ -1,6 +1,5 @@
+import itertools
 import json
-import multiprocessing as mp
-import signal
 import time
 from collections import defaultdict
 
@@ -10,9 +9,17 @@ import pandas as pd
 
 from morbdd import Const as CONST
 from morbdd import ResourcePaths as path
+from morbdd.utils import ColumnarBDD
+from morbdd.utils import STATUS_OK
+from morbdd.utils import get_failed
 from morbdd.utils import get_instance_data
 from morbdd.utils import get_static_order
-from morbdd.utils import handle_timeout
+from morbdd.utils import pack_bitsets
+from morbdd.utils import run_pids
+from morbdd.utils import unpack_bitsets
+from morbdd.utils import save_columnar_bdd
+from morbdd.utils import start_time_budget
+from morbdd.utils import stop_time_budget
 
 
 def get_size(cfg):
@@ -134,48 +141,23 @@ def get_pareto_states_per_layer_knapsack(weight, x):
     return pareto_state_scores
 
 
-def get_pareto_states_per_layer_indepset(order, x_sol, adj_list_comp):
+def get_pareto_states_per_layer_indepset(order, x_sol, adj_list_comp_bits):
     x_sol = np.array(x_sol)
+    n_sols, n_vars = x_sol.shape
     pareto_state_scores = []
 
-    total = x_sol.shape[0]
-    # print(set(list(x_sol[:, 0])))
-    for i in range(1, x_sol.shape[1]):
-        # Get partial sols upto level i in BDD
-        partial_sols = x_sol[:, :i]
-        uniques, counts = np.unique(partial_sols, axis=0, return_counts=True)
-
-        pareto_states = []
-        pareto_counts = []
-
-        # Compute pareto state for each unique sol
-        for unique_sol, count in zip(uniques, counts):
-            _pareto_state = np.ones(x_sol.shape[1])
-            for var_idx, is_active in enumerate(list(unique_sol)):
-                var = order[var_idx]
-                _pareto_state[var] = 0
-                # print(var_idx, var, is_active)
-                if is_active:
-                    # print(adj_list_comp[var])
-                    _pareto_state = np.logical_and(_pareto_state, adj_list_comp[var]).astype(int)
-                    # print(_pareto_state)
-
-            is_found = False
-            for j, ps in enumerate(pareto_states):
-                # print(_pareto_state, ps, np.array_equal(_pareto_state))
-                if np.array_equal(_pareto_state, ps):
-                    pareto_counts[j] += count
-                    is_found = True
-                    break
-            if not is_found:
-                # print(_pareto_state, "not found")
-                pareto_states.append(_pareto_state)
-                pareto_counts.append(count)
-
-        for k in range(len(pareto_counts)):
-            pareto_counts[k] /= total
-
-        pareto_state_scores.append((pareto_states, pareto_counts))
+    # State of every solution as a bitset of the variables that can still be chosen
+    states = np.repeat(pack_bitsets(np.ones((1, n_vars), dtype=bool)), n_sols, axis=0)
+    for i in range(1, n_vars):
+        # Extend the partial solutions by the variable in layer i - 1
+        var = order[i - 1]
+        word, bit = divmod(int(var), 64)
+        states[:, word] &= ~(np.uint64(1) << np.uint64(bit))
+        is_active = x_sol[:, i - 1].astype(bool)
+        states[is_active] &= adj_list_comp_bits[var]
+
+        pareto_states, pareto_counts = np.unique(states, axis=0, return_counts=True)
+        pareto_state_scores.append((unpack_bitsets(pareto_states, n_vars), pareto_counts / n_sols))
 
     return pareto_state_scores
 
@@ -185,158 +167,232 @@ def get_pareto_state_scores_per_layer(problem_type, data, x_sol, order=None, gra
     if problem_type == 1:
         pareto_state_scores = get_pareto_states_per_layer_knapsack(data["cons_coeffs"][0], x_sol)
     elif problem_type == 2:
+        # Packed rows of the complement adjacency matrix
+        adj_list_comp_bits = data["adj_list_comp_bits"] \
+            if "adj_list_comp_bits" in data \
+            else pack_bitsets(data["adj_list_comp"])
         if graph_type == "stidsen":
-            pareto_state_scores = get_pareto_states_per_layer_indepset(order, x_sol, data["adj_list_comp"])
+            pareto_state_scores = get_pareto_states_per_layer_indepset(order, x_sol, adj_list_comp_bits)
         elif graph_type == "ba":
-            pareto_state_scores = get_pareto_states_per_layer_indepset(order, x_sol, data["adj_list_comp"])
+            pareto_state_scores = get_pareto_states_per_layer_indepset(order, x_sol, adj_list_comp_bits)
 
     return pareto_state_scores
 
 
+def get_state_keys(lengths, states, n_bits):
+    # Pack the set-of-variables state of every node into a bitset and use its bytes as the key.
+    # states is the flat list of the node states and lengths the number of entries per node.
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    bits = np.zeros((len(lengths), n_bits), dtype=bool)
+    bits[rows, states] = True
+
+    return [key.tobytes() for key in pack_bitsets(bits)]
+
+
+def get_node_state_keys(layer, n_bits):
+    lengths = [len(n["s"]) for n in layer]
+    states = np.fromiter(itertools.chain.from_iterable(n["s"] for n in layer), dtype=np.int64, count=sum(lengths))
+
+    return get_state_keys(lengths, states, n_bits)
+
+
+def get_pareto_node_index(node_keys, pareto_states, pareto_scores):
+    # Index of the node carrying each Pareto state
+    pareto_states = np.asarray(pareto_states).reshape(len(pareto_scores), -1)
+    # Map each node state to the first node carrying it
+    node_idx = {}
+    for i, key in enumerate(node_keys(pareto_states.shape[1])):
+        node_idx.setdefault(key, i)
+
+    index = []
+    for key in pack_bitsets(pareto_states):
+        i = node_idx.get(key.tobytes())
+        assert i is not None
+        index.append(i)
+
+    return index
+
+
 def tag_dd_nodes(bdd, pareto_state_scores):
     assert len(pareto_state_scores) == len(bdd)
-    items = np.array(range(0, 100))
 
     for l in range(len(bdd)):
         pareto_states, pareto_scores = pareto_state_scores[l]
-        for pareto_state, score in zip(pareto_states, pareto_scores):
-            _pareto_state = items[pareto_state.astype(bool)]
-            is_found = False
-            for n in bdd[l]:
-                if np.array_equal(n["s"], _pareto_state):
-                    n["pareto"] = 1
-                    n["score"] = score
-                    is_found = True
-                    break
-
-            assert is_found
-
         for n in bdd[l]:
-            if "pareto" not in n:
-                n["pareto"] = 0
-                n["score"] = 0
+            n["pareto"] = 0
+            n["score"] = 0
+        if len(pareto_scores) == 0:
+            continue
+
+        index = get_pareto_node_index(lambda n_bits: get_node_state_keys(bdd[l], n_bits),
+                                      pareto_states,
+                                      pareto_scores)
+        for i, score in zip(index, pareto_scores):
+            bdd[l][i]["pareto"] = 1
+            bdd[l][i]["score"] = score
 
     return bdd
 
 
-def worker(rank, cfg):
-    libv2 = get_lib(cfg.bin, n_objs=cfg.prob.n_objs)
-    env = libv2.BDDEnv()
-    signal.signal(signal.SIGALRM, handle_timeout)
-
-    for pid in range(rank, cfg.to_pid, cfg.n_processes):
-        print("1/10: Fetching instance data and order...")
-        data = get_instance_data(cfg.prob.name, cfg.size, cfg.split, pid)
-        order = get_static_order(cfg.prob.name, cfg.order_type, data)
-
-        print("2/10: Resetting env...")
-        initialize_run(cfg.bin,
-                       env,
-                       cfg.problem_type,
-                       cfg.preprocess,
-                       cfg.pf_enum_method,
-                       cfg.bdd_type,
-                       cfg.maxwidth,
-                       order,
-                       cfg.maximization,
-                       cfg.dominance)
-
-        print("3/10: Initializing instance...")
-        set_instance(cfg.bin,
-                     env,
-                     cfg.problem_type,
-                     data,
-                     graph_type=cfg.graph_type)
-
-        print("4/10: Preprocessing instance...")
-        preprocess_inst(cfg.bin,
-                        env,
-                        cfg.problem_type)
-
-        print("5/10: Generating decision diagram...")
-        initialize_dd_constructor(cfg.bin, env)
-        env.generate_dd()
-        time_compile = env.get_time(CONST.TIME_COMPILE)
-
-        print("6/10: Fetching decision diagram...")
-        start = time.time()
-        dd = env.get_dd()
-        time_fetch = time.time() - start
-
-        exact_size = []
-        for i, layer in enumerate(dd):
-            exact_size.append(len(layer))
-        dynamic_order = get_dynamic_order(cfg.bin, env, cfg.problem_type, cfg.order_type, order)
-
-        print("7/10: Computing Pareto Frontier...")
-        try:
-            signal.alarm(cfg.time_limit)
-            env.compute_pareto_frontier()
-        except TimeoutError as exc:
-            is_pf_computed = False
-            print(f"PF not computed within {cfg.time_limit} for pid {pid}")
-        else:
-            is_pf_computed = True
-            print(f"PF computed successfully for pid {pid}")
-        signal.alarm(0)
+def tag_columnar_dd_nodes(dd, pareto_state_scores):
+    # Same as tag_dd_nodes for a DD fetched through get_dd_arrays
+    assert len(pareto_state_scores) == dd.n_layers
 
-        if not is_pf_computed:
+    dd.pareto = np.zeros(dd.n_nodes, dtype=np.int8)
+    dd.score = np.zeros(dd.n_nodes, dtype=np.float64)
+    state_lengths = np.diff(dd.state_ptr)
+    for l in range(dd.n_layers):
+        pareto_states, pareto_scores = pareto_state_scores[l]
+        if len(pareto_scores) == 0:
             continue
-        time_pareto = env.get_time(CONST.TIME_PARETO)
-
-        print("8/10: Fetching Pareto Frontier...")
-        frontier = env.get_frontier()
-
-        print("9/10: Marking Pareto nodes...")
-        pareto_state_scores = get_pareto_state_scores_per_layer(cfg.problem_type, data, frontier["x"],
-                                                                order=dynamic_order,
-                                                                graph_type=cfg.graph_type)
-        dd = tag_dd_nodes(dd, pareto_state_scores)
-
-        print("10/10: Saving data...")
-        # Save BDD
-        file_path = path.bdd / f"{cfg.prob}/{cfg.size}/{cfg.split}"
-        file_path.mkdir(parents=True, exist_ok=True)
-        file_path /= f"{pid}.json"
-        with open(file_path, "w") as fp:
-            json.dump(dd, fp)
-
-        # Save Solution
-        file_path = path.sol / f"{cfg.prob}/{cfg.size}/{cfg.split}"
-        file_path.mkdir(parents=True, exist_ok=True)
-        file_path /= f"{pid}.json"
-        with open(file_path, "w") as fp:
-            json.dump(frontier, fp)
-
-        # Save stats
-        df = pd.DataFrame([
-            [cfg.size,
-             cfg.split,
-             pid,
-             len(frontier["z"]),
-             env.initial_node_count,
-             env.initial_arcs_count,
-             env.num_comparisons,
-             time_fetch,
-             time_compile,
-             time_pareto]], columns=["size", "split", "pid", "nnds", "inc", "iac", "Comp.",
-                                     "compilation", "pareto"])
-        df.to_csv(file_path.parent / f"{pid}.csv", index=False)
+
+        nodes = dd.layer_slice(l)
+        states = dd.state[dd.state_ptr[nodes.start]:dd.state_ptr[nodes.stop]]
+        index = get_pareto_node_index(lambda n_bits: get_state_keys(state_lengths[nodes], states, n_bits),
+                                      pareto_states,
+                                      pareto_scores)
+        index = nodes.start + np.asarray(index, dtype=np.int64)
+        dd.pareto[index] = 1
+        dd.score[index] = pareto_scores
+
+    return dd
+
+
+def fetch_dd(env, dd_fetch):
+    if dd_fetch == "arrays":
+        return ColumnarBDD(env.get_dd_arrays())
+    elif dd_fetch == "dict":
+        return env.get_dd()
+    else:
+        raise ValueError("Invalid DD fetch format!")
+
+
+def init_worker(cfg):
+    libv2 = get_lib(cfg.bin, n_objs=cfg.prob.n_objs)
+
+    return {"env": libv2.BDDEnv()}
+
+
+def worker(pid, cfg, env):
+    print("1/10: Fetching instance data and order...")
+    data = get_instance_data(cfg.prob.name, cfg.size, cfg.split, pid, adj_formats=cfg.adj_formats)
+    order = get_static_order(cfg.prob.name, cfg.order_type, data)
+
+    print("2/10: Resetting env...")
+    initialize_run(cfg.bin,
+                   env,
+                   cfg.problem_type,
+                   cfg.preprocess,
+                   cfg.pf_enum_method,
+                   cfg.bdd_type,
+                   cfg.maxwidth,
+                   order,
+                   cfg.maximization,
+                   cfg.dominance)
+
+    print("3/10: Initializing instance...")
+    set_instance(cfg.bin,
+                 env,
+                 cfg.problem_type,
+                 data,
+                 graph_type=cfg.graph_type)
+
+    print("4/10: Preprocessing instance...")
+    preprocess_inst(cfg.bin,
+                    env,
+                    cfg.problem_type)
+
+    print("5/10: Generating decision diagram...")
+    initialize_dd_constructor(cfg.bin, env)
+    env.generate_dd()
+    time_compile = env.get_time(CONST.TIME_COMPILE)
+
+    print("6/10: Fetching decision diagram...")
+    start = time.time()
+    dd = fetch_dd(env, cfg.dd_fetch)
+    time_fetch = time.time() - start
+    is_columnar = isinstance(dd, ColumnarBDD)
+
+    dynamic_order = get_dynamic_order(cfg.bin, env, cfg.problem_type, cfg.order_type, order)
+
+    print("7/10: Computing Pareto Frontier...")
+    # The worker is killed if the frontier is not computed within cfg.time_limit
+    start_time_budget()
+    env.compute_pareto_frontier()
+    # Saving the results is not timed
+    stop_time_budget()
+    print(f"PF computed successfully for pid {pid}")
+    time_pareto = env.get_time(CONST.TIME_PARETO)
+
+    print("8/10: Fetching Pareto Frontier...")
+    frontier = env.get_frontier()
+
+    print("9/10: Marking Pareto nodes...")
+    pareto_state_scores = get_pareto_state_scores_per_layer(cfg.problem_type, data, frontier["x"],
+                                                            order=dynamic_order,
+                                                            graph_type=cfg.graph_type)
+    dd = tag_columnar_dd_nodes(dd, pareto_state_scores) if is_columnar else tag_dd_nodes(dd, pareto_state_scores)
+
+    print("10/10: Saving data...")
+    # Save BDD
+    file_path = path.bdd / f"{cfg.prob}/{cfg.size}/{cfg.split}"
+    file_path.mkdir(parents=True, exist_ok=True)
+    if cfg.bdd_format == "columnar":
+        save_columnar_bdd(file_path / f"{pid}.cbdd", dd)
+    else:
+        with open(file_path / f"{pid}.json", "w") as fp:
+            json.dump(dd.to_list() if is_columnar else dd, fp)
+
+    # Save Solution
+    file_path = path.sol / f"{cfg.prob}/{cfg.size}/{cfg.split}"
+    file_path.mkdir(parents=True, exist_ok=True)
+    file_path /= f"{pid}.json"
+    with open(file_path, "w") as fp:
+        json.dump(frontier, fp)
+
+    # Save stats
+    df = pd.DataFrame([
+        [cfg.size,
+         cfg.split,
+         pid,
+         len(frontier["z"]),
+         env.initial_node_count,
+         env.initial_arcs_count,
+         env.num_comparisons,
+         time_fetch,
+         time_compile,
+         time_pareto,
+         STATUS_OK]], columns=["size", "split", "pid", "nnds", "inc", "iac", "Comp.", "fetch",
+                               "compilation", "pareto", "status"])
+    df.to_csv(file_path.parent / f"{pid}.csv", index=False)
+
+
+def save_status(cfg, pid, status):
+    # Stats row of a pid whose frontier was not computed
+    file_path = path.sol / f"{cfg.prob}/{cfg.size}/{cfg.split}"
+    file_path.mkdir(parents=True, exist_ok=True)
+    df = pd.DataFrame([[cfg.size, cfg.split, pid, status]], columns=["size", "split", "pid", "status"])
+    df.to_csv(file_path / f"{pid}.csv", index=False)
 
 
 @hydra.main(config_path="./configs", config_name="raw_data.yaml", version_base="1.2")
 def main(cfg):
     cfg.size = get_size(cfg)
-
-    worker(0, cfg)
-    # pool = mp.Pool(processes=cfg.n_processes)
-    # results = []
-    #
-    # for rank in range(cfg.n_processes):
-    #     results.append(pool.apply_async(worker, args=(rank, cfg)))
-    #
-    # for r in results:
-    #     r.get()
+    time_limit = cfg.time_limit
+    if cfg.backend == "thread" and time_limit > 0:
+        # Worker threads cannot be killed, so the frontier computation is not timed
+        print(f"Warning: time_limit {time_limit} ignored by the thread backend")
+        time_limit = 0
+
+    results = run_pids(worker,
+                       range(cfg.from_pid, cfg.to_pid),
+                       args=(cfg,),
+                       num_processes=cfg.n_processes,
+                       timeout=time_limit,
+                       init_fn=init_worker,
+                       backend=cfg.backend)
+    for r in get_failed(results):
+        save_status(cfg, r["pid"], r["status"])
 
 
 if __name__ == "__main__":
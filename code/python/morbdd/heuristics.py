@@ -1,10 +1,12 @@
-import networkx as nx
 import time
 import numpy as np
 # import gurobipy as gp
 from pathlib import Path
 import pandas as pd
 
+from morbdd.utils.connectivity import BDDConnectivity
+from morbdd.utils.connectivity import read_pred
+
 
 # gp.setParam("Threads", 1)
 # # Focus on feasibility
@@ -35,94 +37,132 @@ def get_active_layers(bdd, lidx, lookahead):
     return layers
 
 
-def initialize_paths(parent_layer, threshold=0.5, round_upto=1):
-    return [[node_idx]
-            for node_idx, node in enumerate(parent_layer)
-            if np.round(node["pred"], round_upto) >= threshold and "conn" in node]
+def get_layer_resistance(layer, threshold=0.5, round_upto=1):
+    # get_node_resistance of every node in the layer
+    pred = np.array([node["pred"] for node in layer], dtype=float)
+    return np.where(np.round(pred, round_upto) >= threshold, 0, threshold - pred)
 
 
-def extend_paths(layer, partial_paths):
-    new_partial_paths = []
+def get_layer_arcs(layer):
+    # Parent index (in the previous layer) and child index of every arc into the layer
+    parents, children = [], []
     for node_idx, node in enumerate(layer):
-        for parent_idx in node["op"]:
-            for path in partial_paths:
-                if path[-1] == parent_idx:
-                    new_path = path[:]
-                    new_path.append(node_idx)
-                    new_partial_paths.append(new_path)
-
-        for parent_idx in node["zp"]:
-            for path in partial_paths:
-                if path[-1] == parent_idx:
-                    new_path = path[:]
-                    new_path.append(node_idx)
-                    new_partial_paths.append(new_path)
-
-    return new_partial_paths
-
-
-def get_paths_with_min_resistance(resistances, paths):
-    # Sort paths based on resistance and select the one offering minimum resistance
-    resistances, paths = zip(*sorted(zip(resistances, paths), key=lambda x: x[0]))
-    k = 1
-    for r in resistances[1:]:
-        if r > resistances[0]:
-            break
-        else:
-            k += 1
-
-    return paths[:k]
-
-
-def calculate_path_resistance(path, layers, threshold=0.5, round_upto=1):
-    resistance = 0
-    for node_idx, layer in zip(path[1:], layers[1:]):
-        pred_score = layer[node_idx]["pred"]
-        resistance += get_node_resistance(pred_score,
-                                          threshold=threshold,
-                                          round_upto=round_upto)
-
-    return resistance
-
-
-def generate_resistance_graph(bdd, threshold, round_upto):
-    g = nx.DiGraph()
-    root, terminal = "0-0", f"{len(bdd) + 1}-0"
-
-    edges = []
-    # From root to penultimate layer
-    for lidx, layer in enumerate(bdd):
-        for nidx, node in enumerate(layer):
-            parent_pre = f"{lidx}"
-            node_name = f"{lidx + 1}-{nidx}"
-            resistance = get_node_resistance(node["pred"],
-                                             threshold=threshold,
-                                             round_upto=round_upto)
+        parents.extend(node["op"])
+        parents.extend(node["zp"])
+        children.extend([node_idx] * (len(node["op"]) + len(node["zp"])))
 
-            for op in node['op']:
-                edges.append((f"{parent_pre}-{op}", node_name, resistance))
+    return np.array(parents, dtype=int), np.array(children, dtype=int)
 
-            for zp in node['zp']:
-                edges.append((f"{parent_pre}-{zp}", node_name, resistance))
 
-    # From penultimate layer to terminal node
-    for nidx, _ in enumerate(bdd[-1]):
-        edges.append((f"{len(bdd)}-{nidx}", terminal, 0))
-
-    g.add_weighted_edges_from(edges)
-
-    return g, root, terminal
+def get_min_resistance_nodes(layers, threshold=0.5, round_upto=1):
+    # Nodes of layers[1:] that lie on a minimum resistance path starting from a selected and connected
+    # node of layers[0]. The resistance of a path is the sum of the resistances of its nodes after the first.
+    # A forward pass computes the minimum resistance to reach every node, and a backward pass keeps the arcs
+    # that are tight on a minimum resistance path, so all tied paths are found without enumerating them.
+    dist = np.array([0 if np.round(node["pred"], round_upto) >= threshold and "conn" in node else np.inf
+                     for node in layers[0]])
+    dists, resistances, arcs = [dist], [None], [None]
+    for layer in layers[1:]:
+        parents, children = get_layer_arcs(layer)
+        resistance = get_layer_resistance(layer, threshold=threshold, round_upto=round_upto)
+        dist = np.full(len(layer), np.inf)
+        np.minimum.at(dist, children, dists[-1][parents])
+        dist += resistance
+
+        dists.append(dist)
+        resistances.append(resistance)
+        arcs.append((parents, children))
+
+    selected = [None] * len(layers)
+    on_path = np.zeros(len(dist), dtype=bool)
+    if len(dist) and np.isfinite(dist.min()):
+        on_path = dist == dist.min()
+    for i in range(len(layers) - 1, 0, -1):
+        selected[i] = np.flatnonzero(on_path)
+        parents, children = arcs[i]
+        tight = on_path[children] & (dists[i - 1][parents] + resistances[i][children] == dists[i][children])
+        on_path = np.zeros(len(layers[i - 1]), dtype=bool)
+        on_path[parents[tight]] = True
+
+    return selected
+
+
+def get_first_tight_arcs(heads, tight, n_heads):
+    # Index of the first tight arc of every head node, -1 if there is none
+    first = np.full(n_heads, -1)
+    heads, arc_idxs = np.unique(heads[tight], return_index=True)
+    first[heads] = np.flatnonzero(tight)[arc_idxs]
+
+    return first
+
+
+def get_resistance_labels(bdd, threshold=0.5, round_upto=1):
+    # Shortest path labels on the BDD DAG, where entering a node costs its resistance:
+    #   fwd[lidx][nidx]: minimum resistance from the root up to and including the node
+    #   bwd[lidx][nidx]: minimum resistance from the node (excluded) to the terminal
+    # together with the parent/child on one such path, from one forward and one backward sweep.
+    arcs = [get_layer_arcs(layer) for layer in bdd]
+    resistances = [get_layer_resistance(layer, threshold=threshold, round_upto=round_upto) for layer in bdd]
+
+    fwd, fwd_parent = [], []
+    prev_fwd = np.zeros(1)
+    for (parents, children), resistance in zip(arcs, resistances):
+        dist = np.full(len(resistance), np.inf)
+        np.minimum.at(dist, children, prev_fwd[parents])
+        tight = np.isfinite(dist[children]) & (prev_fwd[parents] == dist[children])
+        first = get_first_tight_arcs(children, tight, len(dist))
+        fwd.append(dist + resistance)
+        fwd_parent.append(np.where(first >= 0, parents[first], -1))
+        prev_fwd = fwd[-1]
+
+    bwd, bwd_child = [np.zeros(len(bdd[-1]))], [np.full(len(bdd[-1]), -1)]
+    for lidx in range(len(bdd) - 1, 0, -1):
+        parents, children = arcs[lidx]
+        cost = resistances[lidx][children] + bwd[0][children]
+        dist = np.full(len(bdd[lidx - 1]), np.inf)
+        np.minimum.at(dist, parents, cost)
+        tight = np.isfinite(dist[parents]) & (cost == dist[parents])
+        first = get_first_tight_arcs(parents, tight, len(dist))
+        bwd.insert(0, dist)
+        bwd_child.insert(0, np.where(first >= 0, children[first], -1))
+
+    return {"fwd": fwd, "fwd_parent": fwd_parent, "bwd": bwd, "bwd_child": bwd_child}
+
+
+def get_path_from_root(labels, lidx, nidx):
+    # (lidx, nidx) of the nodes on a shortest path from the root to the node, None if there is none
+    if not np.isfinite(labels["fwd"][lidx][nidx]):
+        return None
+
+    path = [(lidx, nidx)]
+    while lidx > 0:
+        nidx = int(labels["fwd_parent"][lidx][nidx])
+        lidx -= 1
+        path.append((lidx, nidx))
+
+    return path[::-1]
+
+
+def get_path_to_terminal(labels, lidx, nidx):
+    # (lidx, nidx) of the nodes on a shortest path from the node to the terminal, None if there is none
+    if not np.isfinite(labels["bwd"][lidx][nidx]):
+        return None
+
+    path = [(lidx, nidx)]
+    while lidx < len(labels["bwd"]) - 1:
+        nidx = int(labels["bwd_child"][lidx][nidx])
+        lidx += 1
+        path.append((lidx, nidx))
+
+    return path
 
 
 def switch_on_nodes_in_shortest_path(path, bdd, threshold, round_upto):
-    for node_name in enumerate(path):
-        lidx, nidx = list(map(int, node_name.split("-")))
-        if 0 < lidx < len(bdd) + 1:
-            lidx -= 1
-            node = bdd[lidx][nidx]
-            if np.round(node["pred"], round_upto) < threshold:
-                bdd[lidx][nidx] = switch_on_node(node, threshold)
-                bdd[lidx][nidx]["conn"] = True
+    for lidx, nidx in path:
+        node = bdd[lidx][nidx]
+        if np.round(node["pred"], round_upto) < threshold:
+            bdd[lidx][nidx] = switch_on_node(node, threshold)
+            bdd[lidx][nidx]["conn"] = True
     return bdd
 
 
@@ -233,20 +273,12 @@ def run_select_all(bdd, lidx, threshold=0.5, round_upto=1):
 def run_lookahead(bdd, lidx, lookahead, threshold=0.5, round_upto=1):
     time_stitching = time.time()
     layers = get_active_layers(bdd, lidx, lookahead)
-    paths = initialize_paths(layers[0],
-                             threshold=threshold,
-                             round_upto=round_upto)
-    for layer in layers[1:]:
-        paths = extend_paths(layer, paths)
-
-    resistances = [calculate_path_resistance(path, layers,
-                                             threshold=threshold,
-                                             round_upto=round_upto)
-                   for path in paths]
-    min_resistance_paths = get_paths_with_min_resistance(resistances, paths)
+    selected = get_min_resistance_nodes(layers,
+                                        threshold=threshold,
+                                        round_upto=round_upto)
     # Switch on the nodes in the minimum resistance paths
-    for path in min_resistance_paths:
-        for node_idx, layer in zip(path[1:], layers[1:]):
+    for layer, node_idxs in zip(layers[1:], selected[1:]):
+        for node_idx in node_idxs:
             node = layer[node_idx]
             node["conn"] = True
             node = switch_on_node(node, threshold)
@@ -259,9 +291,12 @@ def run_lookahead(bdd, lidx, lookahead, threshold=0.5, round_upto=1):
 def run_shortest_path(bdd, threshold=0.5, round_upto=1):
     time_stitching = time.time()
 
-    resistance_graph, root, terminal = generate_resistance_graph(bdd, threshold, round_upto)
-    sp = nx.shortest_path(resistance_graph, root, terminal)
-    bdd = switch_on_nodes_in_shortest_path(sp, bdd, threshold, round_upto)
+    labels = get_resistance_labels(bdd, threshold, round_upto)
+    # The terminal is entered at no cost from every node of the last layer
+    nidx = int(np.argmin(labels["fwd"][-1]))
+    sp = get_path_from_root(labels, len(bdd) - 1, nidx)
+    if sp is not None:
+        bdd = switch_on_nodes_in_shortest_path(sp, bdd, threshold, round_upto)
     time_stitching = time.time() - time_stitching
 
     return bdd, time_stitching
@@ -274,22 +309,24 @@ def run_shortest_path_up_down(bdd, lidx, threshold=0.5, round_upto=1):
         bdd, time_stitching = run_shortest_path(bdd, threshold=threshold, round_upto=round_upto)
         return bdd, time_stitching
 
-    resistance_graph, root, terminal = generate_resistance_graph(bdd, threshold, round_upto)
+    # All queries are answered from the labels of the BDD before stitching
+    labels = get_resistance_labels(bdd, threshold, round_upto)
+    paths = []
     # DOWN stitching
     # Turn on nodes in the shortest paths starting from connected node in the previous layer
     # to the terminal layer.
-    for nidx, node in bdd[lidx - 1]:
-        if node["conn"]:
-            start_node = f"{lidx}-{nidx}"
-            sp = nx.shortest_path(resistance_graph, start_node, terminal)
-            bdd = switch_on_nodes_in_shortest_path(sp, bdd, threshold, round_upto)
+    for nidx, node in enumerate(bdd[lidx - 1]):
+        if node.get("conn"):
+            paths.append(get_path_to_terminal(labels, lidx - 1, nidx))
     # UP Stitching
     # Turn on nodes in the shortest paths starting from the root to the high scoring nodes
     # in the current layer
-    for nidx, node in bdd[lidx]:
+    for nidx, node in enumerate(bdd[lidx]):
         if np.round(node["pred"], round_upto) >= threshold:
-            end_node = f"{lidx + 1}-{nidx}"
-            sp = nx.shortest_path(resistance_graph, root, end_node)
+            paths.append(get_path_from_root(labels, lidx, nidx))
+
+    for sp in paths:
+        if sp is not None:
             bdd = switch_on_nodes_in_shortest_path(sp, bdd, threshold, round_upto)
 
     time_stitching = time.time() - time_stitching
@@ -373,3 +410,30 @@ def stitch(problem, cfg, bdd, lidx, total_time_stitching):
 
     total_time_stitching += time_stitching
     return bdd, total_time_stitching, time_mip
+
+
+def stitch_disconnected_layers(problem, cfg, bdd, pid=None):
+    # Check connectedness of predicted Pareto BDD and perform stitching if necessary
+    was_disconnected, total_time_stitching, time_mip, count_stitching = False, 0, 0, 0
+    connectivity = BDDConnectivity(bdd, threshold=cfg.deploy.threshold, round_upto=cfg.deploy.round_upto)
+    from_layer = 0
+    while True:
+        lidx = connectivity.check(from_layer)
+        connectivity.write_conn(bdd, from_layer, lidx)
+        if lidx is None:
+            break
+
+        print(f"Disconnected {pid}, layer: ", lidx)
+        was_disconnected = True
+        count_stitching += 1
+        bdd, total_time_stitching, time_mip = stitch(problem,
+                                                     cfg,
+                                                     bdd,
+                                                     lidx,
+                                                     total_time_stitching)
+        # Stitching switches nodes on, so the check resumes below the stitched layer with its new flags
+        connectivity.set_conn(lidx, [bool(node.get("conn", False)) for node in bdd[lidx]])
+        connectivity.set_pred(read_pred(bdd, lidx + 1), from_layer=lidx + 1)
+        from_layer = lidx + 1
+
+    return bdd, was_disconnected, total_time_stitching, time_mip, count_stitching
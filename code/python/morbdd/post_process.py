@@ -1,7 +1,6 @@
 import copy
 import hashlib
 import json
-import multiprocessing as mp
 import zipfile
 
 import hydra
@@ -9,6 +8,8 @@ import numpy as np
 
 from morbdd import resource_path
 from morbdd.utils import get_xgb_model_name
+from morbdd.utils import intersect_fronts
+from morbdd.utils import run_pids
 
 
 def call_get_model_name(cfg):
@@ -90,22 +91,7 @@ def call_get_model_name(cfg):
 
 
 def find_ndps_in_preds(true_pf, pred_pf, i, mdl_hex):
-    z, z_pred = np.array(true_pf), np.array(pred_pf)
-    assert z.shape[1] == z_pred.shape[1]
-
-    # Defining a data type
-    rows, cols = z.shape
-    dt_z = {'names': ['f{}'.format(i) for i in range(cols)],
-            'formats': cols * [z.dtype]}
-
-    rows, cols = z_pred.shape
-    dt_z_pred = {'names': ['f{}'.format(i) for i in range(cols)],
-                 'formats': cols * [z_pred.dtype]}
-
-    # Finding intersection
-    found_ndps = np.intersect1d(z.view(dt_z), z_pred.view(dt_z_pred))
-
-    return found_ndps
+    return intersect_fronts(true_pf, pred_pf)
 
 
 def save_found_ndps(cfg, out_path, i, found_ndps):
@@ -191,11 +177,10 @@ def main(cfg):
     h.update(mdl_name.encode("utf-8"))
     mdl_hex = h.hexdigest()
 
-    # pool = mp.Pool(processes=cfg.nthread)
-    # results = [pool.apply_async(worker, args=(i, cfg, mdl_hex)) for i in range(cfg.deploy.from_pid, cfg.deploy.to_pid)]
-    # results = [r.get() for r in results]
-
-    worker(cfg.deploy.from_pid, cfg, mdl_hex)
+    run_pids(worker,
+             range(cfg.deploy.from_pid, cfg.deploy.to_pid),
+             args=(cfg, mdl_hex),
+             num_processes=cfg.nthread)
 
 
 if __name__ == '__main__':
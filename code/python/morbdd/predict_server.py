@@ -0,0 +1,244 @@
+import hashlib
+import json
+import queue
+import re
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import hydra
+import numpy as np
+import xgboost as xgb
+
+from morbdd.predict_xgb import call_get_model_name
+from morbdd.predict_xgb import convert_bdd_to_xgb_data_deploy
+from morbdd.predict_xgb import load_model
+from morbdd.utils import get_instance_data
+from morbdd.utils import get_static_order
+
+# Long-lived prediction service. Requests and responses are newline-delimited JSON objects:
+#   {"id": 1, "features": [[...], ...]}                         score a feature matrix
+#   {"id": 2, "bdd": [[{...}, ...], ...], "pid": 1097}          featurize a BDD of instance pid and score it
+#   {"id": 3, "bdd": ..., "inst_data": {...}, "mdl_hex": "..."} instance data and model given inline
+#   -> {"id": 1, "scores": [...], "time": ...} or {"id": 1, "error": "..."}
+# Concurrent requests for the same model are scored with one DMatrix.
+
+
+class ModelRegistry:
+    # Boosters kept in memory, keyed by the hex digest of the model name
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.models = {}
+        # One lock per model, so that loading a model does not block requests for the loaded ones
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, mdl_hex):
+        model = self.models.get(mdl_hex)
+        if model is not None:
+            return model
+
+        with self.lock:
+            model_lock = self.locks.setdefault(mdl_hex, threading.Lock())
+        with model_lock:
+            if mdl_hex not in self.models:
+                model = load_model(self.cfg, mdl_hex)
+                if model is None:
+                    with self.lock:
+                        self.locks.pop(mdl_hex, None)
+                    raise ValueError(f"Invalid model {mdl_hex}!")
+                self.models[mdl_hex] = model
+
+        return self.models[mdl_hex]
+
+
+class _Job:
+    def __init__(self, mdl_hex, features):
+        self.mdl_hex = mdl_hex
+        self.features = features
+        self.scores = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class PredictionBatcher:
+    # Collects jobs for up to batch_wait seconds (or max_batch_rows rows) and scores all jobs of a
+    # model with a single predict call
+    def __init__(self, registry, batch_wait=0.005, max_batch_rows=1000000):
+        self.registry = registry
+        self.batch_wait = batch_wait
+        self.max_batch_rows = max_batch_rows
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def predict(self, mdl_hex, features):
+        # Requests are validated before they join a batch, so that a malformed one only fails itself
+        model = self.registry.get(mdl_hex)
+        features = np.asarray(features, dtype=np.float32)
+        if features.ndim != 2 or features.shape[1] != model.num_features():
+            raise ValueError(f"Invalid features of shape {features.shape}, "
+                             f"expected (n, {model.num_features()}) for model {mdl_hex}!")
+        job = _Job(mdl_hex, features)
+        self.jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise ValueError(job.error)
+
+        return job.scores
+
+    def _collect(self):
+        batch = [self.jobs.get()]
+        n_rows = len(batch[0].features)
+        deadline = time.time() + self.batch_wait
+        while n_rows < self.max_batch_rows:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                job = self.jobs.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(job)
+            n_rows += len(job.features)
+
+        return batch
+
+    def _score(self, mdl_hex, jobs):
+        try:
+            model = self.registry.get(mdl_hex)
+            features = np.vstack([job.features for job in jobs])
+            scores = model.predict(xgb.DMatrix(features), iteration_range=(0, model.best_iteration + 1))
+        except Exception as e:
+            for job in jobs:
+                job.error = str(e)
+                job.done.set()
+            return
+
+        offset = 0
+        for job in jobs:
+            job.scores = scores[offset:offset + len(job.features)]
+            offset += len(job.features)
+            job.done.set()
+
+    def _loop(self):
+        while True:
+            jobs_per_model = {}
+            for job in self._collect():
+                jobs_per_model.setdefault(job.mdl_hex, []).append(job)
+            for mdl_hex, jobs in jobs_per_model.items():
+                self._score(mdl_hex, jobs)
+
+
+def get_request_features(cfg, request):
+    if "features" in request:
+        return np.asarray(request["features"], dtype=np.float32)
+
+    if "bdd" not in request:
+        raise ValueError("Invalid request, expected features or bdd!")
+    if "inst_data" in request:
+        inst_data = request["inst_data"]
+    elif "pid" in request:
+        inst_data = get_instance_data(cfg.prob.name,
+                                      request.get("size", cfg.prob.size),
+                                      request.get("split", cfg.deploy.split),
+                                      request["pid"])
+    else:
+        raise ValueError("Invalid request, expected inst_data or pid with a bdd!")
+    order = get_static_order(cfg.prob.name, cfg.deploy.order_type, inst_data)
+
+    return convert_bdd_to_xgb_data_deploy(cfg.prob.name,
+                                          bdd=request["bdd"],
+                                          inst_data=inst_data,
+                                          order=order,
+                                          state_norm_const=cfg.prob.state_norm_const,
+                                          layer_norm_const=cfg.prob.layer_norm_const)
+
+
+def handle_request(cfg, batcher, default_mdl_hex, line):
+    start = time.time()
+    request = {}
+    try:
+        request = json.loads(line)
+        mdl_hex = request.get("mdl_hex", default_mdl_hex)
+        # The digest names the model file, anything else is rejected before it reaches the registry
+        if not isinstance(mdl_hex, str) or re.fullmatch("[0-9a-f]{64}", mdl_hex) is None:
+            raise ValueError("Invalid mdl_hex, expected a 64-character hex digest!")
+        features = get_request_features(cfg, request)
+        scores = batcher.predict(mdl_hex, features)
+        response = {"id": request.get("id"), "scores": scores.tolist(), "time": time.time() - start}
+    except Exception as e:
+        response = {"id": request.get("id") if isinstance(request, dict) else None, "error": str(e)}
+
+    return json.dumps(response) + "\n"
+
+
+def serve_stdin(cfg, batcher, mdl_hex):
+    # Responses go to stdout, in completion order, so everything else is printed to stderr
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    lock = threading.Lock()
+
+    def respond(line):
+        response = handle_request(cfg, batcher, mdl_hex, line)
+        with lock:
+            out.write(response)
+            out.flush()
+
+    with ThreadPoolExecutor(max_workers=cfg.server.num_threads) as pool:
+        for line in sys.stdin:
+            if line.strip():
+                pool.submit(respond, line)
+
+
+def serve_socket(cfg, batcher, mdl_hex):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if line.strip():
+                    self.wfile.write(handle_request(cfg, batcher, mdl_hex, line).encode("utf-8"))
+                    self.wfile.flush()
+
+    if cfg.server.transport == "unix":
+        path = Path(cfg.server.socket_path)
+        path.unlink(missing_ok=True)
+        server = socketserver.ThreadingUnixStreamServer(str(path), Handler)
+        print(f"Listening on {path}")
+    else:
+        server = socketserver.ThreadingTCPServer((cfg.server.host, cfg.server.port), Handler)
+        print(f"Listening on {cfg.server.host}:{cfg.server.port}")
+    server.daemon_threads = True
+
+    with server:
+        server.serve_forever()
+
+
+@hydra.main(version_base="1.2", config_path="./configs", config_name="deploy.yaml")
+def main(cfg):
+    mdl_name = call_get_model_name(cfg)
+    # Convert to hex
+    h = hashlib.blake2s(digest_size=32)
+    h.update(mdl_name.encode("utf-8"))
+    mdl_hex = h.hexdigest()
+    print(f"Using model: {mdl_hex}", file=sys.stderr)
+
+    registry = ModelRegistry(cfg)
+    # Load the default model upfront, other models are loaded on their first request
+    registry.get(mdl_hex)
+    batcher = PredictionBatcher(registry,
+                                batch_wait=cfg.server.batch_wait,
+                                max_batch_rows=cfg.server.max_batch_rows)
+
+    if cfg.server.transport == "stdin":
+        serve_stdin(cfg, batcher, mdl_hex)
+    elif cfg.server.transport in ("unix", "tcp"):
+        serve_socket(cfg, batcher, mdl_hex)
+    else:
+        raise ValueError("Invalid server transport!")
+
+
+if __name__ == '__main__':
+    main()
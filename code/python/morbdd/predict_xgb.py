@@ -1,19 +1,25 @@
 import hashlib
 import json
-import multiprocessing as mp
 
 import hydra
 import numpy as np
 import xgboost as xgb
 
 from morbdd import resource_path
+from morbdd.utils import ColumnarBDD
 from morbdd.utils import FeaturizerConfig
-from morbdd.utils import extract_node_features
+from morbdd.utils import get_cached_features
+from morbdd.utils import get_columnar_bdd_path
 from morbdd.utils import get_featurizer
 from morbdd.utils import get_instance_data
+from morbdd.utils import get_results
 from morbdd.utils import get_static_order
+from morbdd.utils import get_xgb_features
 from morbdd.utils import get_xgb_model_name
+from morbdd.utils import load_columnar_bdd
 from morbdd.utils import read_from_zip
+from morbdd.utils import run_pids
+from morbdd.utils import save_columnar_bdd
 import time
 import pandas as pd
 
@@ -71,47 +77,26 @@ def convert_bdd_to_xgb_data_deploy(problem,
         # Extract instance and variable features
         featurizer_conf = FeaturizerConfig()
         featurizer = get_featurizer(problem, featurizer_conf)
-        features = featurizer.get(inst_data)
+        features = get_cached_features(problem, featurizer, inst_data)
         # Instance features
         inst_features = features["inst"][0]
         # Variable features. Reordered features based on ordering
         var_features = features["var"][order]
-        num_var_features = var_features.shape[1]
-
-        features_lst = []
-        for lidx, layer in enumerate(bdd):
-            # Parent variable features
-            _parent_var_feat = -1 * np.ones(num_var_features) \
-                if lidx == 0 \
-                else var_features[lidx - 1]
-            _var_feat = var_features[lidx]
-
-            prev_layer = bdd[lidx - 1]
-            for node in layer:
-                _node_feat, _parent_node_feat = extract_node_features("knapsack",
-                                                                      lidx,
-                                                                      node,
-                                                                      prev_layer,
-                                                                      inst_data,
-                                                                      layer_norm_const=layer_norm_const,
-                                                                      state_norm_const=state_norm_const)
-
-                # Features
-                features_lst.append(np.concatenate((inst_features,
-                                                    _parent_var_feat,
-                                                    _parent_node_feat,
-                                                    _var_feat,
-                                                    _node_feat)))
-                # labels_lst.append(node["l"])
-
-        return features_lst
+
+        return get_xgb_features(problem,
+                                bdd,
+                                inst_features,
+                                var_features,
+                                inst_data,
+                                layer_norm_const=layer_norm_const,
+                                state_norm_const=state_norm_const)
 
     features = None
     if problem == "knapsack":
         features = convert_bdd_to_xgb_data_deploy_knapsack()
 
     assert features is not None
-    return np.array(features)
+    return features
 
 
 def load_model(cfg, mdl_hex):
@@ -137,6 +122,10 @@ def load_model(cfg, mdl_hex):
 
 
 def set_prediction_score_on_node(bdd, preds):
+    if isinstance(bdd, ColumnarBDD):
+        bdd.pred = np.asarray(preds, dtype=np.float64)
+        return bdd
+
     it = 0
     for lidx, layer in enumerate(bdd):
         for node in layer:
@@ -146,9 +135,24 @@ def set_prediction_score_on_node(bdd, preds):
     return bdd
 
 
+def load_bdd(problem, size, split, pid, bdd_format="json"):
+    if bdd_format == "columnar":
+        file_path = get_columnar_bdd_path(problem, size, split, pid)
+        return load_columnar_bdd(file_path) if file_path.exists() else None
+
+    archive = resource_path / f"bdds/{problem}/{size}.zip"
+    file = f"{size}/{split}/{pid}.json"
+
+    return read_from_zip(archive, file, format="json")
+
+
 def save_bdd(problem, size, split, pid, bdd, mdl_hex):
     pred_bdd_path = resource_path / f"predictions/xgb/{problem}/{size}/{split}/{mdl_hex}/pred_bdd"
     pred_bdd_path.mkdir(parents=True, exist_ok=True)
+    if isinstance(bdd, ColumnarBDD):
+        save_columnar_bdd(pred_bdd_path / f"{pid}.cbdd", bdd)
+        return
+
     pred_bdd_path = pred_bdd_path / f"{pid}.json"
     with open(pred_bdd_path, "w") as fp:
         json.dump(bdd, fp)
@@ -160,48 +164,46 @@ def save_time_result(r, problem, size, split, mdl_hex):
     df.to_csv(resource_path / f"predictions/xgb/{problem}/{size}/{split}/{mdl_hex}/time_pred_result.csv", index=False)
 
 
-def worker(rank, cfg, mdl_hex):
-    model = load_model(cfg, mdl_hex)
-    time_result = []
-    for pid in range(cfg.deploy.from_pid + rank, cfg.deploy.to_pid, cfg.deploy.num_processes):
-        # Read instance
-        inst_data = get_instance_data(cfg.prob.name, cfg.prob.size, cfg.deploy.split, pid)
-        order = get_static_order(cfg.prob.name, cfg.deploy.order_type, inst_data)
+def init_worker(cfg, mdl_hex):
+    return {"model": load_model(cfg, mdl_hex)}
+
+
+def worker(pid, cfg, mdl_hex, model):
+    # Read instance
+    inst_data = get_instance_data(cfg.prob.name, cfg.prob.size, cfg.deploy.split, pid)
+    order = get_static_order(cfg.prob.name, cfg.deploy.order_type, inst_data)
 
-        # Load BDD
-        archive = resource_path / f"bdds/{cfg.prob.name}/{cfg.prob.size}.zip"
-        file = f"{cfg.prob.size}/{cfg.deploy.split}/{pid}.json"
-        bdd = read_from_zip(archive, file, format="json")
-        if bdd is None:
-            continue
+    # Load BDD
+    bdd = load_bdd(cfg.prob.name, cfg.prob.size, cfg.deploy.split, pid, bdd_format=cfg.deploy.bdd_format)
+    if bdd is None:
+        return None
 
-        # Get BDD data
-        time_featurize = time.time()
-        features = convert_bdd_to_xgb_data_deploy(cfg.prob.name,
-                                                  bdd=bdd,
-                                                  inst_data=inst_data,
-                                                  order=order,
-                                                  state_norm_const=cfg.prob.state_norm_const,
-                                                  layer_norm_const=cfg.prob.layer_norm_const)
+    # Get BDD data
+    time_featurize = time.time()
+    features = convert_bdd_to_xgb_data_deploy(cfg.prob.name,
+                                              bdd=bdd,
+                                              inst_data=inst_data,
+                                              order=order,
+                                              state_norm_const=cfg.prob.state_norm_const,
+                                              layer_norm_const=cfg.prob.layer_norm_const)
 
-        # Predict
-        dfeatures = xgb.DMatrix(features)
-        time_featurize = time.time() - time_featurize
+    # Predict
+    dfeatures = xgb.DMatrix(features)
+    time_featurize = time.time() - time_featurize
 
-        time_prediction = time.time()
-        preds = model.predict(dfeatures, iteration_range=(0, model.best_iteration + 1))
-        time_prediction = time.time() - time_prediction
+    time_prediction = time.time()
+    preds = model.predict(dfeatures, iteration_range=(0, model.best_iteration + 1))
+    time_prediction = time.time() - time_prediction
 
-        time_set_score = time.time()
-        bdd = set_prediction_score_on_node(bdd, preds)
-        time_set_score = time.time() - time_set_score
+    time_set_score = time.time()
+    bdd = set_prediction_score_on_node(bdd, preds)
+    time_set_score = time.time() - time_set_score
 
-        save_bdd(cfg.prob.name, cfg.prob.size, cfg.deploy.split, pid, bdd, mdl_hex)
-        print("Processed: ", pid)
-        time_result.append([cfg.prob.size, cfg.deploy.split, pid, cfg.deploy.order_type,
-                            time_featurize, time_prediction, time_set_score])
+    save_bdd(cfg.prob.name, cfg.prob.size, cfg.deploy.split, pid, bdd, mdl_hex)
+    print("Processed: ", pid)
 
-    return time_result
+    return [cfg.prob.size, cfg.deploy.split, pid, cfg.deploy.order_type,
+            time_featurize, time_prediction, time_set_score]
 
 
 @hydra.main(version_base="1.2", config_path="./configs", config_name="deploy.yaml")
@@ -214,18 +216,15 @@ def main(cfg):
     print(f"Using model: {mdl_hex}")
 
     # Deploy model
-    # pool = mp.Pool(processes=cfg.deploy.num_processes)
-    # results = []
-    # for rank in range(cfg.deploy.num_processes):
-    #     results.append(pool.apply_async(worker, args=(rank, cfg, mdl_hex)))
-    #
-    # # Fetch results
-    # results = [r.get() for r in results]
-    # r = []
-    # for result in results:
-    #     r.extend(result)
-
-    r = worker(0, cfg, mdl_hex)
+    results = run_pids(worker,
+                       range(cfg.deploy.from_pid, cfg.deploy.to_pid),
+                       args=(cfg, mdl_hex),
+                       num_processes=cfg.deploy.num_processes,
+                       init_fn=init_worker,
+                       backend=cfg.deploy.backend)
+
+    # Fetch results
+    r = get_results(results)
     save_time_result(r, cfg.prob.name, cfg.prob.size, cfg.deploy.split, mdl_hex)
 
 
@@ -9,6 +9,7 @@ import xgboost as xgb
 from morbdd import resource_path
 from morbdd.utils import FeaturizerConfig
 from morbdd.utils import extract_node_features
+from morbdd.utils import get_cached_features
 from morbdd.utils import get_featurizer
 from morbdd.utils import get_instance_data
 from morbdd.utils import get_static_order
@@ -185,7 +186,7 @@ def convert_bdd_to_xgb_data_deploy(problem,
         # Extract instance and variable features
         featurizer_conf = FeaturizerConfig()
         featurizer = get_featurizer(problem, featurizer_conf)
-        features = featurizer.get(inst_data)
+        features = get_cached_features(problem, featurizer, inst_data)
         # Instance features
         inst_features = features["inst"][0]
         # Variable features. Reordered features based on ordering
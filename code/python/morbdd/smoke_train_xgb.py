@@ -0,0 +1,83 @@
+import tempfile
+
+import numpy as np
+import xgboost as xgb
+from omegaconf import OmegaConf
+
+from morbdd.train_xgb import get_cache_prefix
+from morbdd.train_xgb import get_dmatrix
+
+# Smoke run of every dmatrix.type of train_xgb on random data: builds the train and val matrices from an
+# iterator created with the cache prefix train_xgb would use, and trains a few rounds on them.
+#   python -m morbdd.smoke_train_xgb
+DMATRIX_TYPES = ["DMatrix", "QuantileDMatrix", "ExtMemQuantileDMatrix"]
+
+
+class ArrayIterator(xgb.DataIter):
+    def __init__(self, batches, cache_prefix=None):
+        self.batches = batches
+        self._it = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self._it == len(self.batches):
+            return 0
+
+        x, y, wt = self.batches[self._it]
+        input_data(data=x, label=y, weight=wt)
+        self._it += 1
+
+        return 1
+
+    def reset(self):
+        self._it = 0
+
+
+def get_batches(rng, n_batches=4, n_rows=256, n_features=8):
+    batches = []
+    for _ in range(n_batches):
+        x = rng.random((n_rows, n_features), dtype=np.float32)
+        y = (x[:, 0] + 0.1 * rng.random(n_rows) > 0.5).astype(np.float32)
+        batches.append((x, y, np.ones(n_rows, dtype=np.float32)))
+
+    return batches
+
+
+def smoke_run(dmatrix_type, cache_dir, num_round=5):
+    cfg = OmegaConf.create({"prob": {"name": "knapsack", "size": "smoke"},
+                            "dmatrix": {"type": dmatrix_type, "max_bin": 32, "cache_dir": cache_dir}})
+    rng = np.random.default_rng(0)
+    dtrain = get_dmatrix(cfg, ArrayIterator(get_batches(rng), cache_prefix=get_cache_prefix(cfg, "train")))
+    dval = get_dmatrix(cfg, ArrayIterator(get_batches(rng), cache_prefix=get_cache_prefix(cfg, "val")), ref=dtrain)
+
+    param = {"max_depth": 3, "objective": "binary:logistic", "eval_metric": "logloss", "nthread": 2}
+    if dmatrix_type != "DMatrix":
+        param.update({"tree_method": "hist", "max_bin": cfg.dmatrix.max_bin})
+    evals_result = {}
+    bst = xgb.train(param, dtrain, num_boost_round=num_round, evals=[(dval, "val")], evals_result=evals_result,
+                    verbose_eval=False)
+    assert bst.num_boosted_rounds() == num_round
+
+    return dtrain.num_row(), evals_result["val"]["logloss"][-1]
+
+
+def main():
+    failed = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for dmatrix_type in DMATRIX_TYPES:
+            if not hasattr(xgb, dmatrix_type):
+                print(f"{dmatrix_type}: skipped, not available in xgboost {xgb.__version__}")
+                continue
+            try:
+                num_rows, logloss = smoke_run(dmatrix_type, cache_dir)
+                print(f"{dmatrix_type}: ok, {num_rows} rows, val logloss {logloss:.4f}")
+            except Exception as e:
+                print(f"{dmatrix_type}: failed, {e}")
+                failed.append(dmatrix_type)
+
+    if len(failed):
+        raise SystemExit(f"Smoke run failed for {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,15 @@
 import datetime
 import hashlib
-import io
 import json
+import multiprocessing as mp
 import os
+import resource
+import time
 import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 
 import hydra
 import numpy as np
@@ -11,6 +17,11 @@ import xgboost as xgb
 from omegaconf import OmegaConf
 
 from morbdd import resource_path
+from morbdd.utils import ShardStore
+from morbdd.utils import get_shard_store_path
+from morbdd.utils import get_weights_type
+from morbdd.utils import get_xgb_data_loader
+from morbdd.utils import get_xgb_indexed_data_path
 
 
 def get_xgb_model_name(max_depth=None,
@@ -139,7 +150,7 @@ def get_xgb_model_name(max_depth=None,
 
 class Iterator(xgb.DataIter):
     def __init__(self, problem, size, split, neg_pos_ratio, min_samples, sampling_type, weights_type, labels_type,
-                 names):
+                 names, data_format="zip", cache_prefix=os.path.join(".", "cache")):
         self.problem = problem
         self.size = size
         self.split = split
@@ -149,16 +160,13 @@ class Iterator(xgb.DataIter):
         self.weights_type = weights_type
         self.labels_type = labels_type
         self.names = names
-
-        self.zf_sampling_type = zipfile.ZipFile(
-            resource_path / f"xgb_data/{self.problem}/{self.size}/{self.split}/{sampling_type}.zip")
-        self.zf_labels_type = zipfile.ZipFile(
-            resource_path / f"xgb_data/{self.problem}/{self.size}/{self.split}/labels/{labels_type}.zip")
+        self.data_format = data_format
+        self.load = get_xgb_data_loader(problem, size, split, sampling_type, weights_type, labels_type,
+                                        data_format=data_format)
 
         self._it = 0
-        # XGBoost will generate some cache files under current directory with the prefix
-        # "cache"
-        super().__init__(cache_prefix=os.path.join(".", "cache"))
+        # XGBoost will generate some cache files with the prefix cache_prefix when the data is paged to disk
+        super().__init__(cache_prefix=cache_prefix)
 
     def next(self, input_data):
         """Advance the iterator by 1 step and pass the data to XGBoost.  This function is
@@ -172,17 +180,7 @@ class Iterator(xgb.DataIter):
         # input_data is a function passed in by XGBoost who has the exact same signature of
         # ``DMatrix``
         _name = self.names[self._it]
-        with self.zf_sampling_type.open(f"{self.sampling_type}/{_name}", "r") as fp:
-            data = io.BytesIO(fp.read())
-            x = np.load(data)
-
-        with self.zf_sampling_type.open(f"{self.sampling_type}/{self.weights_type}/{_name}", "r") as fp:
-            data = io.BytesIO(fp.read())
-            wt = np.load(data)
-
-        with self.zf_labels_type.open(f"{self.labels_type}/{_name}", "r") as fp:
-            data = io.BytesIO(fp.read())
-            y = np.load(data)
+        x, y, wt = self.load(_name.split(".")[0])
 
         input_data(data=x, label=y, weight=wt)
         self._it += 1
@@ -194,12 +192,151 @@ class Iterator(xgb.DataIter):
         self._it = 0
 
 
+class ShardIterator(xgb.DataIter):
+    # Feeds the shards of a ShardStore to XGBoost, one batch per shard. Batches are views of the memory-mapped
+    # columns, restricted to the rows of the pids in [from_pid, to_pid).
+    def __init__(self, store, from_pid=None, to_pid=None, cache_prefix=os.path.join(".", "cache")):
+        self.store = store
+        self.from_pid = from_pid
+        self.to_pid = to_pid
+        self.shards = store.get_shards(from_pid, to_pid)
+
+        self._it = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self._it == len(self.shards):
+            return 0
+
+        shard = self.shards[self._it]
+        columns = self.store.load_shard(shard)
+        start, stop = self.store.get_shard_rows(shard, self.from_pid, self.to_pid)
+        input_data(data=columns["x"][start:stop], label=columns["y"][start:stop], weight=columns["w"][start:stop])
+        self._it += 1
+
+        return 1
+
+    def reset(self):
+        self._it = 0
+
+
+# Loaders of the worker processes of PrefetchIterator, keyed by their get_xgb_data_loader arguments
+_loaders = {}
+
+
+def load_batch(loader_args, pids):
+    # Features, labels and weights of the given pids concatenated in order, None if none of them exist
+    if loader_args not in _loaders:
+        _loaders[loader_args] = get_xgb_data_loader(*loader_args[:-1], data_format=loader_args[-1])
+    load = _loaders[loader_args]
+
+    data = [d for d in map(load, pids) if d is not None]
+    if len(data) == 0:
+        return None
+
+    return tuple(np.concatenate(column) for column in zip(*data))
+
+
+class PrefetchIterator(xgb.DataIter):
+    # Reads batches of batch_size instances on a pool of num_workers threads or processes, up to read_ahead
+    # batches ahead of the one XGBoost consumes. Batches are always passed in pid order, and at most
+    # read_ahead + 1 batches are held in memory. Worker processes are spawned, as next() is called back from
+    # XGBoost while its OpenMP threads run and forking there can deadlock.
+    def __init__(self, problem, size, split, sampling_type, weights_type, labels_type, pids, data_format="zip",
+                 num_workers=1, backend="thread", batch_size=8, read_ahead=2, cache_prefix=os.path.join(".", "cache")):
+        self.loader_args = (problem, size, split, sampling_type, weights_type, labels_type, data_format)
+        self.batches = [list(pids[i:i + batch_size]) for i in range(0, len(pids), batch_size)]
+        self.read_ahead = max(1, read_ahead)
+        if backend == "thread":
+            self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        elif backend == "process":
+            self.pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=mp.get_context("spawn"))
+        else:
+            raise ValueError("Invalid prefetch backend!")
+
+        self.futures = deque()
+        self._it = 0
+        self._submitted = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def _fill(self):
+        while self._submitted < len(self.batches) and len(self.futures) < self.read_ahead:
+            self.futures.append(self.pool.submit(load_batch, self.loader_args, self.batches[self._submitted]))
+            self._submitted += 1
+
+    def next(self, input_data):
+        while self._it < len(self.batches):
+            self._fill()
+            data = self.futures.popleft().result()
+            self._it += 1
+            if data is not None:
+                x, y, wt = data
+                input_data(data=x, label=y, weight=wt)
+                # Start reading the next batch before XGBoost consumes this one
+                self._fill()
+                return 1
+
+        return 0
+
+    def reset(self):
+        for future in self.futures:
+            future.cancel()
+        # Reads already running are waited for, so that their batches are freed before the next pass
+        wait(self.futures)
+        self.futures.clear()
+        self._it = 0
+        self._submitted = 0
+
+    def close(self):
+        self.reset()
+        self.pool.shutdown(wait=True)
+
+
+def get_cache_prefix(cfg, split):
+    # Prefix of the external memory cache files of a split, relative cache dirs are below resource_path.
+    # QuantileDMatrix keeps its data in memory and rejects iterators with a cache prefix.
+    if cfg.dmatrix.type == "QuantileDMatrix":
+        return None
+
+    cache_dir = resource_path / cfg.dmatrix.cache_dir / f"{cfg.prob.name}/{cfg.prob.size}/{split}"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    return str(cache_dir / "cache")
+
+
 def get_iterator(cfg, sampling_type, weights_type, label_type, split):
+    cache_prefix = get_cache_prefix(cfg, split)
+    if cfg.data_format == "shards":
+        store = ShardStore(get_shard_store_path(cfg.prob.name, cfg.prob.size, split, sampling_type, weights_type,
+                                                label_type))
+        it = ShardIterator(store, cfg[split].from_pid, cfg[split].to_pid, cache_prefix=cache_prefix)
+        print("Iterator on ", split, ": shards - ", len(it.shards))
+        return it
+
     valid_names = [f"{i}.npy" for i in range(cfg[split].from_pid, cfg[split].to_pid)]
 
-    zf_path = zipfile.Path(resource_path / f"xgb_data/knapsack/{cfg.prob.size}/{split}/{sampling_type}.zip")
-    filenames = [p.name for p in zf_path.joinpath(f'{sampling_type}').iterdir() if p.name in valid_names]
+    if cfg.data_format == "indexed":
+        path = get_xgb_indexed_data_path(cfg.prob.name, cfg.prob.size, split) / sampling_type
+        filenames = [name for name in valid_names if path.joinpath(name).exists()]
+    else:
+        zf_path = zipfile.Path(resource_path / f"xgb_data/knapsack/{cfg.prob.size}/{split}/{sampling_type}.zip")
+        filenames = [p.name for p in zf_path.joinpath(f'{sampling_type}').iterdir() if p.name in valid_names]
     print("Iterator on ", split, ": len - ", len(filenames))
+    if cfg.prefetch.num_workers > 0:
+        return PrefetchIterator(cfg.prob.name,
+                                cfg.prob.size,
+                                split,
+                                sampling_type,
+                                weights_type,
+                                label_type,
+                                [name.split(".")[0] for name in filenames],
+                                data_format=cfg.data_format,
+                                num_workers=cfg.prefetch.num_workers,
+                                backend=cfg.prefetch.backend,
+                                batch_size=cfg.prefetch.batch_size,
+                                read_ahead=cfg.prefetch.read_ahead,
+                                cache_prefix=cache_prefix)
+
     it = Iterator(cfg.prob.name,
                   cfg.prob.size,
                   split,
@@ -208,33 +345,61 @@ def get_iterator(cfg, sampling_type, weights_type, label_type, split):
                   sampling_type,
                   weights_type,
                   label_type,
-                  filenames)
+                  filenames,
+                  data_format=cfg.data_format,
+                  cache_prefix=cache_prefix)
 
     return it
 
 
+def get_dmatrix(cfg, it, ref=None):
+    # ref: Training matrix whose quantiles are reused for the validation matrix
+    if cfg.dmatrix.type == "DMatrix":
+        return xgb.DMatrix(it)
+    elif cfg.dmatrix.type == "QuantileDMatrix":
+        return xgb.QuantileDMatrix(it, ref=ref, max_bin=cfg.dmatrix.max_bin)
+    elif cfg.dmatrix.type == "ExtMemQuantileDMatrix":
+        if not hasattr(xgb, "ExtMemQuantileDMatrix"):
+            raise ValueError("ExtMemQuantileDMatrix requires xgboost >= 3.0!")
+        return xgb.ExtMemQuantileDMatrix(it, ref=ref, max_bin=cfg.dmatrix.max_bin)
+    else:
+        raise ValueError("Invalid DMatrix type!")
+
+
+def get_split_dmatrix(cfg, split, ref=None):
+    sampling_type = f"npr{cfg[split].neg_pos_ratio}ms{cfg[split].min_samples}"
+    weights_type = get_weights_type(cfg[split].flag_layer_penalty,
+                                    cfg[split].layer_penalty,
+                                    cfg[split].flag_imbalance_penalty,
+                                    cfg[split].flag_importance_penalty,
+                                    cfg[split].penalty_aggregation)
+    it = get_iterator(cfg, sampling_type, weights_type, cfg.label, split)
+    try:
+        return get_dmatrix(cfg, it, ref=ref)
+    finally:
+        # The matrices keep their own copy or cache of the data, the read-ahead pool is no longer needed
+        if isinstance(it, PrefetchIterator):
+            it.close()
+
+
+def get_peak_memory():
+    # Peak resident memory of this process in MB (ru_maxrss is in KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
 @hydra.main(version_base="1.2", config_path="./configs", config_name="train_xgb.yaml")
 def main(cfg):
-    sampling_type = f"npr{cfg.train.neg_pos_ratio}ms{cfg.train.min_samples}"
-    weights_type = ""
-    if cfg.train.flag_layer_penalty:
-        weights_type += f"{cfg.train.layer_penalty}-"
-    weights_type += "1-" if cfg.train.flag_imbalance_penalty else "0-"
-    weights_type += "1-" if cfg.train.flag_importance_penalty else "0-"
-    weights_type += cfg.train.penalty_aggregation
-    dtrain = xgb.DMatrix(get_iterator(cfg, sampling_type, weights_type, cfg.label, "train"))
-
-    sampling_type = f"npr{cfg.val.neg_pos_ratio}ms{cfg.val.min_samples}"
-    weights_type = ""
-    if cfg.val.flag_layer_penalty:
-        weights_type += f"{cfg.val.layer_penalty}-"
-    weights_type += "1-" if cfg.val.flag_imbalance_penalty else "0-"
-    weights_type += "1-" if cfg.val.flag_importance_penalty else "0-"
-    weights_type += cfg.val.penalty_aggregation
-    dval = xgb.DMatrix(get_iterator(cfg, sampling_type, weights_type, cfg.label, "val"))
+    start = time.time()
+    dtrain = get_split_dmatrix(cfg, "train")
+    dval = get_split_dmatrix(cfg, "val", ref=dtrain)
+    time_dmatrix = time.time() - start
+    memory_dmatrix = get_peak_memory()
 
+    num_rows = dtrain.num_row() + dval.num_row()
     print("Number of training samples: ", dtrain.num_row())
     print("Number of validation samples: ", dval.num_row())
+    print(f"Built {cfg.dmatrix.type} in {time_dmatrix:.2f}s ({num_rows / max(time_dmatrix, 1e-9):.0f} rows/s), "
+          f"peak memory {memory_dmatrix:.0f} MB")
     print("Setting up training...")
     evals_result = {}
     evals = []
@@ -254,13 +419,23 @@ def main(cfg):
              "eval_metric": list(cfg.eval_metric),
              "nthread": cfg.nthread,
              "seed": cfg.seed}
+    if cfg.dmatrix.type != "DMatrix":
+        # Quantized matrices only work with the hist method and the bins they were built with
+        param.update({"tree_method": "hist", "max_bin": cfg.dmatrix.max_bin})
 
     print("Started training...")
+    start = time.time()
     bst = xgb.train(param, dtrain,
                     num_boost_round=cfg.num_round,
                     evals=evals,
                     early_stopping_rounds=cfg.early_stopping_rounds,
                     evals_result=evals_result)
+    time_train = time.time() - start
+    memory_train = get_peak_memory()
+    num_rounds = bst.num_boosted_rounds()
+    print(f"Trained {num_rounds} rounds in {time_train:.2f}s "
+          f"({dtrain.num_row() * num_rounds / max(time_train, 1e-9):.0f} row-rounds/s), "
+          f"peak memory {memory_train:.0f} MB")
 
     # Get model name
     mdl_path = resource_path / f"pretrained/xgb/{cfg.prob.name}/{cfg.prob.size}"
@@ -320,7 +495,13 @@ def main(cfg):
     summary_obj = {"timestamp": str(datetime.datetime.now()),
                    "mdl_hex": hex,
                    "best_iteration": bst.best_iteration,
-                   "eval_metric": list(cfg.eval_metric)[-1]}
+                   "eval_metric": list(cfg.eval_metric)[-1],
+                   "dmatrix": cfg.dmatrix.type,
+                   "num_train_rows": dtrain.num_row(),
+                   "time_dmatrix": time_dmatrix,
+                   "time_train": time_train,
+                   "peak_memory_dmatrix_mb": memory_dmatrix,
+                   "peak_memory_train_mb": memory_train}
     summary_obj.update({em: evals_result["train"][em][bst.best_iteration] for em in cfg.eval_metric})
     summary_obj.update({em: evals_result["val"][em][bst.best_iteration] for em in cfg.eval_metric})
 
@@ -137,7 +137,8 @@ def get_xgb_mixed_model_name(max_depth=None,
 class Iterator(xgb.DataIter):
     def __init__(self, problem, dataset_type, split, neg_pos_ratio, min_samples, sampling_type, weights_type,
                  labels_type,
-                 names):
+                 names,
+                 cache_prefix=os.path.join(".", "cache")):
         self.problem = problem
         self.dataset_type = dataset_type
         self.split = split
@@ -154,9 +155,8 @@ class Iterator(xgb.DataIter):
             resource_path / f"xgb_data/{self.problem}/{self.dataset_type}/{self.split}/labels/{labels_type}.zip")
 
         self._it = 0
-        # XGBoost will generate some cache files under current directory with the prefix
-        # "cache"
-        super().__init__(cache_prefix=os.path.join(".", "cache"))
+        # XGBoost will generate some cache files with the prefix cache_prefix when the data is paged to disk
+        super().__init__(cache_prefix=cache_prefix)
 
     def next(self, input_data):
         """Advance the iterator by 1 step and pass the data to XGBoost.  This function is
@@ -198,6 +198,8 @@ def get_iterator(cfg, sampling_type, weights_type, label_type, split):
     zf_path = zipfile.Path(resource_path / f"xgb_data/knapsack/{dataset_type}/{split}/{sampling_type}.zip")
     filenames = [p.name for p in zf_path.joinpath(f'{sampling_type}').iterdir() if p.name in valid_names]
     print("Iterator on ", split, ": len - ", len(filenames))
+    cache_dir = resource_path / cfg.dmatrix.cache_dir / f"{cfg.prob.name}/{dataset_type}/{split}"
+    cache_dir.mkdir(parents=True, exist_ok=True)
     it = Iterator(cfg.prob.name,
                   "mixed",
                   split,
@@ -206,7 +208,8 @@ def get_iterator(cfg, sampling_type, weights_type, label_type, split):
                   sampling_type,
                   weights_type,
                   label_type,
-                  filenames)
+                  filenames,
+                  cache_prefix=str(cache_dir / "cache"))
 
     return it
 
@@ -8,6 +8,32 @@ import torch
 from torch.utils.data import Dataset, DataLoader
 
 from morbdd import resource_path
+from morbdd.utils.bdd_store import ColumnarBDD
+from morbdd.utils.bdd_store import bdd_to_columnar
+from morbdd.utils.bdd_store import get_columnar_bdd_path
+from morbdd.utils.bdd_store import load_columnar_bdd
+from morbdd.utils.bdd_store import save_columnar_bdd
+from morbdd.utils.executor import STATUS_OK
+from morbdd.utils.executor import get_failed
+from morbdd.utils.executor import get_results
+from morbdd.utils.executor import run_pids
+from morbdd.utils.executor import start_time_budget
+from morbdd.utils.executor import stop_time_budget
+from morbdd.utils.feature_cache import clear_feature_cache
+from morbdd.utils.feature_cache import get_cached_features
+from morbdd.utils.hypervolume import get_front_norm
+from morbdd.utils.hypervolume import get_nondominated
+from morbdd.utils.hypervolume import hypervolume
+from morbdd.utils.hypervolume import normalize_front
+from morbdd.utils.pareto_set import as_front
+from morbdd.utils.pareto_set import count_common
+from morbdd.utils.pareto_set import count_dominated
+from morbdd.utils.pareto_set import coverage
+from morbdd.utils.pareto_set import difference_fronts
+from morbdd.utils.pareto_set import intersect_fronts
+from morbdd.utils.shard_store import ShardStore
+from morbdd.utils.shard_store import ShardWriter
+from morbdd.utils.shard_store import get_shard_store_path
 import hashlib
 
 ZERO_ARC = -1
@@ -68,10 +94,30 @@ def read_from_zip(archive, file, format="raw"):
             data = json.load(raw_data)
         elif format == "npz":
             data = np.load(io.BytesIO(raw_data.read()))
+        elif format == "cbdd":
+            data = load_columnar_bdd(raw_data.read())
 
     return data
 
 
+def pack_bitsets(bits):
+    # Pack the rows of a 0/1 matrix into little-endian uint64 words, bit i of a row
+    # goes to bit (i % 64) of word (i // 64)
+    bits = np.asarray(bits, dtype=bool)
+    n_rows, n_bits = bits.shape
+    n_words = max(1, (n_bits + 63) // 64)
+    packed = np.zeros((n_rows, n_words * 8), dtype=np.uint8)
+    packed[:, :(n_bits + 7) // 8] = np.packbits(bits, axis=1, bitorder="little")
+
+    return packed.view("<u8")
+
+
+def unpack_bitsets(words, n_bits):
+    words = np.ascontiguousarray(words, dtype="<u8")
+
+    return np.unpackbits(words.view(np.uint8), axis=1, count=n_bits, bitorder="little")
+
+
 def read_instance_knapsack(archive, inst):
     data = {'value': [], 'n_vars': 0, 'n_cons': 1, 'n_objs': 3}
     data['weight'], data['capacity'] = [], 0
@@ -87,9 +133,58 @@ def read_instance_knapsack(archive, inst):
     return data
 
 
-def read_instance_indepset(archive, inst):
+def get_edges_from_cliques(cliques):
+    # Every pair of variables sharing a constraint is an edge (i, j) with i < j
+    edges = [np.asarray(clique)[np.column_stack(np.triu_indices(len(clique), 1))]
+             for clique in cliques if len(clique) > 1]
+    if len(edges) == 0:
+        return np.zeros((0, 2), dtype=int)
+
+    edges = np.sort(np.concatenate(edges), axis=1)
+    edges = edges[edges[:, 0] != edges[:, 1]]
+
+    return np.unique(edges, axis=0)
+
+
+def get_adjacency(edges, n_vars, adj_formats=("dense",)):
+    # dense: n_vars x n_vars float matrices adj_list (with self-loops) and its complement adj_list_comp
+    # csr: neighbour lists adj_indptr/adj_indices (without self-loops)
+    # bitset: complement rows packed into uint64 words, adj_list_comp_bits
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    src = np.concatenate((edges[:, 0], edges[:, 1]))
+    dst = np.concatenate((edges[:, 1], edges[:, 0]))
+
+    adj = {}
+    if "dense" in adj_formats:
+        adj_list = np.eye(n_vars)
+        adj_list[src, dst] = 1
+        adj["adj_list"] = adj_list
+        adj["adj_list_comp"] = 1 - adj_list
+
+    if "csr" in adj_formats:
+        perm = np.lexsort((dst, src))
+        adj_indptr = np.zeros(n_vars + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n_vars), out=adj_indptr[1:])
+        adj["adj_indptr"] = adj_indptr
+        adj["adj_indices"] = dst[perm].astype(np.int32)
+
+    if "bitset" in adj_formats:
+        adj_list_comp_bits = np.repeat(pack_bitsets(np.ones((1, n_vars), dtype=bool)), n_vars, axis=0)
+        rows = np.concatenate((src, np.arange(n_vars)))
+        cols = np.concatenate((dst, np.arange(n_vars)))
+        np.bitwise_and.at(adj_list_comp_bits,
+                          (rows, cols // 64),
+                          ~(np.uint64(1) << (cols % 64).astype(np.uint64)))
+        adj["adj_list_comp_bits"] = adj_list_comp_bits
+
+    return adj
+
+
+def read_instance_indepset(archive, inst, adj_formats=("dense",)):
     if inst.split(".")[-1] == "npz":
-        data = read_from_zip(archive, inst, format="npz")
+        npz = read_from_zip(archive, inst, format="npz")
+        data = {key: npz[key] for key in npz.files}
+        data["n_vars"], data["n_objs"] = int(data["n_vars"]), int(data["n_objs"])
     else:
         raw_data = read_from_zip(archive, inst)
 
@@ -97,11 +192,6 @@ def read_instance_indepset(archive, inst):
 
         data["n_vars"], data["n_cons"] = list(map(int, raw_data.readline().strip().split()))
         data["n_objs"] = int(raw_data.readline())
-        data["adj_list"] = np.zeros((data["n_vars"], data["n_vars"]))
-        data["adj_list_comp"] = np.ones((data["n_vars"], data["n_vars"]))
-        for i in range(data["n_vars"]):
-            data["adj_list"][i, i] = 1
-            data["adj_list_comp"][i, i] = 0
 
         for _ in range(data["n_objs"]):
             data["obj_coeffs"].append(list(map(int, raw_data.readline().split())))
@@ -114,29 +204,19 @@ def read_instance_indepset(archive, inst):
             non_zero_vars = [i - 1 for i in non_zero_vars]
             data["cons_coeffs"].append(non_zero_vars)
 
-            for i in range(len(non_zero_vars)):
-                i_var = non_zero_vars[i]
-                for j in range(i + 1, len(non_zero_vars)):
-                    j_var = non_zero_vars[j]
-                    data["adj_list"][i_var, j_var] = 1
-                    data["adj_list"][j_var, i_var] = 1
-                    data["adj_list_comp"][i_var, j_var] = 0
-                    data["adj_list_comp"][j_var, i_var] = 0
-
-        # print(data["adj_list"])
-        # data["adj_list_comp"] = np.zeros((data["n_vars"], data["n_vars"]))
-        # data["adj_list_comp"][data["adj_list"] == 0] = 1
-        # print(data["adj_list"][96])
-        # print(data["adj_list_comp"][96])
+        data["edges"] = get_edges_from_cliques(data["cons_coeffs"])
+
+    data.update(get_adjacency(data["edges"], data["n_vars"], adj_formats=adj_formats))
+
     return data
 
 
-def read_instance(problem, archive, inst):
+def read_instance(problem, archive, inst, adj_formats=("dense",)):
     data = None
     if problem == "knapsack" or problem == "knapsackc":
         data = read_instance_knapsack(archive, inst)
     elif problem == "indepset":
-        data = read_instance_indepset(archive, inst)
+        data = read_instance_indepset(archive, inst, adj_formats=adj_formats)
     return data
 
 
@@ -150,7 +230,7 @@ def get_instance_prefix(problem):
     return prefix
 
 
-def get_instance_data(problem, size, split, pid):
+def get_instance_data(problem, size, split, pid, adj_formats=("dense",)):
     prefix = get_instance_prefix(problem)
     archive = resource_path / f"instances/{problem}/{size}.zip"
     suffix = "dat"
@@ -159,7 +239,7 @@ def get_instance_data(problem, size, split, pid):
             suffix = "npz"
 
     inst = f'{size}/{split}/{prefix}_{size}_{pid}.{suffix}'
-    data = read_instance(problem, archive, inst)
+    data = read_instance(problem, archive, inst, adj_formats=adj_formats)
 
     return data
 
@@ -240,7 +320,10 @@ def get_layer_weights(flag_penalty, penalty, num_vars):
     return layer_weight
 
 
-def get_bdd_data(problem, size, split, pid):
+def get_bdd_data(problem, size, split, pid, bdd_format="json"):
+    if bdd_format == "columnar":
+        return load_columnar_bdd(get_columnar_bdd_path(problem, size, split, pid))
+
     archive = resource_path / f"bdds/{problem}/{size}.zip"
     zf = zipfile.ZipFile(archive)
     fp = zf.open(f"{size}/{split}/{pid}.json", "r")
@@ -548,6 +631,66 @@ def extract_node_features(problem,
         raise ValueError("Invalid problem!")
 
 
+def get_xgb_features(problem,
+                     bdd,
+                     inst_features,
+                     var_features,
+                     inst_data,
+                     nodes=None,
+                     layer_norm_const=100,
+                     state_norm_const=1000):
+    # Layer-vectorized version of extract_node_features that directly builds the XGBoost feature matrix,
+    # one float32 row per node (or per index in nodes) with the columns
+    # inst features | parent var features | parent node features | var features | node features
+    def get_xgb_features_knapsack():
+        n_inst_feat, n_var_feat = len(inst_features), var_features.shape[1]
+        features = np.empty((len(nodes), n_inst_feat + 2 * n_var_feat + 9), dtype=np.float32)
+
+        state = dd.states()[:, 0]
+        lidx = dd.node_layer()[nodes]
+        node_state = state[nodes].astype(np.float64)
+        norm_state = node_state / state_norm_const
+        state_to_capacity = node_state / inst_data["capacity"]
+
+        # Parent node features. Like extract_node_features, the one-arc parent state is only used
+        # when a node has more than one one-arc parent.
+        parent_node_feat = -np.ones((len(nodes), 6))
+        parent_node_feat[:, 0] = 1
+        has_op = (lidx > 0) & (np.diff(dd.op_ptr)[nodes] > 1)
+        op_parent = dd.layer_ptr[lidx[has_op] - 1] + dd.op_idx[dd.op_ptr[nodes[has_op]]]
+        prev_state = state[op_parent].astype(np.float64)
+        parent_node_feat[has_op, 1] = prev_state / state_norm_const
+        parent_node_feat[has_op, 2] = prev_state / inst_data["capacity"]
+        has_zp = (lidx > 0) & (np.diff(dd.zp_ptr)[nodes] > 0)
+        parent_node_feat[has_zp, 4] = norm_state[has_zp]
+        parent_node_feat[has_zp, 5] = state_to_capacity[has_zp]
+
+        # Variable features broadcast by layer, -1 for the parent of the first layer
+        parent_var_features = np.vstack((-np.ones((1, n_var_feat)), var_features))
+
+        col = 0
+        features[:, col:col + n_inst_feat] = inst_features
+        col += n_inst_feat
+        features[:, col:col + n_var_feat] = parent_var_features[lidx]
+        col += n_var_feat
+        features[:, col:col + 6] = parent_node_feat
+        col += 6
+        features[:, col:col + n_var_feat] = var_features[lidx]
+        col += n_var_feat
+        features[:, col] = norm_state
+        features[:, col + 1] = state_to_capacity
+        features[:, col + 2] = (lidx + 1) / layer_norm_const
+
+        return features
+
+    dd = bdd_to_columnar(bdd)
+    nodes = np.arange(dd.n_nodes) if nodes is None else np.asarray(nodes, dtype=np.int64)
+    if problem == "knapsack":
+        return get_xgb_features_knapsack()
+    else:
+        raise ValueError("Invalid problem!")
+
+
 def get_aggregated_weight(aggregation="sum",
                           flag_layer_penalty=False,
                           layer_weight=1,
@@ -573,6 +716,190 @@ def get_aggregated_weight(aggregation="sum",
     return weight
 
 
+def get_aggregated_weights(aggregation="sum",
+                           flag_layer_penalty=False,
+                           layer_weight=1,
+                           flag_imbalance_penalty=False,
+                           imb_wt=1,
+                           flag_importance_penalty=False,
+                           score=0):
+    # Vectorized get_aggregated_weight, flag_importance_penalty can be a per-node mask
+    if aggregation == "sum":
+        neutral, combine = 0, np.add
+    elif aggregation == "mul":
+        neutral, combine = 1, np.multiply
+    else:
+        return np.ones(np.shape(score))
+
+    l_wt = layer_weight if flag_layer_penalty else neutral
+    imb_wt = imb_wt if flag_imbalance_penalty else neutral
+    imp_wt = np.where(flag_importance_penalty, score, neutral)
+    weight = np.array(np.broadcast_to(combine(combine(l_wt, imb_wt), imp_wt), np.shape(score)), dtype=float)
+    weight[weight == 0] = 1
+
+    return weight
+
+
+def get_node_labels(pareto, score, labeling_scheme):
+    # Vectorized label_bdd
+    pareto = np.asarray(pareto) == 1
+    if labeling_scheme == "binary":
+        return pareto.astype(np.int64)
+    elif labeling_scheme == "mo":
+        # Margin one
+        return np.where(pareto, 1, -1)
+    elif labeling_scheme == "mos":
+        # Margin one score
+        return np.where(pareto, 1 + np.asarray(score), -1)
+    elif labeling_scheme == "nms":
+        # Negative margin score
+        return np.where(pareto, np.asarray(score), -1)
+    else:
+        raise ValueError("Invalid labeling scheme!")
+
+
+def sample_xgb_nodes(bdd, neg_pos_ratio=1, min_samples=0, rng=None):
+    # Global index of the training nodes of a BDD: the Pareto nodes of every layer, in node order, followed by
+    # a random sample of max(int(neg_pos_ratio * #pos), min_samples) of its other nodes (all of them if
+    # neg_pos_ratio < 1). Also returns the number of positive and negative samples of every layer.
+    dd = bdd_to_columnar(bdd)
+    rng = np.random.default_rng() if rng is None else rng
+    node_layer = dd.node_layer()
+    is_pos = dd.pareto == 1
+
+    pos_nodes, neg_nodes = np.flatnonzero(is_pos), np.flatnonzero(~is_pos)
+    num_pos = np.bincount(node_layer[pos_nodes], minlength=dd.n_layers)
+    num_neg_all = np.diff(dd.layer_ptr) - num_pos
+    if neg_pos_ratio < 1:
+        num_neg = num_neg_all
+    else:
+        num_neg = np.maximum((neg_pos_ratio * num_pos).astype(np.int64), min_samples)
+        num_neg = np.minimum(num_neg, num_neg_all)
+
+    pos_ptr = np.concatenate(([0], np.cumsum(num_pos)))
+    neg_ptr = np.concatenate(([0], np.cumsum(num_neg_all)))
+    nodes = []
+    for lidx in range(dd.n_layers):
+        nodes.append(pos_nodes[pos_ptr[lidx]:pos_ptr[lidx + 1]])
+        neg_ids = neg_nodes[neg_ptr[lidx]:neg_ptr[lidx + 1]]
+        if num_neg[lidx] < len(neg_ids):
+            neg_ids = rng.choice(neg_ids, num_neg[lidx], replace=False)
+        nodes.append(neg_ids)
+    nodes = np.concatenate(nodes) if len(nodes) else np.zeros(0, dtype=np.int64)
+
+    return nodes.astype(np.int64), num_pos, num_neg
+
+
+def get_weights_type(flag_layer_penalty=True,
+                     layer_penalty=None,
+                     flag_imbalance_penalty=False,
+                     flag_importance_penalty=False,
+                     penalty_aggregation="sum"):
+    weights_type = ""
+    if flag_layer_penalty:
+        weights_type += f"{layer_penalty}-"
+    weights_type += "1-" if flag_imbalance_penalty else "0-"
+    weights_type += "1-" if flag_importance_penalty else "0-"
+    weights_type += penalty_aggregation
+
+    return weights_type
+
+
+def get_sample_weights(bdd,
+                       nodes,
+                       num_pos,
+                       num_neg,
+                       num_vars,
+                       flag_layer_penalty=True,
+                       layer_penalty=None,
+                       flag_imbalance_penalty=False,
+                       flag_importance_penalty=False,
+                       penalty_aggregation="sum"):
+    # Weights of the sampled nodes, with num_pos/num_neg the number of positive/negative samples of every layer
+    dd = bdd_to_columnar(bdd)
+    lidx = dd.node_layer()[nodes]
+    is_pos = dd.pareto[nodes] == 1
+    layer_weight = np.asarray(get_layer_weights(flag_layer_penalty, layer_penalty, num_vars), dtype=float)
+    # Imbalance weights of every layer
+    num_samples = num_pos + num_neg
+    pos_imb_wt = np.divide(num_neg, num_samples, out=np.zeros(len(num_samples)), where=num_samples > 0)
+
+    return get_aggregated_weights(aggregation=penalty_aggregation,
+                                  flag_layer_penalty=flag_layer_penalty,
+                                  layer_weight=layer_weight[lidx],
+                                  flag_imbalance_penalty=flag_imbalance_penalty,
+                                  imb_wt=np.where(is_pos, pos_imb_wt[lidx], 1 - pos_imb_wt[lidx]),
+                                  flag_importance_penalty=is_pos & bool(flag_importance_penalty),
+                                  score=dd.score[nodes])
+
+
+def get_xgb_training_data(problem,
+                          bdd=None,
+                          num_vars=None,
+                          size=None,
+                          split=None,
+                          pid=None,
+                          order_type=None,
+                          state_norm_const=1000,
+                          layer_norm_const=100,
+                          label_type="binary",
+                          neg_pos_ratio=1,
+                          min_samples=0,
+                          flag_layer_penalty=True,
+                          layer_penalty=None,
+                          flag_imbalance_penalty=False,
+                          flag_importance_penalty=False,
+                          penalty_aggregation="sum",
+                          random_seed=100,
+                          with_features=True,
+                          with_labels=True,
+                          with_weights=True):
+    # Features, labels and weights of the sampled nodes of a BDD, None for the parts that are not requested.
+    # Features have the column layout of extract_node_features.
+    if problem != "knapsack":
+        raise ValueError("Invalid problem type!")
+
+    dd = bdd_to_columnar(bdd)
+    rng = np.random.default_rng(random_seed)
+    nodes, num_pos, num_neg = sample_xgb_nodes(dd, neg_pos_ratio, min_samples, rng)
+
+    features, labels, weights = None, None, None
+    if with_features:
+        # Read instance
+        inst_data = get_instance_data(problem, size, split, pid)
+        order = get_static_order(problem, order_type, inst_data)
+        # Extract instance and variable features
+        featurizer = get_featurizer(problem, FeaturizerConfig(norm_const=state_norm_const,
+                                                              raw=False,
+                                                              context=True))
+        inst_features = get_cached_features(problem, featurizer, inst_data)
+        features = get_xgb_features(problem,
+                                    dd,
+                                    inst_features["inst"][0],
+                                    inst_features["var"][order],
+                                    inst_data,
+                                    nodes=nodes,
+                                    layer_norm_const=layer_norm_const,
+                                    state_norm_const=state_norm_const)
+
+    if with_labels:
+        labels = get_node_labels(dd.pareto[nodes], dd.score[nodes] if dd.score is not None else 0, label_type)
+
+    if with_weights:
+        weights = get_sample_weights(dd,
+                                     nodes,
+                                     num_pos,
+                                     num_neg,
+                                     num_vars,
+                                     flag_layer_penalty=flag_layer_penalty,
+                                     layer_penalty=layer_penalty,
+                                     flag_imbalance_penalty=flag_imbalance_penalty,
+                                     flag_importance_penalty=flag_importance_penalty,
+                                     penalty_aggregation=penalty_aggregation)
+
+    return features, labels, weights
+
+
 def convert_bdd_to_xgb_data(problem,
                             bdd=None,
                             num_objs=None,
@@ -603,122 +930,180 @@ def convert_bdd_to_xgb_data(problem,
     labels_data_path.mkdir(parents=True, exist_ok=True)
     labels_exists = labels_data_path.joinpath(f"{pid}.npy").exists()
 
-    weights_type = ""
-    if flag_layer_penalty:
-        weights_type += f"{layer_penalty}-"
-    weights_type += "1-" if flag_imbalance_penalty else "0-"
-    weights_type += "1-" if flag_importance_penalty else "0-"
-    weights_type += penalty_aggregation
+    weights_type = get_weights_type(flag_layer_penalty,
+                                    layer_penalty,
+                                    flag_imbalance_penalty,
+                                    flag_importance_penalty,
+                                    penalty_aggregation)
     weights_data_path = resource_path / "xgb_data" / problem / size / split / sampling_type / weights_type
     weights_data_path.mkdir(parents=True, exist_ok=True)
     weights_exists = weights_data_path.joinpath(f"{pid}.npy").exists()
 
     print(f"Processed {pid}, Features - {features_exists}, Weights - {weights_exists}, Labels - {labels_exists}")
 
-    def convert_bdd_to_xgb_data_knapsack():
-        rng = random.Random(random_seed)
-        features_lst = None if features_exists else []
-        weights_lst = None if weights_exists else []
-        labels_lst = None if labels_exists else []
-        layer_weight_lst = get_layer_weights(flag_layer_penalty, layer_penalty, num_vars)
-
-        inst_data, order, features, inst_features, var_features, num_var_features = None, None, None, None, None, None
-        if not features_exists:
-            # Read instance
-            inst_data = get_instance_data(problem, size, split, pid)
-            order = get_static_order(problem, order_type, inst_data)
-            # Extract instance and variable features
-            featurizer = get_featurizer(problem, FeaturizerConfig(norm_const=state_norm_const,
-                                                                  raw=False,
-                                                                  context=True))
-            features = featurizer.get(inst_data)
-            # Instance features
-            inst_features = features["inst"][0]
-            # Variable features. Reordered features based on ordering
-            var_features = features["var"][order]
-            num_var_features = features["var"].shape[1]
-
-        # features_lst, labels_lst, weights_lst = [], [], []
-        for lidx, layer in enumerate(bdd):
-            # _features_lst, _labels_lst, _weights_lst = [], [], []
-            pos_ids = [node_id for node_id, node in enumerate(layer) if node["pareto"] == 1]
-            neg_ids = list(set(range(len(layer))).difference(set(pos_ids)))
-
-            # Subsample negative samples
-            num_pos_samples = len(pos_ids)
-            if neg_pos_ratio < 1:
-                num_neg_samples = len(neg_ids)
-            else:
-                num_neg_samples = np.max([int(neg_pos_ratio * num_pos_samples),
-                                          min_samples])
-                num_neg_samples = np.min([num_neg_samples, len(neg_ids)])
-                rng.shuffle(neg_ids)
-            neg_ids = neg_ids[:num_neg_samples]
+    if problem == "knapsack":
+        data = get_xgb_training_data(problem,
+                                     bdd=bdd,
+                                     num_vars=num_vars,
+                                     size=size,
+                                     split=split,
+                                     pid=pid,
+                                     order_type=order_type,
+                                     state_norm_const=state_norm_const,
+                                     layer_norm_const=layer_norm_const,
+                                     label_type=label_type,
+                                     neg_pos_ratio=neg_pos_ratio,
+                                     min_samples=min_samples,
+                                     flag_layer_penalty=flag_layer_penalty,
+                                     layer_penalty=layer_penalty,
+                                     flag_imbalance_penalty=flag_imbalance_penalty,
+                                     flag_importance_penalty=flag_importance_penalty,
+                                     penalty_aggregation=penalty_aggregation,
+                                     random_seed=random_seed,
+                                     with_features=not features_exists,
+                                     with_labels=not labels_exists,
+                                     with_weights=not weights_exists)
+    else:
+        raise ValueError("Invalid problem type!")
 
-            # Imbalance weights for the current layer
-            pos_imb_wt = num_neg_samples / (num_pos_samples + num_neg_samples)
-            neg_imb_wt = 1 - pos_imb_wt
+    features_np, labels_np, weights_np = data
+    if features_np is not None:
+        np.save(open(sampling_data_path.joinpath(f"{pid}.npy"), "wb"), features_np)
 
-            _parent_var_feat, _var_feat = None, None
-            if not features_exists:
-                # Variable features: Parent and current layer
-                _parent_var_feat = -1 * np.ones(num_var_features) \
-                    if lidx == 0 \
-                    else var_features[lidx - 1]
-                _var_feat = var_features[lidx]
+    if labels_np is not None:
+        np.save(open(labels_data_path.joinpath(f"{pid}.npy"), "wb"), labels_np)
 
-            prev_layer = bdd[lidx - 1] if lidx > 0 else None
-            node_ids = pos_ids[:]
-            node_ids.extend(neg_ids)
-            for i, node_id in enumerate(node_ids):
-                node = layer[node_id]
+    if weights_np is not None:
+        np.save(open(weights_data_path.joinpath(f"{pid}.npy"), "wb"), weights_np)
 
-                if not features_exists:
-                    _node_feat, _parent_node_feat = extract_node_features("knapsack",
-                                                                          lidx,
-                                                                          node,
-                                                                          prev_layer,
-                                                                          inst_data,
-                                                                          layer_norm_const=layer_norm_const,
-                                                                          state_norm_const=state_norm_const)
-                    features_lst.append(np.concatenate((inst_features,
-                                                        _parent_var_feat,
-                                                        _parent_node_feat,
-                                                        _var_feat,
-                                                        _node_feat)))
 
-                if not labels_exists:
-                    labels_lst.append(node["l"])
+def get_xgb_indexed_data_path(problem, size, split):
+    # Layout of the indexed dataset of a split:
+    #   full/{pid}.npy                                  features of all nodes
+    #   labels/{label_type}/{pid}.npy                   labels of all nodes
+    #   {sampling_type}/{pid}.npy                       rows of the sampled nodes
+    #   {sampling_type}/{weights_type}/{pid}.npy        weights of the sampled nodes
+    return resource_path / "xgb_data" / problem / size / split / "indexed"
+
+
+def convert_bdd_to_xgb_indexed_data(problem,
+                                    bdd=None,
+                                    num_objs=None,
+                                    num_vars=None,
+                                    split=None,
+                                    pid=None,
+                                    order_type=None,
+                                    state_norm_const=1000,
+                                    layer_norm_const=100,
+                                    label_types=("binary",),
+                                    samplings=({"neg_pos_ratio": 1, "min_samples": 0},),
+                                    weightings=({"flag_layer_penalty": True,
+                                                 "layer_penalty": "exponential",
+                                                 "flag_imbalance_penalty": False,
+                                                 "flag_importance_penalty": False,
+                                                 "penalty_aggregation": "sum"},),
+                                    random_seed=100):
+    # Featurizes a BDD once and writes every sampling x label x weighting variant of it. A variant is the same
+    # data convert_bdd_to_xgb_data would write for its parameters.
+    if problem != "knapsack":
+        raise ValueError("Invalid problem type!")
 
-                if not weights_exists:
-                    weights_lst.append(get_aggregated_weight(
-                        aggregation=penalty_aggregation,
-                        flag_layer_penalty=flag_layer_penalty,
-                        layer_weight=layer_weight_lst[lidx],
-                        flag_imbalance_penalty=flag_imbalance_penalty,
-                        imb_wt=pos_imb_wt if i < num_pos_samples else neg_imb_wt,
-                        flag_importance_penalty=flag_importance_penalty if i < num_pos_samples else False,
-                        score=node["score"]))
+    size = f"{num_objs}_{num_vars}"
+    data_path = get_xgb_indexed_data_path(problem, size, split)
+    dd = bdd_to_columnar(bdd)
+    node_layer = dd.node_layer()
 
-        return features_lst, labels_lst, weights_lst
+    features_path = data_path / "full" / f"{pid}.npy"
+    if not features_path.exists():
+        inst_data = get_instance_data(problem, size, split, pid)
+        order = get_static_order(problem, order_type, inst_data)
+        featurizer = get_featurizer(problem, FeaturizerConfig(norm_const=state_norm_const,
+                                                              raw=False,
+                                                              context=True))
+        inst_features = get_cached_features(problem, featurizer, inst_data)
+        features = get_xgb_features(problem,
+                                    dd,
+                                    inst_features["inst"][0],
+                                    inst_features["var"][order],
+                                    inst_data,
+                                    layer_norm_const=layer_norm_const,
+                                    state_norm_const=state_norm_const)
+        features_path.parent.mkdir(parents=True, exist_ok=True)
+        np.save(features_path, features)
+
+    for label_type in label_types:
+        labels_path = data_path / "labels" / label_type / f"{pid}.npy"
+        if not labels_path.exists():
+            labels_path.parent.mkdir(parents=True, exist_ok=True)
+            np.save(labels_path, get_node_labels(dd.pareto, dd.score if dd.score is not None else 0, label_type))
+
+    for sampling in samplings:
+        sampling_type = f"npr{sampling['neg_pos_ratio']}ms{sampling['min_samples']}"
+        nodes_path = data_path / sampling_type / f"{pid}.npy"
+        if nodes_path.exists():
+            nodes = np.load(nodes_path).astype(np.int64)
+            is_pos = dd.pareto[nodes] == 1
+            num_pos = np.bincount(node_layer[nodes[is_pos]], minlength=dd.n_layers)
+            num_neg = np.bincount(node_layer[nodes[~is_pos]], minlength=dd.n_layers)
+        else:
+            # Same draw as convert_bdd_to_xgb_data
+            rng = np.random.default_rng(random_seed)
+            nodes, num_pos, num_neg = sample_xgb_nodes(dd, sampling["neg_pos_ratio"], sampling["min_samples"], rng)
+            nodes_path.parent.mkdir(parents=True, exist_ok=True)
+            np.save(nodes_path, nodes.astype(np.int32))
+
+        for weighting in weightings:
+            weights_path = data_path / sampling_type / get_weights_type(**weighting) / f"{pid}.npy"
+            if not weights_path.exists():
+                weights_path.parent.mkdir(parents=True, exist_ok=True)
+                np.save(weights_path, get_sample_weights(dd, nodes, num_pos, num_neg, num_vars, **weighting))
+
+    print(f"Processed {pid}, {len(samplings)} samplings x {len(label_types)} labels x {len(weightings)} weightings")
+
+
+def load_xgb_indexed_data(problem, size, split, pid, sampling_type, weights_type, label_type):
+    # Features, labels and weights of one variant of the indexed dataset, the full matrices are memory-mapped
+    data_path = get_xgb_indexed_data_path(problem, size, split)
+    nodes = np.load(data_path / sampling_type / f"{pid}.npy")
+    x = np.load(data_path / "full" / f"{pid}.npy", mmap_mode="r")[nodes]
+    y = np.load(data_path / "labels" / label_type / f"{pid}.npy", mmap_mode="r")[nodes]
+    wt = np.load(data_path / sampling_type / weights_type / f"{pid}.npy")
+
+    return x, y, wt
+
+
+def get_xgb_data_loader(problem, size, split, sampling_type, weights_type, label_type, data_format="zip"):
+    # Function that returns the features, labels and weights of a pid, None if the pid is not in the dataset
+    if data_format == "indexed":
+        data_path = get_xgb_indexed_data_path(problem, size, split) / sampling_type
+
+        def load(pid):
+            if not data_path.joinpath(f"{pid}.npy").exists():
+                return None
+            return load_xgb_indexed_data(problem, size, split, pid, sampling_type, weights_type, label_type)
+
+    elif data_format == "zip":
+        data_path = resource_path / f"xgb_data/{problem}/{size}/{split}"
+        zf_sampling_type = zipfile.ZipFile(data_path / f"{sampling_type}.zip")
+        zf_labels_type = zipfile.ZipFile(data_path / f"labels/{label_type}.zip")
+        members = set(zf_sampling_type.namelist())
+
+        def read(zf, file):
+            with zf.open(file, "r") as fp:
+                return np.load(io.BytesIO(fp.read()))
+
+        def load(pid):
+            if f"{sampling_type}/{pid}.npy" not in members:
+                return None
+            x = read(zf_sampling_type, f"{sampling_type}/{pid}.npy")
+            wt = read(zf_sampling_type, f"{sampling_type}/{weights_type}/{pid}.npy")
+            y = read(zf_labels_type, f"{label_type}/{pid}.npy")
+            return x, y, wt
 
-    if problem == "knapsack":
-        data = convert_bdd_to_xgb_data_knapsack()
     else:
-        raise ValueError("Invalid problem type!")
-
-    features_lst, labels_lst, weights_lst = data
-    if features_lst is not None:
-        features_np = np.array(features_lst)
-        np.save(open(sampling_data_path.joinpath(f"{pid}.npy"), "wb"), features_np)
+        raise ValueError("Invalid data format!")
 
-    if labels_lst is not None:
-        labels_np = np.array(labels_lst)
-        np.save(open(labels_data_path.joinpath(f"{pid}.npy"), "wb"), labels_np)
-
-    if weights_lst is not None:
-        weights_np = np.array(weights_lst)
-        np.save(open(weights_data_path.joinpath(f"{pid}.npy"), "wb"), weights_np)
+    return load
 
 
 def convert_bdd_to_xgb_mixed_data(problem,
@@ -753,121 +1138,50 @@ def convert_bdd_to_xgb_mixed_data(problem,
     labels_data_path.mkdir(parents=True, exist_ok=True)
     labels_exists = labels_data_path.joinpath(f"{counter}.npy").exists()
 
-    weights_type = ""
-    if flag_layer_penalty:
-        weights_type += f"{layer_penalty}-"
-    weights_type += "1-" if flag_imbalance_penalty else "0-"
-    weights_type += "1-" if flag_importance_penalty else "0-"
-    weights_type += penalty_aggregation
+    weights_type = get_weights_type(flag_layer_penalty,
+                                    layer_penalty,
+                                    flag_imbalance_penalty,
+                                    flag_importance_penalty,
+                                    penalty_aggregation)
     weights_data_path = resource_path / "xgb_data" / problem / dataset_type / split / sampling_type / weights_type
     weights_data_path.mkdir(parents=True, exist_ok=True)
     weights_exists = weights_data_path.joinpath(f"{counter}.npy").exists()
 
     print(f"Processed {counter}, Features - {features_exists}, Weights - {weights_exists}, Labels - {labels_exists}")
 
-    def convert_bdd_to_xgb_mixed_data_knapsack():
-        rng = random.Random(random_seed)
-        features_lst = None if features_exists else []
-        weights_lst = None if weights_exists else []
-        labels_lst = None if labels_exists else []
-        layer_weight_lst = get_layer_weights(flag_layer_penalty, layer_penalty, num_vars)
-
-        inst_data, order, features, inst_features, var_features, num_var_features = None, None, None, None, None, None
-        if not features_exists:
-            # Read instance
-            inst_data = get_instance_data(problem, size, split, pid)
-            order = get_static_order(problem, order_type, inst_data)
-            # Extract instance and variable features
-            featurizer = get_featurizer(problem, FeaturizerConfig(norm_const=state_norm_const,
-                                                                  raw=False,
-                                                                  context=True))
-            features = featurizer.get(inst_data)
-            # Instance features
-            inst_features = features["inst"][0]
-            # Variable features. Reordered features based on ordering
-            var_features = features["var"][order]
-            num_var_features = features["var"].shape[1]
-
-        # features_lst, labels_lst, weights_lst = [], [], []
-        for lidx, layer in enumerate(bdd):
-            # _features_lst, _labels_lst, _weights_lst = [], [], []
-            pos_ids = [node_id for node_id, node in enumerate(layer) if node["pareto"] == 1]
-            neg_ids = list(set(range(len(layer))).difference(set(pos_ids)))
-
-            # Subsample negative samples
-            num_pos_samples = len(pos_ids)
-            if neg_pos_ratio < 1:
-                num_neg_samples = len(neg_ids)
-            else:
-                num_neg_samples = np.max([int(neg_pos_ratio * num_pos_samples),
-                                          min_samples])
-                num_neg_samples = np.min([num_neg_samples, len(neg_ids)])
-                rng.shuffle(neg_ids)
-            neg_ids = neg_ids[:num_neg_samples]
-
-            # Imbalance weights for the current layer
-            pos_imb_wt = num_neg_samples / (num_pos_samples + num_neg_samples)
-            neg_imb_wt = 1 - pos_imb_wt
-
-            _parent_var_feat, _var_feat = None, None
-            if not features_exists:
-                # Variable features: Parent and current layer
-                _parent_var_feat = -1 * np.ones(num_var_features) \
-                    if lidx == 0 \
-                    else var_features[lidx - 1]
-                _var_feat = var_features[lidx]
-
-            prev_layer = bdd[lidx - 1] if lidx > 0 else None
-            node_ids = pos_ids[:]
-            node_ids.extend(neg_ids)
-            for i, node_id in enumerate(node_ids):
-                node = layer[node_id]
-
-                if not features_exists:
-                    _node_feat, _parent_node_feat = extract_node_features("knapsack",
-                                                                          lidx,
-                                                                          node,
-                                                                          prev_layer,
-                                                                          inst_data,
-                                                                          layer_norm_const=layer_norm_const,
-                                                                          state_norm_const=state_norm_const)
-                    features_lst.append(np.concatenate((inst_features,
-                                                        _parent_var_feat,
-                                                        _parent_node_feat,
-                                                        _var_feat,
-                                                        _node_feat)))
-
-                if not labels_exists:
-                    labels_lst.append(node["l"])
-
-                if not weights_exists:
-                    weights_lst.append(get_aggregated_weight(
-                        aggregation=penalty_aggregation,
-                        flag_layer_penalty=flag_layer_penalty,
-                        layer_weight=layer_weight_lst[lidx],
-                        flag_imbalance_penalty=flag_imbalance_penalty,
-                        imb_wt=pos_imb_wt if i < num_pos_samples else neg_imb_wt,
-                        flag_importance_penalty=flag_importance_penalty if i < num_pos_samples else False,
-                        score=node["score"]))
-
-        return features_lst, labels_lst, weights_lst
-
     if problem == "knapsack":
-        data = convert_bdd_to_xgb_mixed_data_knapsack()
+        data = get_xgb_training_data(problem,
+                                     bdd=bdd,
+                                     num_vars=num_vars,
+                                     size=size,
+                                     split=split,
+                                     pid=pid,
+                                     order_type=order_type,
+                                     state_norm_const=state_norm_const,
+                                     layer_norm_const=layer_norm_const,
+                                     label_type=label_type,
+                                     neg_pos_ratio=neg_pos_ratio,
+                                     min_samples=min_samples,
+                                     flag_layer_penalty=flag_layer_penalty,
+                                     layer_penalty=layer_penalty,
+                                     flag_imbalance_penalty=flag_imbalance_penalty,
+                                     flag_importance_penalty=flag_importance_penalty,
+                                     penalty_aggregation=penalty_aggregation,
+                                     random_seed=random_seed,
+                                     with_features=not features_exists,
+                                     with_labels=not labels_exists,
+                                     with_weights=not weights_exists)
     else:
         raise ValueError("Invalid problem type!")
 
-    features_lst, labels_lst, weights_lst = data
-    if features_lst is not None:
-        features_np = np.array(features_lst)
+    features_np, labels_np, weights_np = data
+    if features_np is not None:
         np.save(open(sampling_data_path.joinpath(f"{counter}.npy"), "wb"), features_np)
 
-    if labels_lst is not None:
-        labels_np = np.array(labels_lst)
+    if labels_np is not None:
         np.save(open(labels_data_path.joinpath(f"{counter}.npy"), "wb"), labels_np)
 
-    if weights_lst is not None:
-        weights_np = np.array(weights_lst)
+    if weights_np is not None:
         np.save(open(weights_data_path.joinpath(f"{counter}.npy"), "wb"), weights_np)
 
 
@@ -1090,10 +1404,6 @@ def checkpoint_test(cfg, scores_df):
     scores_df.to_csv(scores_df_name, index=False)
 
 
-def handle_timeout(sig, frame):
-    raise TimeoutError('Timeout')
-
-
 def set_seed(seed):
     random.seed = seed
     torch.manual_seed(seed)
@@ -0,0 +1,191 @@
+import itertools
+import json
+from pathlib import Path
+
+import numpy as np
+
+from morbdd import resource_path
+
+# On-disk layout of a columnar BDD (.cbdd):
+#   magic (8 bytes) | header length (uint64) | JSON header | padding | arrays
+# Every array starts on a 64-byte boundary of the data section, so a reader can
+# map the file once and take zero-copy views of each column.
+CBDD_MAGIC = b"MORBDD\x00\x01"
+CBDD_SUFFIX = "cbdd"
+CBDD_ALIGN = 64
+
+# Columns that every BDD has: per-layer offsets into the node arrays, CSR
+# encoded node states and CSR encoded one-arc/zero-arc parents. Parent indices
+# are local to the previous layer, same as the "op"/"zp" lists of the JSON BDD.
+CBDD_COLUMNS = ["layer_ptr", "state_ptr", "state", "op_ptr", "op_idx", "zp_ptr", "zp_idx"]
+# Per-node columns that are only present once a BDD is labelled or scored
+CBDD_NODE_FIELDS = {"pareto": np.int8, "score": np.float64, "pred": np.float64}
+
+
+def _align(offset):
+    return (offset + CBDD_ALIGN - 1) // CBDD_ALIGN * CBDD_ALIGN
+
+
+class ColumnarBDD:
+    def __init__(self, arrays):
+        self.layer_ptr = arrays["layer_ptr"]
+        self.state_ptr = arrays["state_ptr"]
+        self.state = arrays["state"]
+        self.op_ptr = arrays["op_ptr"]
+        self.op_idx = arrays["op_idx"]
+        self.zp_ptr = arrays["zp_ptr"]
+        self.zp_idx = arrays["zp_idx"]
+        self.pareto = arrays.get("pareto")
+        self.score = arrays.get("score")
+        self.pred = arrays.get("pred")
+
+    @property
+    def n_layers(self):
+        return len(self.layer_ptr) - 1
+
+    @property
+    def n_nodes(self):
+        return int(self.layer_ptr[-1])
+
+    def __len__(self):
+        return self.n_layers
+
+    def layer_size(self, lidx):
+        return int(self.layer_ptr[lidx + 1] - self.layer_ptr[lidx])
+
+    def layer_slice(self, lidx):
+        return slice(int(self.layer_ptr[lidx]), int(self.layer_ptr[lidx + 1]))
+
+    def state_width(self):
+        # Width of the node state if all states have the same length (e.g. knapsack), None otherwise
+        lengths = np.diff(self.state_ptr)
+        if len(lengths) == 0:
+            return 0
+        if np.all(lengths == lengths[0]):
+            return int(lengths[0])
+
+        return None
+
+    def states(self):
+        # Fixed-width states as an (n_nodes, width) view of the flat state column
+        width = self.state_width()
+        assert width is not None, "Node states have variable length!"
+
+        return self.state.reshape(-1, width)
+
+    def node_layer(self):
+        # Layer index of every node
+        return np.repeat(np.arange(self.n_layers), np.diff(self.layer_ptr))
+
+    def arrays(self):
+        arrays = {name: getattr(self, name) for name in CBDD_COLUMNS}
+        for name in CBDD_NODE_FIELDS:
+            if getattr(self, name) is not None:
+                arrays[name] = getattr(self, name)
+
+        return arrays
+
+    def to_list(self):
+        # Convert back to the list-of-layers-of-dicts representation
+        state, op_idx, zp_idx = self.state.tolist(), self.op_idx.tolist(), self.zp_idx.tolist()
+        state_ptr, op_ptr, zp_ptr = self.state_ptr.tolist(), self.op_ptr.tolist(), self.zp_ptr.tolist()
+        fields = {name: getattr(self, name).tolist()
+                  for name in CBDD_NODE_FIELDS
+                  if getattr(self, name) is not None}
+
+        bdd = []
+        for lidx in range(self.n_layers):
+            layer = []
+            for i in range(int(self.layer_ptr[lidx]), int(self.layer_ptr[lidx + 1])):
+                node = {"s": state[state_ptr[i]:state_ptr[i + 1]],
+                        "op": op_idx[op_ptr[i]:op_ptr[i + 1]],
+                        "zp": zp_idx[zp_ptr[i]:zp_ptr[i + 1]]}
+                for name, values in fields.items():
+                    node[name] = values[i]
+                layer.append(node)
+            bdd.append(layer)
+
+        return bdd
+
+
+def _csr(lists, n, dtype=np.int32):
+    lengths = np.fromiter((len(lst) for lst in lists), dtype=np.int64, count=n)
+    ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(lengths, out=ptr[1:])
+    flat = np.fromiter(itertools.chain.from_iterable(lists), dtype=dtype, count=int(ptr[-1]))
+
+    return ptr, flat
+
+
+def bdd_to_columnar(bdd):
+    if isinstance(bdd, ColumnarBDD):
+        return bdd
+
+    layer_ptr = np.zeros(len(bdd) + 1, dtype=np.int64)
+    np.cumsum([len(layer) for layer in bdd], out=layer_ptr[1:])
+    nodes = [node for layer in bdd for node in layer]
+    n_nodes = len(nodes)
+
+    arrays = {"layer_ptr": layer_ptr}
+    arrays["state_ptr"], arrays["state"] = _csr([node["s"] for node in nodes], n_nodes)
+    arrays["op_ptr"], arrays["op_idx"] = _csr([node["op"] for node in nodes], n_nodes)
+    arrays["zp_ptr"], arrays["zp_idx"] = _csr([node["zp"] for node in nodes], n_nodes)
+    for name, dtype in CBDD_NODE_FIELDS.items():
+        if n_nodes and all(name in node for node in nodes):
+            arrays[name] = np.fromiter((node[name] for node in nodes), dtype=dtype, count=n_nodes)
+
+    return ColumnarBDD(arrays)
+
+
+def save_columnar_bdd(path, bdd):
+    arrays = bdd_to_columnar(bdd).arrays()
+
+    specs = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        specs[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({"arrays": specs}).encode("utf-8")
+    data_start = _align(len(CBDD_MAGIC) + 8 + len(header))
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as fp:
+        fp.write(CBDD_MAGIC)
+        fp.write(np.uint64(len(header)).tobytes())
+        fp.write(header)
+        for name, array in arrays.items():
+            fp.seek(data_start + specs[name]["offset"])
+            fp.write(array.tobytes())
+        # Pad the file so that the last array is fully backed by the mapping
+        fp.truncate(data_start + offset)
+
+
+def load_columnar_bdd(source):
+    # source is either a path (memory-mapped, read-only) or the raw bytes of a .cbdd file
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        buf = np.frombuffer(source, dtype=np.uint8)
+    else:
+        buf = np.memmap(source, dtype=np.uint8, mode="r")
+
+    if bytes(buf[:len(CBDD_MAGIC)]) != CBDD_MAGIC:
+        raise ValueError("Invalid columnar BDD file!")
+    header_len = int(buf[len(CBDD_MAGIC):len(CBDD_MAGIC) + 8].view(np.uint64)[0])
+    header_start = len(CBDD_MAGIC) + 8
+    header = json.loads(bytes(buf[header_start:header_start + header_len]))
+    data_start = _align(header_start + header_len)
+
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"]))
+        start = data_start + spec["offset"]
+        arrays[name] = buf[start:start + count * dtype.itemsize].view(dtype).reshape(spec["shape"])
+
+    return ColumnarBDD(arrays)
+
+
+def get_columnar_bdd_path(problem, size, split, pid):
+    return resource_path / f"bdds/{problem}/{size}/{split}/{pid}.{CBDD_SUFFIX}"
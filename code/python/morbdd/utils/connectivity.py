@@ -0,0 +1,84 @@
+import numpy as np
+
+from morbdd.utils.bdd_store import bdd_to_columnar
+
+
+def get_parent_arcs(bdd):
+    # Global (child, parent) node index of every one-arc and zero-arc below the first layer, sorted by
+    # child, and the offset of the arcs of every layer
+    node_layer = bdd.node_layer()
+    n_nodes = bdd.n_nodes
+    child = np.concatenate((np.repeat(np.arange(n_nodes), np.diff(bdd.op_ptr)),
+                            np.repeat(np.arange(n_nodes), np.diff(bdd.zp_ptr))))
+    parent = np.concatenate((bdd.op_idx, bdd.zp_idx)).astype(np.int64)
+
+    keep = node_layer[child] > 0
+    child, parent = child[keep], parent[keep]
+    # Parent indices are local to the previous layer
+    parent += bdd.layer_ptr[node_layer[child] - 1]
+
+    order = np.argsort(child, kind="stable")
+    child, parent = child[order], parent[order]
+    arc_ptr = np.searchsorted(child, bdd.layer_ptr)
+
+    return child, parent, arc_ptr
+
+
+def read_pred(bdd, from_layer=0):
+    # Predictions of the nodes of a list-of-layers BDD, starting at from_layer
+    return np.fromiter((node["pred"] for layer in bdd[from_layer:] for node in layer), dtype=float)
+
+
+class BDDConnectivity:
+    # A node is connected if its prediction is above the threshold and one of its parents is connected. The
+    # root is always connected, so on the first layer every selected node is connected. Layers are checked
+    # with one vectorized step each, and a check can be restarted at any layer after the predictions or the
+    # connected nodes of the layer above it were changed, e.g. by stitching.
+    def __init__(self, bdd, threshold=0.5, round_upto=1):
+        cbdd = bdd_to_columnar(bdd)
+        self.threshold = threshold
+        self.round_upto = round_upto
+        self.layer_ptr = cbdd.layer_ptr
+        self.n_layers = cbdd.n_layers
+        self.child, self.parent, self.arc_ptr = get_parent_arcs(cbdd)
+        self.selected = np.zeros(cbdd.n_nodes, dtype=bool)
+        self.conn = np.zeros(cbdd.n_nodes, dtype=bool)
+        if cbdd.pred is not None:
+            self.set_pred(cbdd.pred)
+
+    def layer_slice(self, lidx):
+        return slice(int(self.layer_ptr[lidx]), int(self.layer_ptr[lidx + 1]))
+
+    def set_pred(self, pred, from_layer=0):
+        # pred holds the predictions of the nodes from from_layer onwards
+        start = int(self.layer_ptr[from_layer])
+        self.selected[start:] = np.round(np.asarray(pred, dtype=float), self.round_upto) >= self.threshold
+
+    def set_conn(self, lidx, conn):
+        self.conn[self.layer_slice(lidx)] = conn
+
+    def check(self, from_layer=0):
+        # Computes the connected nodes layer by layer starting at from_layer and returns the first
+        # disconnected layer, None if the BDD is connected. Layers after it are left unchecked.
+        for lidx in range(from_layer, self.n_layers):
+            nodes = self.layer_slice(lidx)
+            if lidx == 0:
+                self.conn[nodes] = self.selected[nodes]
+            else:
+                arcs = slice(int(self.arc_ptr[lidx]), int(self.arc_ptr[lidx + 1]))
+                child, parent = self.child[arcs], self.parent[arcs]
+                self.conn[nodes] = False
+                self.conn[child[self.conn[parent]]] = True
+                self.conn[nodes] &= self.selected[nodes]
+
+            if not self.conn[nodes].any():
+                return lidx
+
+        return None
+
+    def write_conn(self, bdd, from_layer=0, to_layer=None):
+        # Set the "conn" flag of the nodes of the checked layers from_layer..to_layer of a list-of-layers BDD
+        to_layer = self.n_layers - 1 if to_layer is None else to_layer
+        for lidx in range(from_layer, to_layer + 1):
+            for node, conn in zip(bdd[lidx], self.conn[self.layer_slice(lidx)].tolist()):
+                node["conn"] = conn
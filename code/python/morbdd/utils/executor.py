@@ -0,0 +1,314 @@
+import multiprocessing as mp
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from multiprocessing.connection import wait
+
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+STATUS_TIMEOUT = "timeout"
+
+BACKEND_PROCESS = "process"
+BACKEND_THREAD = "thread"
+
+# Holds the connection to the executor of the worker the current task runs in. Not set when
+# tasks run in-process.
+_local = threading.local()
+
+
+def start_time_budget():
+    # Restarts the time budget of the running task, e.g. to only time the Pareto frontier computation
+    # and not the instance setup before it. Does nothing when tasks run in-process.
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.send(time.time())
+
+
+def stop_time_budget():
+    # Ends the time budget of the running task, e.g. once the Pareto frontier is computed, so that the
+    # task is not killed while it saves its results. Does nothing when tasks run in-process.
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.send(None)
+
+
+def _get_task_result(pid, status, result=None, error=None, run_time=0):
+    return {"pid": pid, "status": status, "result": result, "error": error, "time": run_time}
+
+
+def _init_worker(init_fn, args):
+    return init_fn(*args) if init_fn is not None else {}
+
+
+def _run_task(process_fn, pid, args, kwargs):
+    start = time.time()
+    try:
+        result = process_fn(pid, *args, **kwargs)
+    except Exception:
+        return _get_task_result(pid, STATUS_ERROR, error=traceback.format_exc(), run_time=time.time() - start)
+
+    return _get_task_result(pid, STATUS_OK, result=result, run_time=time.time() - start)
+
+
+def _worker_loop(process_fn, args, init_fn, conn):
+    _local.conn = conn
+
+    kwargs = _init_worker(init_fn, args)
+    while True:
+        pid = conn.recv()
+        if pid is None:
+            break
+
+        conn.send(_run_task(process_fn, pid, args, kwargs))
+
+
+class _ThreadConn:
+    # Pipe-like pair of queues between the executor and a worker thread
+    def __init__(self, inbox, outbox, wakeup=None):
+        self.inbox = inbox
+        self.outbox = outbox
+        self.wakeup = wakeup
+
+    def send(self, obj):
+        self.outbox.put(obj)
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def recv(self):
+        return self.inbox.get()
+
+    def poll(self):
+        return not self.inbox.empty()
+
+    def close(self):
+        pass
+
+
+class _WorkerThread(threading.Thread):
+    # Worker thread with the parts of the Process interface the executor uses. The thread backend takes
+    # no timeout, so a thread is only stopped once it is idle or has died, never in the middle of a task.
+    exitcode = None
+
+    def __init__(self, process_fn, args, init_fn, conn):
+        super().__init__(target=_worker_loop, args=(process_fn, args, init_fn, conn), daemon=True)
+
+    def kill(self):
+        # A thread cannot be killed. One still busy when run() is interrupted is a daemon thread and ends
+        # with the interpreter.
+        pass
+
+
+class PidExecutor:
+    # Runs process_fn(pid, *args, **init_fn(*args)) for every pid on a pool of worker processes.
+    # The next pid is handed to whichever worker becomes free first, so slow instances do not hold
+    # back a fixed stride of pids. A task that runs longer than timeout seconds gets its worker
+    # killed and replaced, and a task that raises or crashes its worker is recorded without affecting
+    # the other tasks.
+    #
+    # With backend="thread" the workers are threads of this process instead, each with its own
+    # init_fn state. This only pays off when process_fn spends its time in native code that releases
+    # the GIL (e.g. the libbddenv compilation and frontier calls), but avoids a copy of the
+    # interpreter, instance data and models per worker. A running thread cannot be killed, so this
+    # backend does not take a timeout.
+    def __init__(self, process_fn, args=(), num_processes=1, timeout=None, init_fn=None, poll_interval=1,
+                 backend=BACKEND_PROCESS):
+        if backend not in (BACKEND_PROCESS, BACKEND_THREAD):
+            raise ValueError("Invalid executor backend!")
+        if backend == BACKEND_THREAD and timeout is not None and timeout > 0:
+            # A timed-out thread would keep running its task, and writing its outputs, next to its replacement
+            raise ValueError("Invalid timeout for the thread backend, threads cannot be killed! Set the time limit to 0.")
+
+        self.process_fn = process_fn
+        self.args = tuple(args)
+        self.num_processes = max(1, int(num_processes))
+        self.timeout = timeout if timeout is not None and timeout > 0 else None
+        self.init_fn = init_fn
+        self.poll_interval = poll_interval
+        self.backend = backend
+
+        self.ctx = mp.get_context("fork")
+        # Set by the worker threads whenever they send a message
+        self.wakeup = threading.Event()
+        # worker id -> (process or thread, parent end of the pipe)
+        self.workers = {}
+        # worker id -> (pid, start time, time budget start) of the task it is running, None if idle. The
+        # budget start is None once the task ended its time budget.
+        self.running = {}
+        self.pending = deque()
+        self.results = {}
+        self._next_worker_id = 0
+
+    def _spawn_worker(self):
+        worker_id = self._next_worker_id
+        self._next_worker_id += 1
+        if self.backend == BACKEND_THREAD:
+            to_worker, from_worker = queue.Queue(), queue.Queue()
+            parent_conn = _ThreadConn(from_worker, to_worker)
+            child_conn = _ThreadConn(to_worker, from_worker, wakeup=self.wakeup)
+            process = _WorkerThread(self.process_fn, self.args, self.init_fn, child_conn)
+            process.start()
+        else:
+            parent_conn, child_conn = self.ctx.Pipe()
+            process = self.ctx.Process(target=_worker_loop,
+                                       args=(self.process_fn, self.args, self.init_fn, child_conn),
+                                       daemon=True)
+            process.start()
+            child_conn.close()
+        self.workers[worker_id] = (process, parent_conn)
+        self.running[worker_id] = None
+
+    def _stop_worker(self, worker_id, kill=False):
+        process, conn = self.workers.pop(worker_id)
+        self.running.pop(worker_id, None)
+        if not kill:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            process.join(timeout=self.poll_interval)
+        if process.is_alive():
+            process.kill()
+        process.join(timeout=self.poll_interval)
+        conn.close()
+
+    def _replace_worker(self, worker_id):
+        self._stop_worker(worker_id, kill=True)
+        if len(self.pending):
+            self._spawn_worker()
+
+    def _set_result(self, task_result):
+        self.results[task_result["pid"]] = task_result
+        self._log(task_result)
+
+    def _dispatch(self):
+        for worker_id in list(self.workers.keys()):
+            process, conn = self.workers[worker_id]
+            if self.running[worker_id] is None and len(self.pending):
+                pid = self.pending.popleft()
+                try:
+                    conn.send(pid)
+                except (BrokenPipeError, OSError):
+                    # The worker died since it was last checked, the pid goes to its replacement
+                    self.pending.appendleft(pid)
+                    self._replace_worker(worker_id)
+                    continue
+                now = time.time()
+                self.running[worker_id] = (pid, now, now)
+
+    def _receive(self, worker_id):
+        # Returns False if the worker is gone
+        process, conn = self.workers[worker_id]
+        try:
+            while conn.poll():
+                message = conn.recv()
+                if isinstance(message, dict):
+                    self._set_result(message)
+                    self.running[worker_id] = None
+                elif self.running[worker_id] is not None:
+                    # The task restarted (a time) or ended (None) its time budget
+                    pid, start, _ = self.running[worker_id]
+                    self.running[worker_id] = (pid, start, message)
+        except (EOFError, OSError):
+            return False
+
+        return True
+
+    def _check_workers(self):
+        now = time.time()
+        for worker_id in list(self.workers.keys()):
+            process, conn = self.workers[worker_id]
+            alive = self._receive(worker_id) and process.is_alive()
+            task = self.running[worker_id]
+            if task is None:
+                if not alive:
+                    self._replace_worker(worker_id)
+                continue
+
+            pid, start, budget_start = task
+            if not alive:
+                self._set_result(_get_task_result(pid, STATUS_ERROR,
+                                                  error=f"Worker exited with code {process.exitcode}",
+                                                  run_time=now - start))
+                self._replace_worker(worker_id)
+
+            elif self.timeout is not None and budget_start is not None and now - budget_start > self.timeout:
+                self._set_result(_get_task_result(pid, STATUS_TIMEOUT,
+                                                  error=f"Timeout after {self.timeout}s",
+                                                  run_time=now - start))
+                self._replace_worker(worker_id)
+
+    @staticmethod
+    def _log(task_result):
+        if task_result["status"] == STATUS_OK:
+            print(f"Processed pid {task_result['pid']} in {task_result['time']:.2f}s")
+        else:
+            print(f"Failed pid {task_result['pid']} ({task_result['status']}): {task_result['error']}")
+
+    def _run_serial(self, pids):
+        kwargs = _init_worker(self.init_fn, self.args)
+        for pid in pids:
+            self._set_result(_run_task(self.process_fn, pid, self.args, kwargs))
+
+    def _run_parallel(self, pids):
+        self.pending = deque(pids)
+        for _ in range(min(self.num_processes, len(pids))):
+            self._spawn_worker()
+
+        try:
+            while len(self.results) < len(pids):
+                self._dispatch()
+                if self.backend == BACKEND_THREAD:
+                    self.wakeup.wait(timeout=self.poll_interval)
+                    self.wakeup.clear()
+                else:
+                    handles = [h for process, conn in self.workers.values() for h in (conn, process.sentinel)]
+                    wait(handles, timeout=self.poll_interval)
+                self._check_workers()
+        finally:
+            for worker_id in list(self.workers.keys()):
+                self._stop_worker(worker_id)
+
+    def run(self, pids):
+        pids = list(pids)
+        self.results = {}
+        if len(pids) == 0:
+            return []
+
+        # Without a time budget a single worker runs in-process, which keeps debugging simple
+        if self.num_processes == 1 and self.timeout is None:
+            self._run_serial(pids)
+        else:
+            self._run_parallel(pids)
+
+        task_results = [self.results[pid] for pid in pids]
+        summary = {status: 0 for status in (STATUS_OK, STATUS_ERROR, STATUS_TIMEOUT)}
+        for task_result in task_results:
+            summary[task_result["status"]] += 1
+        print(f"Done: {summary[STATUS_OK]} ok, {summary[STATUS_ERROR]} failed, "
+              f"{summary[STATUS_TIMEOUT]} timed out")
+
+        return task_results
+
+
+def run_pids(process_fn, pids, args=(), num_processes=1, timeout=None, init_fn=None, backend=BACKEND_PROCESS):
+    executor = PidExecutor(process_fn,
+                           args=args,
+                           num_processes=num_processes,
+                           timeout=timeout,
+                           init_fn=init_fn,
+                           backend=backend)
+
+    return executor.run(pids)
+
+
+def get_failed(task_results):
+    # Tasks that raised, crashed or ran out of time
+    return [r for r in task_results if r["status"] != STATUS_OK]
+
+
+def get_results(task_results, skip_none=True):
+    # Results of the successful tasks, in pid order
+    return [r["result"] for r in task_results
+            if r["status"] == STATUS_OK and not (skip_none and r["result"] is None)]
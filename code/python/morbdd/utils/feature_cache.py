@@ -0,0 +1,119 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from morbdd import resource_path
+
+# Number of featurized instances kept in memory by each process
+FEATURE_CACHE_SIZE = 128
+FEATURE_CACHE_VERSION = 1
+# Problems whose instance data get_instance_hash knows how to hash
+FEATURE_CACHE_PROBLEMS = ("knapsack", "knapsackc")
+
+# key -> features dict, most recently used last. Shared by the worker threads of the thread backend.
+_memory_cache = OrderedDict()
+_memory_cache_lock = threading.Lock()
+
+
+def get_instance_hash(data):
+    # Hash of the instance contents, so that the key does not depend on where the instance was read from
+    h = hashlib.blake2s(digest_size=16)
+    for name in ("n_objs", "n_vars", "capacity"):
+        h.update(f"{name}={data[name]};".encode("utf-8"))
+    for name in ("weight", "value"):
+        array = np.ascontiguousarray(data[name], dtype=np.int64)
+        h.update(f"{name}={array.shape};".encode("utf-8"))
+        h.update(array.tobytes())
+
+    return h.hexdigest()
+
+
+def get_feature_cache_key(data, cfg):
+    h = hashlib.blake2s(digest_size=16)
+    h.update(get_instance_hash(data).encode("utf-8"))
+    h.update(f"v{FEATURE_CACHE_VERSION}-{cfg.norm_const}-{cfg.raw}-{cfg.context}".encode("utf-8"))
+
+    return h.hexdigest()
+
+
+def get_feature_cache_path(problem, key):
+    return resource_path / f"features/{problem}/{key[:2]}/{key}.npz"
+
+
+def _freeze(features):
+    # Cached arrays are shared between callers
+    for feat in features.values():
+        if feat is not None:
+            feat.setflags(write=False)
+
+    return features
+
+
+def _load_features(path):
+    try:
+        with np.load(path) as npz:
+            features = {name: None for name in ("raw", "inst", "var", "vrank")}
+            features.update({name: npz[name] for name in npz.files})
+    except (OSError, ValueError, EOFError):
+        return None
+
+    return features
+
+
+def _save_features(path, features):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a private file first, as several workers (processes or threads) may featurize the same instance
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp.npz")
+    np.savez(tmp_path, **{name: feat for name, feat in features.items() if feat is not None})
+    os.replace(tmp_path, path)
+
+
+def _remember(key, features):
+    with _memory_cache_lock:
+        _memory_cache[key] = features
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > FEATURE_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def _recall(key):
+    with _memory_cache_lock:
+        features = _memory_cache.get(key)
+        if features is not None:
+            _memory_cache.move_to_end(key)
+
+    return features
+
+
+def get_cached_features(problem, featurizer, data, use_disk=True):
+    # featurizer.get(data), looked up in the in-process LRU, then on disk, and computed only on a miss.
+    # The returned arrays are read-only.
+    if problem not in FEATURE_CACHE_PROBLEMS:
+        raise ValueError(f"Invalid problem {problem} for the feature cache!")
+
+    key = get_feature_cache_key(data, featurizer.cfg)
+    features = _recall(key)
+    if features is not None:
+        return features
+
+    path = get_feature_cache_path(problem, key)
+    if use_disk and path.exists():
+        features = _load_features(path)
+
+    if features is None:
+        features = featurizer.get(data)
+        if use_disk:
+            _save_features(path, features)
+
+    features = _freeze(features)
+    _remember(key, features)
+
+    return features
+
+
+def clear_feature_cache():
+    with _memory_cache_lock:
+        _memory_cache.clear()
@@ -0,0 +1,130 @@
+from bisect import bisect_left
+
+import numpy as np
+
+# Exact hypervolume of minimization fronts (same convention as pygmo: every point must be strictly better than
+# the reference point to contribute). Uses the WFG algorithm: points are sorted by their last objective, and the
+# exclusive contribution of each point is its box minus the hypervolume of its limit set, which lies in one slice
+# of the last objective and so is computed one dimension lower. Two and three objectives are solved with sweeps.
+
+# Maximum number of entries of the pairwise comparison tensor built by get_nondominated
+_MAX_COMPARISONS = 1 << 22
+
+
+def get_nondominated(points):
+    # Unique nondominated points of a minimization front, sorted lexicographically
+    points = np.unique(np.asarray(points, dtype=float), axis=0)
+    n, d = points.shape
+    if n <= 1 or d == 0:
+        return points
+    if d == 1:
+        return points[:1]
+    if d == 2:
+        # Sorted by the first objective, a point is nondominated iff it beats all points before it on the second
+        best = np.minimum.accumulate(points[:, 1])
+        keep = np.ones(n, dtype=bool)
+        keep[1:] = points[1:, 1] < best[:-1]
+        return points[keep]
+
+    # A point can only be dominated by a point before it in lexicographic order
+    keep = np.ones(n, dtype=bool)
+    chunk = max(1, _MAX_COMPARISONS // (n * d))
+    for start in range(0, n, chunk):
+        block = points[start:start + chunk]
+        rows = np.arange(len(block))
+        dominates = (points[None, :start + len(block)] <= block[:, None]).all(axis=2)
+        dominates[rows, start + rows] = False
+        keep[start:start + len(block)] = ~dominates.any(axis=1)
+
+    return points[keep]
+
+
+def _hv_2d(points, ref):
+    points = points[np.argsort(points[:, 0], kind="stable")]
+    best = np.minimum.accumulate(points[:, 1])
+    x_next = np.append(points[1:, 0], ref[0])
+
+    return float(np.sum((x_next - points[:, 0]) * (ref[1] - best)))
+
+
+def _hv_3d(points, ref):
+    # Sweep over the third objective, keeping the 2D front of the points swept so far as a staircase sorted
+    # by the first objective. Dominated points need not be filtered beforehand.
+    points = points[np.lexsort((points[:, 1], points[:, 0], points[:, 2]))].tolist()
+    xs, ys = [], []
+    area, hv = 0.0, 0.0
+    for i, (x, y, z) in enumerate(points):
+        pos = bisect_left(xs, x)
+        if not ((pos > 0 and ys[pos - 1] <= y) or (pos < len(xs) and xs[pos] == x and ys[pos] <= y)):
+            # Height of the front just left of x, then remove the points of the front dominated by (x, y)
+            cur_x, cur_h = x, ys[pos - 1] if pos > 0 else ref[1]
+            end = pos
+            while end < len(xs) and ys[end] >= y:
+                area += (xs[end] - cur_x) * (cur_h - y)
+                cur_x, cur_h = xs[end], ys[end]
+                end += 1
+            area += ((xs[end] if end < len(xs) else ref[0]) - cur_x) * (cur_h - y)
+            xs[pos:end] = [x]
+            ys[pos:end] = [y]
+
+        z_next = points[i + 1][2] if i + 1 < len(points) else ref[2]
+        hv += area * (z_next - z)
+
+    return float(hv)
+
+
+def _wfg(points, ref):
+    # points are strictly better than ref, and nondominated if there are more than three objectives
+    n, d = points.shape
+    if n == 0:
+        return 0.0
+    if n == 1:
+        return float(np.prod(ref - points[0]))
+    if d == 1:
+        return float(ref[0] - points[:, 0].min())
+    if d == 2:
+        return _hv_2d(points, ref)
+    if d == 3:
+        return _hv_3d(points, ref)
+
+    # Worst last objective first, so that the limit set of a point has its last objective
+    points = points[np.argsort(-points[:, -1], kind="stable")]
+    ref_slice = ref[:-1]
+    hv = 0.0
+    for k in range(n):
+        p = points[k, :-1]
+        box = np.prod(ref_slice - p)
+        limit = np.maximum(points[k + 1:, :-1], p)
+        if d > 4:
+            limit = get_nondominated(limit)
+        hv += (ref[-1] - points[k, -1]) * (box - _wfg(limit, ref_slice))
+
+    return float(hv)
+
+
+def hypervolume(points, ref_point=None):
+    points = np.asarray(points, dtype=float)
+    if points.ndim != 2:
+        points = points.reshape(-1, len(ref_point) if ref_point is not None else points.shape[-1])
+    ref = np.zeros(points.shape[1]) if ref_point is None else np.asarray(ref_point, dtype=float)
+    if points.shape[1] != len(ref):
+        raise ValueError("Invalid reference point!")
+
+    points = points[(points < ref).all(axis=1)]
+    if points.shape[1] > 3:
+        points = get_nondominated(points)
+
+    return _wfg(points, ref)
+
+
+def get_front_norm(z):
+    # Per-objective scale of a maximization front, as used by metric_eval to normalize all fronts of an instance
+    norm = np.abs(np.min(-np.asarray(z, dtype=float), axis=0))
+    norm[norm == 0] = 1
+
+    return norm
+
+
+def normalize_front(z, norm):
+    # Maximization front -> minimization front in [-1, 0], so that the reference point is the origin
+    return -np.asarray(z, dtype=float) / norm
@@ -0,0 +1,139 @@
+import numpy as np
+
+# Set operations between integer objective matrices (one point per row, maximization). Rows of both fronts are
+# sorted lexicographically once with np.lexsort and mapped to dense ids, so that intersections and differences
+# become O(n log n) operations on integer ids, without structured dtypes.
+
+# Maximum number of entries of the pairwise comparison tensor built by count_dominated
+_MAX_COMPARISONS = 1 << 22
+
+
+def as_front(z, n_objs=None):
+    # 2D array of objective values. Integer arrays keep their dtype and are used as they are, whatever their
+    # strides; float fronts (e.g. negated NSGA-II objectives) are rounded to int64.
+    z = np.asarray(z)
+    if z.dtype.kind == "f":
+        z = np.rint(z)
+    if z.dtype.kind not in "iu":
+        z = z.astype(np.int64)
+    if z.ndim != 2:
+        if n_objs is None:
+            n_objs = z.shape[-1] if z.size else 0
+        z = z.reshape(z.size // max(n_objs, 1), n_objs)
+
+    return z
+
+
+def _as_fronts(a, b):
+    a = np.asarray(a)
+    b = np.asarray(b)
+    n_objs = a.shape[-1] if a.size else (b.shape[-1] if b.size else 0)
+    a, b = as_front(a, n_objs), as_front(b, n_objs)
+    assert a.shape[1] == b.shape[1]
+
+    return a, b
+
+
+def lexsort_front(z):
+    # Order of the rows of z, sorted by the first objective, then the second, and so on
+    return np.lexsort(z.T[::-1])
+
+
+def get_row_ids(a, b):
+    # Dense ids of the rows of a and b, equal rows share an id and ids follow the lexicographic order
+    a, b = _as_fronts(a, b)
+    z = np.concatenate((a, b))
+    order = lexsort_front(z)
+    z = z[order]
+    new = np.ones(len(z), dtype=bool)
+    new[1:] = (z[1:] != z[:-1]).any(axis=1)
+    ids = np.empty(len(z), dtype=np.int64)
+    ids[order] = np.cumsum(new) - 1
+
+    return ids[:len(a)], ids[len(a):]
+
+
+def intersect_fronts(a, b, return_indices=False):
+    # Unique rows of a that are also in b, sorted lexicographically, and optionally the index in a of each
+    a, b = _as_fronts(a, b)
+    ids_a, ids_b = get_row_ids(a, b)
+    common, idx_a = np.unique(ids_a, return_index=True)
+    mask = np.isin(common, ids_b, assume_unique=True)
+    idx_a = idx_a[mask]
+    if return_indices:
+        return a[idx_a], idx_a
+
+    return a[idx_a]
+
+
+def difference_fronts(a, b, return_indices=False):
+    # Unique rows of a that are not in b, sorted lexicographically, and optionally the index in a of each
+    a, b = _as_fronts(a, b)
+    ids_a, ids_b = get_row_ids(a, b)
+    unique, idx_a = np.unique(ids_a, return_index=True)
+    idx_a = idx_a[~np.isin(unique, ids_b)]
+    if return_indices:
+        return a[idx_a], idx_a
+
+    return a[idx_a]
+
+
+def count_common(a, b):
+    # Number of unique rows in both a and b
+    a, b = _as_fronts(a, b)
+    if len(a) == 0 or len(b) == 0:
+        return 0
+    ids_a, ids_b = get_row_ids(a, b)
+
+    return int(np.isin(np.unique(ids_a), ids_b, assume_unique=True).sum())
+
+
+def count_dominated(a, b, eps=0.0, multiplicative=True):
+    # Number of points of b weakly eps-dominated by some point of a, i.e. a point p of a with p * (1 + eps) >= q
+    # (or p + eps >= q) on every objective. With eps=0 this is plain weak dominance.
+    a, b = _as_fronts(a, b)
+    if len(a) == 0 or len(b) == 0:
+        return 0
+    if eps:
+        a = a * (1 + eps) if multiplicative else a + eps
+
+    # Sorted by decreasing first objective, the points of a that can dominate q are a prefix
+    a = a[np.argsort(-a[:, 0], kind="stable")]
+    b = b[np.argsort(-b[:, 0], kind="stable")]
+    n_candidates = np.searchsorted(-a[:, 0], -b[:, 0], side="right")
+
+    n_objs = a.shape[1]
+    if n_objs == 1:
+        return int((n_candidates > 0).sum())
+    if n_objs == 2:
+        # Best second objective of every prefix
+        best = np.maximum.accumulate(a[:, 1])
+        has = n_candidates > 0
+        return int((best[n_candidates[has] - 1] >= b[has, 1]).sum())
+
+    count = 0
+    start = 0
+    while start < len(b):
+        # Prefixes grow along b, so a chunk only needs the prefix of its last point
+        chunk = max(1, _MAX_COMPARISONS // (max(1, n_candidates[start]) * n_objs))
+        end = min(len(b), start + chunk)
+        while end - start > 1 and (end - start) * n_candidates[end - 1] * n_objs > _MAX_COMPARISONS:
+            end = start + (end - start) // 2
+        k = n_candidates[end - 1]
+        if k:
+            dominates = (a[None, :k, 1:] >= b[start:end, None, 1:]).all(axis=2)
+            # Only the prefix of each point of the chunk counts
+            dominates &= np.arange(k)[None, :] < n_candidates[start:end, None]
+            count += int(dominates.any(axis=1).sum())
+        start = end
+
+    return count
+
+
+def coverage(a, b):
+    # Fraction of the points of b weakly dominated by a (C-metric)
+    a, b = _as_fronts(a, b)
+    if len(b) == 0:
+        return 0.0
+
+    return count_dominated(a, b) / len(b)
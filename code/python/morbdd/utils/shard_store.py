@@ -0,0 +1,127 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from morbdd import resource_path
+
+# Sharded training store: the sampled rows of many instances, concatenated in pid order and cut into shards
+# of about shard_rows rows. An instance never spans two shards. Every column of a shard is one uncompressed
+# .npy file, so a reader maps it once and hands the mapping to XGBoost without copying it:
+#   manifest.json
+#   {shard:05d}.x.npy       float32 features, C-contiguous (n_rows, n_features)
+#   {shard:05d}.y.npy       float32 labels
+#   {shard:05d}.w.npy       float32 weights
+#   {shard:05d}.pid.npy     int32 pid of every row
+#   {shard:05d}.layer.npy   int16 layer of every row
+SHARD_STORE_VERSION = 1
+SHARD_STORE_MANIFEST = "manifest.json"
+SHARD_ROWS = 1 << 20
+SHARD_COLUMNS = {"x": np.float32, "y": np.float32, "w": np.float32, "pid": np.int32, "layer": np.int16}
+
+
+def get_shard_store_path(problem, size, split, sampling_type, weights_type, label_type):
+    return resource_path / f"xgb_store/{problem}/{size}/{split}/{sampling_type}/{weights_type}/{label_type}"
+
+
+class ShardWriter:
+    def __init__(self, path, shard_rows=SHARD_ROWS):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.shard_rows = shard_rows
+        self.n_features = None
+        self.shards = []
+        # pid -> [shard, start row, stop row]
+        self.pids = {}
+        self.last_pid = None
+        self._reset()
+
+    def _reset(self):
+        self.buffer = {name: [] for name in SHARD_COLUMNS}
+        self.n_buffered = 0
+
+    def add(self, pid, x, y, w, layer):
+        if self.n_features is None:
+            self.n_features = x.shape[1]
+        assert x.shape[1] == self.n_features, "Invalid number of features!"
+        # Rows are kept sorted by pid, so that a pid range of a shard is a slice
+        assert self.last_pid is None or pid > self.last_pid, "Pids must be added in increasing order!"
+        self.last_pid = pid
+
+        n_rows = len(x)
+        self.pids[pid] = [len(self.shards), self.n_buffered, self.n_buffered + n_rows]
+        for name, column in zip(("x", "y", "w", "layer"), (x, y, w, layer)):
+            self.buffer[name].append(np.asarray(column, dtype=SHARD_COLUMNS[name]))
+        self.buffer["pid"].append(np.full(n_rows, pid, dtype=np.int32))
+        self.n_buffered += n_rows
+
+        if self.n_buffered >= self.shard_rows:
+            self.flush()
+
+    def flush(self):
+        if self.n_buffered == 0:
+            return
+
+        shard = len(self.shards)
+        for name in SHARD_COLUMNS:
+            np.save(self.path / f"{shard:05d}.{name}.npy", np.ascontiguousarray(np.concatenate(self.buffer[name])))
+        pids = [pid for pid, (k, _, _) in self.pids.items() if k == shard]
+        self.shards.append({"n_rows": self.n_buffered, "from_pid": min(pids), "to_pid": max(pids) + 1})
+        self._reset()
+
+    def close(self):
+        self.flush()
+        manifest = {"version": SHARD_STORE_VERSION,
+                    "n_features": self.n_features,
+                    "n_rows": sum(shard["n_rows"] for shard in self.shards),
+                    "shards": self.shards,
+                    "pids": {str(pid): loc for pid, loc in self.pids.items()}}
+        # The manifest is written last, a store without one is incomplete
+        tmp_path = self.path / f"{SHARD_STORE_MANIFEST}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(manifest, fp)
+        os.replace(tmp_path, self.path / SHARD_STORE_MANIFEST)
+
+
+class ShardStore:
+    def __init__(self, path):
+        self.path = Path(path)
+        manifest_path = self.path / SHARD_STORE_MANIFEST
+        if not manifest_path.exists():
+            raise ValueError(f"Invalid shard store {self.path}!")
+        with open(manifest_path, "r") as fp:
+            manifest = json.load(fp)
+        if manifest["version"] != SHARD_STORE_VERSION:
+            raise ValueError("Invalid shard store version!")
+
+        self.n_features = manifest["n_features"]
+        self.n_rows = manifest["n_rows"]
+        self.shards = manifest["shards"]
+        self.pids = {int(pid): loc for pid, loc in manifest["pids"].items()}
+
+    def __len__(self):
+        return len(self.shards)
+
+    def load_shard(self, shard, columns=("x", "y", "w")):
+        # Read-only memory maps of the columns of a shard
+        return {name: np.load(self.path / f"{shard:05d}.{name}.npy", mmap_mode="r") for name in columns}
+
+    def get_shard_rows(self, shard, from_pid=None, to_pid=None):
+        # Row range of the pids in [from_pid, to_pid) in a shard, rows are sorted by pid
+        pids = np.load(self.path / f"{shard:05d}.pid.npy", mmap_mode="r")
+        start = 0 if from_pid is None else int(np.searchsorted(pids, from_pid, side="left"))
+        stop = len(pids) if to_pid is None else int(np.searchsorted(pids, to_pid, side="left"))
+
+        return start, stop
+
+    def get_shards(self, from_pid=None, to_pid=None):
+        # Shards holding pids in [from_pid, to_pid)
+        return [k for k, shard in enumerate(self.shards)
+                if (from_pid is None or shard["to_pid"] > from_pid) and (to_pid is None or shard["from_pid"] < to_pid)]
+
+    def get_pid(self, pid, columns=("x", "y", "w")):
+        # Random access to the rows of one instance, as views of the shard mappings
+        shard, start, stop = self.pids[pid]
+
+        return {name: column[start:stop] for name, column in self.load_shard(shard, columns).items()}